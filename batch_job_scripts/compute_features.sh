@@ -19,7 +19,7 @@ scratchdir=/scratch/project_2001325/evo_hyperspectral/
 
 cd $scratchdir/
 # set parameters for preprocessing
-tree_path=$scratchdir/data/matched/matched_trees.geojson
+tree_path=$scratchdir/data/matched/matched_trees.parquet
 tile_path=$scratchdir/data/tiles/
 out_path=$scratchdir/data/matched_w_features/
 
@@ -0,0 +1,25 @@
+#!/bin/bash
+#SBATCH --job-name=dedup-trees
+#SBATCH --account=project_2001325
+#SBATCH --time=02:00:00
+#SBATCH --mem-per-cpu=4G
+#SBATCH --partition=small
+#SBATCH --cpus-per-task=10
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/dedup_trees_out_%j.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/dedup_trees_err_%j.txt
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+tree_dir=$scratchdir/data/merged/
+out_dir=$scratchdir/data/treemap/merged/
+
+# Drop the crowns delineated twice within or across tiles, before the
+# features are computed for the tree map from $out_dir
+python dedup_trees.py $tree_dir $out_dir --num-workers 10
@@ -0,0 +1,34 @@
+#!/bin/bash
+#SBATCH --job-name=map_species
+#SBATCH --account=project_2001325
+#SBATCH --time=15:00:00
+#SBATCH --mem-per-cpu=4G
+#SBATCH --partition=small
+#SBATCH --mail-type=END
+#SBATCH --cpus-per-task=30
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/map_species_out_%j.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/map_species_err_%j.txt
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+# set parameters for preprocessing
+tree_dir=$scratchdir/data/treemap/merged/
+tile_dir=$scratchdir/data/tiles/
+learner_path=$scratchdir/models/deadwood_model.pkl
+model_path=$scratchdir/models/deadwood_model.npz
+out_dir=$scratchdir/data/treemap/segs_w_species/
+
+# Export the learner so that the workers do not need to import fastai
+if [ ! -f $model_path ]; then
+    python export_model.py $learner_path $model_path
+fi
+
+# Compute the features and predict the species for each tree segment in one pass
+python map_species.py $tree_dir $tile_dir $model_path $out_dir --num-workers 30
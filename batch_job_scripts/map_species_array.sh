@@ -0,0 +1,34 @@
+#!/bin/bash
+#SBATCH --job-name=map_species
+#SBATCH --account=project_2001325
+#SBATCH --time=04:00:00
+#SBATCH --mem-per-cpu=4G
+#SBATCH --partition=small
+#SBATCH --mail-type=END
+#SBATCH --cpus-per-task=30
+#SBATCH --array=0-7
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/map_species_out_%A_%a.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/map_species_err_%A_%a.txt
+
+# Every array task maps its own share of the tiles, balanced by the number of
+# crowns. Submit the merge once all of them have finished:
+#   jobid=$(sbatch --parsable map_species_array.sh)
+#   sbatch --dependency=afterok:$jobid merge_tree_map.sh
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+# set parameters for preprocessing
+tree_dir=$scratchdir/data/treemap/merged/
+tile_dir=$scratchdir/data/tiles/
+model_path=$scratchdir/models/deadwood_model.npz
+out_dir=$scratchdir/data/treemap/segs_w_species/
+
+# The shard is taken from SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT
+python map_species.py $tree_dir $tile_dir $model_path $out_dir --fmt parquet --num-workers 30
@@ -0,0 +1,26 @@
+#!/bin/bash
+#SBATCH --job-name=merge_tree_map
+#SBATCH --account=project_2001325
+#SBATCH --time=02:00:00
+#SBATCH --mem-per-cpu=8G
+#SBATCH --partition=small
+#SBATCH --mail-type=END
+#SBATCH --cpus-per-task=1
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/merge_tree_map_out_%j.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/merge_tree_map_err_%j.txt
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+tree_dir=$scratchdir/data/treemap/merged/
+out_dir=$scratchdir/data/treemap/segs_w_species/
+
+# Collect the tiles written by the shards of map_species_array.sh into the tree
+# map, one tile at a time. Fails if a tile of tree_dir has no output.
+python merge_shards.py $out_dir $scratchdir/data/treemap/tree_map.parquet --input-dir $tree_dir
@@ -21,8 +21,13 @@ cd $scratchdir/
 # set parameters for preprocessing
 data_dir=$scratchdir/data/treemap/segs_w_features/
 learner_path=$scratchdir/models/deadwood_model.pkl
+model_path=$scratchdir/models/deadwood_model.npz
 out_dir=$scratchdir/data/treemap/segs_w_species/
 
+# Export the learner so that the workers do not need to import fastai
+if [ ! -f $model_path ]; then
+    python export_model.py $learner_path $model_path
+fi
 
 # Compute the features for each matched tree segment
-python segment_classification.py $data_dir $learner_path $out_dir --num_workers 10
\ No newline at end of file
+python segment_classification.py $data_dir $model_path $out_dir --num-workers 10
\ No newline at end of file
@@ -0,0 +1,25 @@
+#!/bin/bash
+#SBATCH --job-name=repack-tiles
+#SBATCH --account=project_2001325
+#SBATCH --time=04:00:00
+#SBATCH --mem-per-cpu=4G
+#SBATCH --partition=small
+#SBATCH --cpus-per-task=10
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/repack_tiles_out_%j.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/repack_tiles_err_%j.txt
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+tile_dir=$scratchdir/data/tiles/
+out_dir=$scratchdir/data/tiles_repacked/
+
+# Repack the tiles once into compressed blocks and copy the CHM band to
+# $out_dir/chm. Later stages take $out_dir in place of $tile_dir.
+python repack_tiles.py $tile_dir $out_dir --num-workers 10
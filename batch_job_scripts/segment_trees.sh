@@ -0,0 +1,25 @@
+#!/bin/bash
+#SBATCH --job-name=segment-trees
+#SBATCH --account=project_2001325
+#SBATCH --time=04:00:00
+#SBATCH --mem-per-cpu=4G
+#SBATCH --partition=small
+#SBATCH --cpus-per-task=20
+#SBATCH --output=/scratch/project_2001325/evo_hyperspectral/logs/segment_trees_out_%j.txt
+#SBATCH --error=/scratch/project_2001325/evo_hyperspectral/logs/segment_trees_err_%j.txt
+
+# activate environment and load module
+module purge
+module load tykky
+
+export PATH="/projappl/project_2001325/ibccarbon/bin:$PATH"
+
+scratchdir=/scratch/project_2001325/evo_hyperspectral/
+
+cd $scratchdir/
+tile_dir=$scratchdir/data/tiles/
+out_dir=$scratchdir/data/merged/
+
+# Python alternative to detect_treetops.sh and fix_crown_data.py, with the same
+# parameters (ws=5, hmin=10), writing the merged trees of each tile directly
+python segment_trees.py $tile_dir $out_dir --ws 5 --hmin 10 --num-workers 20
@@ -0,0 +1,62 @@
+"""
+Per-tile wall time of fix_crown_data.merge_files against the former row-wise
+implementation on synthetic crowns.
+
+    python -m benchmarks.bench_merge --n-trees 20000
+"""
+
+from fastcore.script import *
+import json
+import tempfile
+import time
+from pathlib import Path
+import geopandas as gpd
+from shapely.geometry import Polygon
+from benchmarks import synthetic
+from fix_crown_data import merge_files
+
+
+def merge_files_rowwise(ttop_fname:Path, crown_fname:Path, outfile:Path):
+    "The row-wise merge that preceded the vectorized implementation"
+    ttops = gpd.read_file(ttop_fname)
+    ttops.rename(columns={'geometry':'ttop', 'Z':'max_height'}, inplace=True)
+    ttops.set_index('treeID', drop=True, inplace=True)
+    ttops['ttop_x'] = ttops.apply(lambda row: row.ttop.x, axis=1)
+    ttops['ttop_y'] = ttops.apply(lambda row: row.ttop.y, axis=1)
+    ttops = ttops.drop(['ttop', 'max_height'], axis=1)
+    crowns = gpd.read_file(crown_fname)
+    crowns.set_index('value', drop=True, inplace=True)
+    crowns.sort_values(by='value', inplace=True)
+    crowns = crowns.join(ttops, how='outer')
+    crowns = crowns.dropna()
+    crowns['geometry'] = crowns.apply(lambda row: Polygon(row.geometry.exterior), axis=1)
+    crowns.rename(columns={'value':'treeID'}, inplace=True)
+    crowns['bounds_x'] = crowns.apply(lambda row: row.geometry.bounds[2] - row.geometry.bounds[0], axis=1)
+    crowns['bounds_y'] = crowns.apply(lambda row: row.geometry.bounds[3] - row.geometry.bounds[1], axis=1)
+    crowns.set_crs('EPSG:32635', inplace=True, allow_override=True)
+    crowns['tile_id'] = outfile.stem
+    crowns.to_file(filename=outfile, driver='GeoJSON')
+
+
+@call_parse
+def bench_merge(n_trees:int=10000, # Number of crowns in the synthetic tile
+                repeats:int=3): # Number of timed runs per implementation
+    "Compare the per-tile wall time of the vectorized and row-wise crown merge"
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for d in ['ttops', 'crowns', 'rowwise', 'vectorized']: (tmp/d).mkdir()
+        ttops, crowns = synthetic.make_crowns(n_trees, synthetic.tile_bounds(0, 0))
+        ttops.to_file(tmp/'ttops'/'R1C1.geojson', driver='GeoJSON')
+        crowns.to_file(tmp/'crowns'/'R1C1.geojson', driver='GeoJSON')
+
+        results = {'n_trees': n_trees}
+        for name, func in [('rowwise', merge_files_rowwise), ('vectorized', merge_files)]:
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                func(tmp/'ttops'/'R1C1.geojson', tmp/'crowns'/'R1C1.geojson', tmp/name/'R1C1.geojson')
+                times.append(time.perf_counter() - start)
+            results[f'{name}_seconds'] = min(times)
+        results['identical_output'] = (tmp/'rowwise'/'R1C1.geojson').read_bytes() == (tmp/'vectorized'/'R1C1.geojson').read_bytes()
+        results['speedup'] = results['rowwise_seconds'] / results['vectorized_seconds']
+    print(json.dumps(results))
@@ -0,0 +1,74 @@
+"""
+Wall time and worker idle time of per-tile Pool.starmap against the tree
+batch scheduler on a synthetic tile set with a skewed number of crowns.
+
+    python -m benchmarks.bench_scheduler --workers 8
+"""
+
+from fastcore.script import *
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from benchmarks import synthetic
+from generate_features import generate_reflectance_features
+from src import scheduler
+
+
+def _timed(func, *args):
+    "Run a task and return when and where it ran"
+    start = time.time()
+    func(*args)
+    return os.getpid(), start, time.time()
+
+
+def _summary(spans, start, end, workers):
+    "Wall time, utilisation and the tail where some workers already sit idle"
+    busy = sum(t1 - t0 for _, t0, t1 in spans)
+    last_by_worker = {}
+    for pid, _, t1 in spans: last_by_worker[pid] = max(last_by_worker.get(pid, 0), t1)
+    first_idle = min(last_by_worker.values()) if len(last_by_worker) == workers else start
+    return {'wall_seconds': end - start, 'utilisation': busy / (workers * (end - start)),
+            'tail_seconds': end - first_idle}
+
+
+@call_parse
+def bench_scheduler(n_tiles:int=16, # Number of synthetic tiles
+                    workers:int=4, # Number of worker processes
+                    n_bands:int=32, # Bands per tile
+                    tile_size:float=150.0, # Tile side in metres
+                    batch_size:int=scheduler.DEFAULT_BATCH_SIZE, # Trees per scheduled task
+                    seed:int=0):
+    "Compare per-tile starmap with the tree batch scheduler on skewed tiles"
+    rng = np.random.default_rng(seed)
+    # A few dense tiles and many sparse ones
+    n_trees = np.maximum((rng.pareto(1.2, n_tiles) + 0.05) * 1000, 50).astype(int)
+    n_trees = np.minimum(n_trees, 20000)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        tasks, batched = [], []
+        for i, n in enumerate(n_trees):
+            bounds = synthetic.tile_bounds(i // 8, i % 8, size=tile_size)
+            _, crowns = synthetic.make_crowns(int(n), bounds, seed=i)
+            tile_fn = tmp/f'T{i}.tif'
+            synthetic.write_tile(tile_fn, bounds, n_bands, seed=i)
+            tasks.append((generate_reflectance_features, tile_fn, crowns))
+            for batch in scheduler.tree_batches(crowns.geometry.values, batch_size):
+                batched.append((generate_reflectance_features, tile_fn, crowns.iloc[batch]))
+
+        results = {'n_tiles': n_tiles, 'workers': workers, 'n_trees': int(n_trees.sum()),
+                   'largest_tile': int(n_trees.max()), 'n_batches': len(batched)}
+
+        start = time.time()
+        with multiprocessing.Pool(workers) as pool:
+            spans = pool.starmap(_timed, tasks)
+        results['starmap'] = _summary(spans, start, time.time(), workers)
+
+        start = time.time()
+        spans = [s for _, s in scheduler.run(_timed, batched, [len(t[2]) for t in batched], workers)]
+        results['scheduler'] = _summary(spans, start, time.time(), workers)
+        results['speedup'] = results['starmap']['wall_seconds'] / results['scheduler']['wall_seconds']
+    print(json.dumps(results))
@@ -0,0 +1,101 @@
+"""
+Read throughput of band sequential, stripped tiles against the same tiles
+repacked with repack_tiles.py, band and pixel interleaved, for the access
+patterns of the pipeline:
+
+    crowns    the pixels of all crowns in block rows, as in feature extraction
+    spec      the same for a subset of the bands, as with a feature spec
+    windows   the cube windows around the treetops in random order
+    chm       the whole CHM band, as in the segmentation
+
+Each pattern is timed after dropping the tile from the page cache (cold) and
+again right after (warm). Random reflectances compress far worse than real
+spectra, so the file sizes are an upper bound for the repacked tiles.
+
+    python -m benchmarks.bench_tiles --n-bands 461 --tile-size 100
+"""
+
+from fastcore.script import *
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from benchmarks import synthetic
+from src import segmentation, tiles
+
+PATTERNS = ('crowns', 'spec', 'windows', 'chm')
+
+
+def _drop_cache(*paths):
+    "Ask the kernel to evict the pages of the files from the page cache"
+    for p in paths:
+        if not Path(p).exists(): continue
+        fd = os.open(p, os.O_RDONLY)
+        try: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally: os.close(fd)
+
+
+def _read(pattern, tile_fn, crowns, n_bands, n_windows, ws, seed):
+    "Read a tile with an access pattern and return the number of bytes decoded"
+    if pattern == 'chm':
+        chm, _ = segmentation.read_chm(tile_fn, n_bands)
+        return chm.size * 4
+    bands = None if pattern != 'spec' else np.linspace(1, n_bands, min(20, n_bands)).astype(int)
+    with tiles.TileReader(tile_fn, bands) as reader:
+        if pattern == 'windows':
+            rng = np.random.default_rng(seed)
+            pick = rng.choice(len(crowns), min(n_windows, len(crowns)), replace=False)
+            x, y = crowns.X.values[pick], crowns.Y.values[pick]
+            bounds = np.stack([x - ws, y - ws, x + ws, y + ws], axis=1)
+            for window in tiles.masking.bbox_windows(bounds, reader.xs, reader.ys): reader.read(window)
+        else:
+            for _ in tiles.crown_pixel_batches(reader, crowns.geometry.values): pass
+        return reader.bytes_read
+
+
+@call_parse
+def bench_tiles(n_bands:int=461, # Bands per tile, the last one standing in for the CHM
+                tile_size:float=100.0, # Tile side in metres
+                n_trees:int=2000, # Crowns per tile
+                n_windows:int=200, # Cube windows read by the windows pattern
+                window_size:int=4, # Radius of the cube windows in metres
+                block_size:int=tiles.REPACK_BLOCK_SIZE, # Block size of the repacked tiles
+                compress:str=tiles.REPACK_COMPRESS, # Compression of the repacked tiles
+                seed:int=0):
+    "Compare the read throughput of the original and the repacked tile layouts"
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        bounds = synthetic.tile_bounds(0, 0, size=tile_size)
+        _, crowns = synthetic.make_crowns(n_trees, bounds, seed=seed)
+        layouts = {'source': tmp/'source'/'R0C0.tif'}
+        os.makedirs(layouts['source'].parent)
+        synthetic.write_tile(layouts['source'], bounds, n_bands, seed=seed, interleave='band')
+        results = {'n_bands': n_bands, 'tile_size': tile_size, 'n_trees': n_trees, 'block_size': block_size,
+                   'compress': compress, 'size_mb': {'source': layouts['source'].stat().st_size / 2**20},
+                   'repack_seconds': {}, 'patterns': {}}
+        for interleave in ('band', 'pixel'):
+            tile_fn = layouts[interleave] = tmp/interleave/'R0C0.tif'
+            os.makedirs(tiles.chm_path(tile_fn).parent)
+            start = time.perf_counter()
+            tiles.repack(layouts['source'], tile_fn, tiles.chm_path(tile_fn), n_bands, block_size, compress, interleave)
+            results['repack_seconds'][interleave] = time.perf_counter() - start
+            results['size_mb'][interleave] = tile_fn.stat().st_size / 2**20
+        results['size_mb']['chm'] = tiles.chm_path(layouts['band']).stat().st_size / 2**20
+
+        for pattern in PATTERNS:
+            results['patterns'][pattern] = {}
+            for layout, tile_fn in layouts.items():
+                r = results['patterns'][pattern][layout] = {}
+                for cache in ('cold', 'warm'):
+                    if cache == 'cold': _drop_cache(tile_fn, tiles.chm_path(tile_fn))
+                    start = time.perf_counter()
+                    n_bytes = _read(pattern, tile_fn, crowns, n_bands, n_windows, window_size, seed)
+                    r[f'{cache}_seconds'] = time.perf_counter() - start
+                    r[f'{cache}_mb_per_s'] = n_bytes / 2**20 / r[f'{cache}_seconds']
+            source = results['patterns'][pattern]['source']
+            for layout in ('band', 'pixel'):
+                r = results['patterns'][pattern][layout]
+                for cache in ('cold', 'warm'): r[f'{cache}_speedup'] = source[f'{cache}_seconds'] / r[f'{cache}_seconds']
+    print(json.dumps(results))
@@ -0,0 +1,158 @@
+"""
+Latency of the tree map service under load.
+
+Builds an index over a synthetic tree map of `n_tiles` tiles (or uses an
+existing index), starts serve_tree_map.py in a separate process and sends
+`n_requests` random requests of each kind from `concurrency` client threads
+over keep-alive connections:
+
+    bbox      the trees in a 50 m box as NDJSON
+    radius    the trees within 20 m of a point as NDJSON
+    species   the number of trees of one species in a 500 m box
+    counts    species counts per hectare in a 500 m box
+    stream    all trees of a 250 m tile as GeoParquet
+
+The p50 and p99 latencies in milliseconds are printed as JSON.
+
+    python -m benchmarks.bench_tree_map --n-tiles 16 --n-trees 5000
+"""
+
+from fastcore.script import *
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlencode
+import numpy as np
+import shapely
+from benchmarks import synthetic
+from src import geo_io, tree_index
+
+SPECIES = ('Scots pine', 'Norway spruce', 'Birch', 'European aspen', 'Deadwood')
+QUERIES = ('bbox', 'radius', 'species', 'counts', 'stream')
+
+
+def write_tree_map(out_dir, n_tiles, n_trees, seed=0):
+    "Per-tile outputs like those of map_species.py, on a square grid of 250 m tiles"
+    rng = np.random.default_rng(seed)
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    side = int(np.ceil(np.sqrt(n_tiles)))
+    for t in range(n_tiles):
+        row, col = divmod(t, side)
+        ttops, crowns = synthetic.make_crowns(n_trees, synthetic.tile_bounds(row, col), f'R{row}C{col}', seed + t)
+        crowns['ttop_x'] = shapely.get_x(ttops.geometry.values)
+        crowns['ttop_y'] = shapely.get_y(ttops.geometry.values)
+        crowns['tile_id'] = f'R{row}C{col}'
+        crowns['species'] = rng.choice(SPECIES, n_trees, p=[0.45, 0.3, 0.15, 0.07, 0.03])
+        geo_io.write_frame(crowns, Path(out_dir)/f'R{row}C{col}.parquet')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait(port, timeout=30):
+    "Wait until the server answers"
+    end = time.time() + timeout
+    while True:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/info')
+            return json.loads(conn.getresponse().read())
+        except OSError:
+            if time.time() > end: raise
+            time.sleep(0.1)
+
+
+def make_requests(kind, n, bounds, seed=0):
+    "Random request paths of a kind within the bounds of the map"
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    paths = []
+    for _ in range(n):
+        x, y = rng.uniform(xmin, xmax), rng.uniform(ymin, ymax)
+        if kind == 'bbox': params = {'bbox': f'{x},{y},{x + 50},{y + 50}'}
+        elif kind == 'radius': params = {'x': x, 'y': y, 'r': 20}
+        elif kind == 'species':
+            params = {'bbox': f'{x - 250},{y - 250},{x + 250},{y + 250}', 'species': rng.choice(SPECIES), 'format': 'count'}
+        elif kind == 'counts': params = {'bbox': f'{x - 250},{y - 250},{x + 250},{y + 250}', 'cell': 100}
+        else: params = {'bbox': f'{x - 125},{y - 125},{x + 125},{y + 125}', 'format': 'parquet'}
+        paths.append(('/counts?' if kind == 'counts' else '/trees?') + urlencode(params))
+    return paths
+
+
+def load(port, paths, concurrency):
+    """
+    Send the requests from `concurrency` threads, each with its own
+    connection, and return the latency of each request in seconds and the
+    bytes received.
+    """
+    def worker(chunk):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        results = []
+        for path in chunk:
+            start = time.perf_counter()
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+            results.append((time.perf_counter() - start, len(body)))
+            if response.status != 200: raise RuntimeError(f'{path}: {response.status} {body[:200]}')
+        conn.close()
+        return results
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = [r for rs in pool.map(worker, [paths[i::concurrency] for i in range(concurrency)]) for r in rs]
+    return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+
+
+@call_parse
+def bench_tree_map(n_tiles:int=16, # Tiles of the synthetic tree map
+                   n_trees:int=5000, # Trees per tile
+                   index_dir:Path=None, # Use this index instead of a synthetic tree map
+                   n_requests:int=200, # Requests of each kind
+                   concurrency:int=4, # Client threads
+                   seed:int=0):
+    "Report the p50 and p99 latency of the tree map service for each kind of query"
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        results = {'concurrency': concurrency, 'n_requests': n_requests}
+        if index_dir is None:
+            write_tree_map(tmp/'map', n_tiles, n_trees, seed)
+            start = time.perf_counter()
+            tree_index.build(geo_io.list_frames(tmp/'map'), tmp/'index')
+            results['build_seconds'] = time.perf_counter() - start
+            index_dir = tmp/'index'
+        index = tree_index.TreeIndex(index_dir)
+        bounds = (index.x.min(), index.y.min(), index.x.max(), index.y.max())
+        results['n_trees'] = len(index)
+
+        port = _free_port()
+        server = subprocess.Popen([sys.executable, 'serve_tree_map.py', str(index_dir), '--port', str(port)],
+                                  cwd=Path(__file__).parent.parent, stdout=subprocess.DEVNULL)
+        try:
+            start = time.perf_counter()
+            _wait(port)
+            results['startup_seconds'] = time.perf_counter() - start
+            results['queries'] = {}
+            for kind in QUERIES:
+                paths = make_requests(kind, n_requests, bounds, seed)
+                # Warm up the connections and the page cache
+                load(port, paths[:concurrency], concurrency)
+                start = time.perf_counter()
+                latency, size = load(port, paths, concurrency)
+                elapsed = time.perf_counter() - start
+                results['queries'][kind] = {'p50_ms': np.percentile(latency, 50) * 1e3,
+                                            'p99_ms': np.percentile(latency, 99) * 1e3,
+                                            'max_ms': latency.max() * 1e3,
+                                            'requests_per_s': len(paths) / elapsed,
+                                            'mean_kb': size.mean() / 2**10}
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(results))
@@ -0,0 +1,60 @@
+"""
+Per-tile parity and runtime of src.segmentation against the lidR outputs of
+detect_trees.R, i.e. the ttops/ and crowns/ GeoJSON files of its output
+directory.
+
+    python -m benchmarks.parity_segmentation data/tiles data/ --tiles R10C12,R10C13
+"""
+
+from fastcore.script import *
+import json
+import time
+from pathlib import Path
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+from src import geo_io, segmentation
+
+
+def compare_tile(tile_fn, lidr_dir, band):
+    "Segment a tile and compare the treetops and crowns with those of lidR"
+    start = time.time()
+    ttops, crowns, _, transform = segmentation.segment_tile(tile_fn, band)
+    seconds = time.time() - start
+    ref_ttops = geo_io.find_frame(Path(lidr_dir)/'ttops', tile_fn.stem)
+    ref_crowns = geo_io.find_frame(Path(lidr_dir)/'crowns', tile_fn.stem)
+    ref_ttops, ref_crowns = geo_io.read_frame(ref_ttops), geo_io.read_frame(ref_crowns)
+
+    # Treetops on the same pixel
+    xy = shapely.get_coordinates(ttops.geometry.values)
+    ref_xy = shapely.get_coordinates(ref_ttops.geometry.values)
+    dist, nearest = cKDTree(xy).query(ref_xy) if len(xy) else (np.full(len(ref_xy), np.inf), None)
+    same = dist < abs(transform.a) / 2
+
+    # Crowns of the matched treetops
+    ids = dict(zip(ref_ttops.treeID.values[same], ttops.treeID.values[nearest[same]])) if same.any() else {}
+    ours = dict(zip(crowns.value.values, crowns.geometry.values))
+    ious = []
+    for ref_id, geom in zip(ref_crowns.value.values, ref_crowns.geometry.values):
+        other = ours.get(ids.get(ref_id))
+        if other is None: continue
+        ious.append(shapely.area(shapely.intersection(geom, other)) / shapely.area(shapely.union(geom, other)))
+    return {'tile_id': tile_fn.stem, 'seconds': seconds,
+            'ttops': len(ttops), 'lidr_ttops': len(ref_ttops), 'ttops_matched': int(same.sum()),
+            'crowns': len(crowns), 'lidr_crowns': len(ref_crowns), 'crowns_matched': len(ious),
+            'crown_iou_median': float(np.median(ious)) if ious else None,
+            'crown_iou_mean': float(np.mean(ious)) if ious else None}
+
+
+@call_parse
+def parity_segmentation(tile_dir:Path, # Directory of the hyperspectral tiles
+                        lidr_dir:Path, # Output directory of detect_trees.R, containing ttops/ and crowns/
+                        tiles:str=None, # Comma separated tile ids, all tiles with lidR outputs by default
+                        band:int=segmentation.CHM_BAND): # Band of the canopy height model
+    "Compare the Python segmentation with the lidR outputs tile by tile"
+    tile_ids = tiles.split(',') if tiles else [f.stem for f in geo_io.list_frames(lidr_dir/'ttops')]
+    results = [compare_tile(tile_dir/f'{t}.tif', lidr_dir, band) for t in tile_ids]
+    for r in results: print(json.dumps(r))
+    total = {k: sum(r[k] for r in results) for k in ['seconds', 'ttops', 'lidr_ttops', 'ttops_matched', 'crowns', 'lidr_crowns']}
+    print(json.dumps({'tiles': len(results), **total,
+                      'ttop_recall': total['ttops_matched'] / max(total['lidr_ttops'], 1)}))
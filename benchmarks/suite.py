@@ -0,0 +1,155 @@
+"""
+Throughput of every pipeline stage on synthetic Evo-like data.
+
+Generates `n_tiles` tiles of 461 bands on the 0.5 m grid in EPSG:32635, with
+the treetop and crown files of detect_trees.R and field plots, and times the
+crown merge, field data matching, feature extraction, cube extraction and
+species inference on them. Each stage runs in a fresh process, which reports
+its wall time, trees per second, peak RSS and the bytes it read. The results
+are printed as JSON and can be compared with the results of another commit.
+
+    python -m benchmarks.suite --n-tiles 4 --out results.json
+    python -m benchmarks.suite --n-tiles 4 --baseline results.json
+"""
+
+from fastcore.script import *
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from benchmarks import synthetic
+from src import geo_io, inference, stats
+
+STAGES = ('merge', 'match', 'features', 'cubes', 'inference')
+
+
+def _io_counters():
+    "Bytes read by this process through system calls (rchar) and from storage (read_bytes)"
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['read_bytes'])
+    except (FileNotFoundError, KeyError):
+        return 0, 0
+
+
+def generate(work_dir, n_tiles, trees_per_tile, tile_size, n_bands, n_plots, seed=0):
+    "Write the synthetic tiles, treetops, crowns, field plots and model into `work_dir`"
+    for d in ['tiles', 'ttops', 'crowns']: os.makedirs(work_dir/d, exist_ok=True)
+    cols = int(np.ceil(np.sqrt(n_tiles)))
+    field = []
+    for i in range(n_tiles):
+        tile_id = f'R{i // cols}C{i % cols}'
+        bounds = synthetic.tile_bounds(i // cols, i % cols, size=tile_size)
+        ttops, crowns = synthetic.make_crowns(trees_per_tile, bounds, tile_id, seed=seed + i)
+        geo_io.write_frame(ttops, work_dir/'ttops'/f'{tile_id}.geojson')
+        geo_io.write_frame(crowns, work_dir/'crowns'/f'{tile_id}.geojson')
+        synthetic.write_tile(work_dir/'tiles'/f'{tile_id}.tif', bounds, n_bands, seed=seed + i)
+        field.append(synthetic.make_field_plots(ttops, n_plots, seed=seed + i))
+    geo_io.write_frame(pd.concat(field, ignore_index=True), work_dir/'field.parquet')
+    synthetic.write_model(work_dir/'model.npz', stats.feature_names(n_bands), seed=seed)
+
+
+def _run(stage, work_dir):
+    "Run a stage over all tiles and return the number of trees it processed"
+    from fix_crown_data import merge_files
+    from generate_features_treemap import generate_reflectance_features
+    from make_cubes import generate_cubes_from_tile
+    from match_field_data import generate_data_contour
+    from segment_classification import process_file
+
+    tile_ids = sorted(f.stem for f in (work_dir/'tiles').glob('*.tif'))
+    for d in ['merged', 'matched', 'features', 'cubes', 'species']: os.makedirs(work_dir/d, exist_ok=True)
+    if stage == 'merge':
+        for t in tile_ids:
+            merge_files(work_dir/'ttops'/f'{t}.geojson', work_dir/'crowns'/f'{t}.geojson', work_dir/'merged'/f'{t}.parquet')
+        return sum(len(geo_io.read_frame(work_dir/'merged'/f'{t}.parquet', columns=['tile_id'])) for t in tile_ids)
+    if stage == 'match':
+        generate_data_contour(work_dir/'field.parquet', work_dir/'merged', work_dir/'matched', fmt='parquet')
+        return sum(len(geo_io.read_frame(work_dir/'merged'/f'{t}.parquet', columns=['tile_id'])) for t in tile_ids)
+    if stage == 'features':
+        n = 0
+        for t in tile_ids:
+            trees = geo_io.read_frame(work_dir/'merged'/f'{t}.parquet')
+            features = generate_reflectance_features(work_dir/'tiles'/f'{t}.tif', trees)
+            pd.concat([trees, features.set_index(trees.index)], axis=1).to_parquet(work_dir/'features'/f'{t}.parquet')
+            n += len(trees)
+        return n
+    if stage == 'cubes':
+        matched = geo_io.read_frame(work_dir/'matched'/'matched_trees.parquet')
+        for t, trees in matched.groupby('tile_id'):
+            generate_cubes_from_tile(work_dir/'tiles'/f'{t}.tif', trees, work_dir/'cubes', 4)
+        return len(matched)
+    if stage == 'inference':
+        model, n = inference.NumpyMLP.load(work_dir/'model.npz'), 0
+        for t in tile_ids:
+            process_file(work_dir/'features'/f'{t}.parquet', model, work_dir/'species', 'parquet')
+            n += len(geo_io.read_frame(work_dir/'species'/f'{t}.parquet', columns=['species']))
+        return n
+    raise ValueError(f'Unknown stage {stage}')
+
+
+def measure(stage, work_dir):
+    "Run a stage in this process and measure it"
+    rchar, read_bytes = _io_counters()
+    start = time.perf_counter()
+    # The progress messages of the stages are not part of the output
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_trees = _run(stage, Path(work_dir))
+    seconds = time.perf_counter() - start
+    rchar_end, read_bytes_end = _io_counters()
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'stage': stage, 'trees': n_trees, 'seconds': seconds, 'trees_per_second': n_trees / max(seconds, 1e-9),
+            'peak_rss_mb': peak_rss / 2**20, 'read_mb': (rchar_end - rchar) / 2**20,
+            'storage_read_mb': (read_bytes_end - read_bytes) / 2**20}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@call_parse
+def suite(n_tiles:int=1, # Number of synthetic tiles, the scale of the run
+          trees_per_tile:int=2000, # Crowns per tile
+          tile_size:float=100.0, # Tile side in metres
+          n_bands:int=461, # Bands per tile, the last one standing in for the CHM
+          n_plots:int=10, # Field plots per tile
+          stages:str=','.join(STAGES), # Comma separated stages to time, later stages need the outputs of earlier ones
+          work_dir:Path=None, # Where to write the data, a temporary directory by default
+          out:Path=None, # Also write the results into this JSON file
+          baseline:Path=None, # Results of an earlier run to compare with
+          seed:int=0):
+    "Time the pipeline stages on synthetic tiles"
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(work_dir or tmp)
+        start = time.perf_counter()
+        generate(work_dir, n_tiles, trees_per_tile, tile_size, n_bands, n_plots, seed)
+        results = {'commit': _commit(), 'n_tiles': n_tiles, 'trees_per_tile': trees_per_tile, 'tile_size': tile_size,
+                   'n_bands': n_bands, 'n_plots': n_plots, 'generate_seconds': time.perf_counter() - start, 'stages': {}}
+        # A fresh process per stage, so that the peak RSS and the bytes read belong to the stage
+        ctx = multiprocessing.get_context('spawn')
+        for stage in stages.split(','):
+            with ctx.Pool(1) as pool:
+                results['stages'][stage] = pool.apply(measure, (stage, work_dir))
+
+    if baseline is not None:
+        with open(baseline) as f: base = json.load(f)
+        for stage, r in results['stages'].items():
+            if stage in base.get('stages', {}):
+                r['speedup'] = r['trees_per_second'] / base['stages'][stage]['trees_per_second']
+        results['baseline_commit'] = base.get('commit')
+    if out is not None:
+        with open(out, 'w') as f: json.dump(results, f, indent=1)
+    print(json.dumps(results))
@@ -0,0 +1,120 @@
+"""
+Synthetic inputs with the layout of the Evo data for benchmarking the pipeline.
+
+Tiles use the 0.5 m grid in EPSG:32635 with pixel centres at .25/.75, and the
+treetop and crown files mimic the output of detect_trees.R.
+"""
+
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+import shapely
+
+CRS = 'EPSG:32635'
+RESOLUTION = 0.5
+
+
+def make_crowns(n_trees, bounds, tile_id='R1C1', seed=0):
+    """
+    Random treetops and convex crown polygons within `bounds`.
+
+    Return
+    ------
+    ttops : A GeoDataFrame with the columns treeID, Z and the treetop points
+    crowns : A GeoDataFrame with the columns value, X, Y, Height_m, CA_m2 and the crown polygons
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    margin = 4
+    # Treetops at pixel centres
+    cols = rng.integers(margin / RESOLUTION, (xmax - xmin - margin) / RESOLUTION, n_trees)
+    rows = rng.integers(margin / RESOLUTION, (ymax - ymin - margin) / RESOLUTION, n_trees)
+    ttop_x = xmin + (cols + 0.5) * RESOLUTION
+    ttop_y = ymax - (rows + 0.5) * RESOLUTION
+    height = np.round(rng.uniform(10, 30, n_trees), 2)
+
+    # Crowns as convex hulls of vertices snapped to the pixel centre grid
+    n_vertices = 12
+    angles = rng.uniform(0, 2*np.pi, (n_trees, n_vertices))
+    radii = rng.uniform(0.5, 3.0, (n_trees, 1)) * rng.uniform(0.6, 1.0, (n_trees, n_vertices))
+    vx = np.round((ttop_x[:,None] + radii*np.cos(angles)) * 4) / 4
+    vy = np.round((ttop_y[:,None] + radii*np.sin(angles)) * 4) / 4
+    crowns = shapely.convex_hull(shapely.multipoints(np.stack([vx, vy], axis=-1)))
+    crowns = np.where(shapely.get_type_id(crowns) == 3, crowns,
+                      shapely.buffer(shapely.points(ttop_x, ttop_y), RESOLUTION, quad_segs=2))
+
+    tree_id = np.arange(1, n_trees + 1)
+    ttops = gpd.GeoDataFrame({'treeID': tree_id, 'Z': height},
+                             geometry=shapely.points(ttop_x, ttop_y), crs=CRS)
+    centroids = shapely.centroid(crowns)
+    crowns = gpd.GeoDataFrame({'value': tree_id,
+                               'X': np.round(shapely.get_x(centroids), 2),
+                               'Y': np.round(shapely.get_y(centroids), 2),
+                               'Height_m': height,
+                               'CA_m2': np.round(shapely.area(crowns), 2)},
+                              geometry=crowns, crs=CRS)
+    return ttops, crowns
+
+
+def tile_bounds(row, col, size=250.0, origin=(380000.0, 6810000.0)):
+    "Bounds of the synthetic tile at `row`, `col` of a regular tiling"
+    xmin = origin[0] + col * size
+    ymax = origin[1] - row * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def write_tile(path, bounds, n_bands=461, seed=0, block_size=None, interleave=None):
+    """
+    Write a float32 tile of random reflectances covering `bounds`, with the
+    last band standing in for the CHM. Row blocks are used unless
+    `block_size` is given, and the GDAL default interleaving unless
+    `interleave` is 'band' or 'pixel'.
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    width, height = int(round((xmax - xmin) / RESOLUTION)), int(round((ymax - ymin) / RESOLUTION))
+    profile = dict(driver='GTiff', width=width, height=height, count=n_bands, dtype='float32', crs=CRS,
+                   transform=from_origin(xmin, ymax, RESOLUTION, RESOLUTION))
+    if block_size is not None: profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+    if interleave is not None: profile['interleave'] = interleave
+    with rasterio.open(path, 'w', **profile) as dst:
+        for b in range(1, n_bands + 1):
+            dst.write(rng.normal(0.2, 0.05, (height, width)).astype(np.float32), b)
+
+
+def make_field_plots(ttops, n_plots=10, radius=9.0, seed=0):
+    """
+    Circular field plots around random treetops. Every treetop within a plot
+    gets a field tree measured close to it, with the columns of the field data.
+
+    Return
+    ------
+    field : A GeoDataFrame with the columns species, tree_X, tree_Y, DBH, nov_2019, sum_2019 and is_gps
+    """
+    rng = np.random.default_rng(seed)
+    x, y = shapely.get_x(ttops.geometry.values), shapely.get_y(ttops.geometry.values)
+    centres = rng.choice(len(ttops), min(n_plots, len(ttops)), replace=False)
+    near = np.zeros(len(ttops), dtype=bool)
+    for c in centres: near |= (x - x[c])**2 + (y - y[c])**2 <= radius**2
+    n = int(near.sum())
+    # Field positions are a few decimetres off the detected treetops
+    tree_x = np.round(x[near] + rng.normal(0, 0.3, n), 2)
+    tree_y = np.round(y[near] + rng.normal(0, 0.3, n), 2)
+    return gpd.GeoDataFrame({'species': rng.choice(['pine', 'spruce', 'birch', 'aspen', 'dead'], n),
+                             'tree_X': tree_x, 'tree_Y': tree_y,
+                             'DBH': np.round(rng.uniform(10, 50, n), 1),
+                             'nov_2019': rng.integers(0, 2, n), 'sum_2019': rng.integers(0, 2, n),
+                             'is_gps': rng.integers(0, 2, n)},
+                            geometry=shapely.points(tree_x, tree_y), crs=CRS)
+
+
+def write_model(path, cont_names, vocab=('pine', 'spruce', 'birch', 'aspen', 'dead'), hidden=64, seed=0):
+    "Write a random two-layer MLP in the .npz format of src.inference"
+    rng = np.random.default_rng(seed)
+    n_in = len(cont_names)
+    np.savez(path, cont_names=np.array(cont_names, dtype=str), vocab=np.array(vocab, dtype=str),
+             ops=np.array(['affine', 'linear', 'relu', 'linear']),
+             **{'0_w': np.ones(n_in), '0_b': np.zeros(n_in),
+                '1_w': rng.normal(0, n_in**-0.5, (n_in, hidden)), '1_b': np.zeros(hidden),
+                '3_w': rng.normal(0, hidden**-0.5, (hidden, len(vocab))), '3_b': np.zeros(len(vocab))})
@@ -0,0 +1,24 @@
+from fastcore.script import *
+import os
+from pathlib import Path
+from src import catalog, geo_io
+
+@call_parse
+def build_catalog(tile_dir:Path, # Directory for the hyperspectral data
+                  out_dir:Path, # Where to save the catalog and the partitions
+                  tree_path:Path=None, # Optional file of trees with a tile_id column, e.g. matched_trees.parquet
+                  field_path:Path=None, # Optional file of field measurements with tree_X and tree_Y columns
+                  masks:bool=False): # Store run-length encoded crown masks with the partitioned trees
+    """
+    Build a tile catalog, and partition the trees by tile so that the
+    feature and cube scripts can take `out_dir` in place of the tree file
+    """
+    if not os.path.exists(out_dir): os.makedirs(out_dir, exist_ok=True)
+    trees = geo_io.read_frame(tree_path) if tree_path is not None else None
+    field = geo_io.read_frame(field_path) if field_path is not None else None
+    tiles = catalog.TileCatalog.build(tile_dir, trees, field)
+    tiles.save(out_dir)
+    print(f'Catalogued {len(tiles)} tiles')
+    if trees is not None:
+        counts = catalog.partition_trees(trees, out_dir/catalog.PARTITION_DIR, tile_dir if masks else None)
+        print(f'Partitioned {counts.sum()} trees into {len(counts)} tiles')
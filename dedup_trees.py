@@ -0,0 +1,100 @@
+from fastcore.script import *
+import os
+import multiprocessing
+from pathlib import Path
+import numpy as np
+from src import dedup, geo_io, instrument, manifest
+
+def hash_tile(path:Path, grid_size:float):
+    "The grid cell keys of the treetops of a tile and the areas of the crowns"
+    trees = geo_io.read_frame(path, columns=['ttop_x', 'ttop_y', 'CA_m2'])
+    instrument.count(crowns=len(trees))
+    with instrument.phase('hash'):
+        return dedup.cell_keys(trees.ttop_x.values, trees.ttop_y.values, grid_size), trees.CA_m2.values
+
+def _hash_tile(args):
+    path, grid_size = args
+    with instrument.task('dedup_hash', path.stem):
+        return hash_tile(path, grid_size)
+
+def pair_overlaps(path_a:Path, rows_a, path_b:Path, rows_b):
+    "The overlap of the crowns at rows_a of a tile with the crowns at rows_b of the same or another tile"
+    a = geo_io.read_frame(path_a, columns=['geometry']).geometry.values
+    b = a if path_b == path_a else geo_io.read_frame(path_b, columns=['geometry']).geometry.values
+    return dedup.crown_overlap(a[rows_a], b[rows_b])
+
+def _pair_overlaps(args):
+    path_a, rows_a, path_b, rows_b = args
+    tile_id = path_a.stem if path_a == path_b else f'{path_a.stem}+{path_b.stem}'
+    with instrument.task('dedup_overlap', tile_id, crowns=len(rows_a)):
+        return pair_overlaps(path_a, rows_a, path_b, rows_b)
+
+def drop_rows(path:Path, out_fn:Path, drop):
+    "Write the trees of a tile without the rows marked in `drop`"
+    trees = geo_io.read_frame(path)
+    instrument.count(crowns=len(trees))
+    geo_io.write_frame(trees[~drop], out_fn)
+
+def _dedup_tile(args):
+    run, tile_id, inputs, outputs, drop = args
+    with instrument.task('dedup', tile_id, duplicates=int(drop.sum())):
+        records = run.input_records(inputs)
+        drop_rows(inputs['trees'], outputs[0], drop)
+        run.record(tile_id, records, outputs)
+
+@call_parse
+def dedup_trees(tree_dir:Path, # Folder containing the merged crowns written by fix_crown_data.py
+                out_dir:Path, # Where to save the crowns without duplicates
+                fmt:str=geo_io.DEFAULT_FORMAT, # Output format, parquet or geojson
+                grid_size:float=dedup.GRID_SIZE, # Side of the grid cells the treetops are snapped to, in metres
+                radius:int=1, # Treetops up to this many cells apart are compared
+                min_overlap:float=dedup.MIN_OVERLAP, # Fraction of the smaller crown two duplicates must share
+                num_workers:int=10, # The number of worker processes
+                force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                profile_tile:str=None): # Run the tasks of this tile under cProfile
+    """
+    Remove the crowns delineated more than once, within a tile or by
+    neighbouring tiles, before the features are computed. The treetops of all
+    tiles go into a spatial hash, only the candidate pairs it finds are
+    compared by crown overlap, and each tile is then rewritten on its own.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    events = instrument.configure(out_dir, 'dedup', profile_tile)
+    tree_fns = geo_io.list_frames(tree_dir)
+    if not tree_fns: return
+    params = {'grid_size': grid_size, 'radius': radius, 'min_overlap': min_overlap}
+    run = manifest.Manifest(out_dir, 'dedup', params)
+    with multiprocessing.Pool(num_workers, maxtasksperchild=20) as pool:
+        hashed = pool.map(_hash_tile, [(f, grid_size) for f in tree_fns])
+        sizes = [len(keys) for keys, _ in hashed]
+        keys = np.concatenate([keys for keys, _ in hashed])
+        area = np.concatenate([area for _, area in hashed])
+        tile = np.repeat(np.arange(len(tree_fns)), sizes)
+        row = np.concatenate([np.arange(n) for n in sizes])
+
+        with instrument.task('dedup_resolve', 'candidates', crowns=len(keys)):
+            i, j = dedup.candidate_pairs(keys, radius)
+            # The tiles are concatenated in order, so tile[i] <= tile[j]
+            tile_pair = tile[i] * len(tree_fns) + tile[j]
+            order = np.argsort(tile_pair, kind='stable')
+            groups = np.split(order, np.flatnonzero(np.diff(tile_pair[order])) + 1) if len(order) else []
+            jobs = [(tree_fns[tile[i[g[0]]]], row[i[g]], tree_fns[tile[j[g[0]]]], row[j[g]]) for g in groups]
+        overlap = np.zeros(len(i))
+        for g, o in zip(groups, pool.imap(_pair_overlaps, jobs)): overlap[g] = o
+        with instrument.task('dedup_resolve', 'winners'):
+            drop, group = dedup.resolve(len(keys), i, j, overlap >= min_overlap, area, tile, row)
+            related = dedup.group_tiles(group, tile, len(tree_fns))
+        print(f'Dropping {drop.sum()} of {len(keys)} trees, {len(i)} candidate pairs in {len(groups)} pairs of tiles')
+
+        # A tile is redone when it or any tile it shares a group of duplicates
+        # with changes, or when that set of tiles changes. Crowns in unchanged
+        # tiles keep their candidate pairs and overlaps, so only a tile
+        # holding a crown of one of the groups can change the result.
+        starts = np.cumsum([0] + sizes)
+        tasks = []
+        for t, f in enumerate(tree_fns):
+            inputs = {'trees': f, **{f'neighbour_{tree_fns[n].stem}': tree_fns[n] for n in related[t]}}
+            tasks.append((f.stem, inputs, [out_dir/f'{f.stem}{geo_io.suffix(fmt)}'], drop[starts[t]:starts[t + 1]]))
+        inputs = [(run, *t) for t in run.pending(tasks, force)]
+        for _ in pool.imap_unordered(_dedup_tile, inputs): pass
+    instrument.summary(events)
@@ -0,0 +1,21 @@
+from fastcore.script import *
+from pathlib import Path
+from src import inference
+from segment_classification import predict_species, read_segments
+
+@call_parse
+def export_model(learner_path:Path, # Path to the exported fastai learner
+                 out_path:Path, # Where to save the .npz model
+                 check_data:Path=None): # Optional features file for comparing the predictions of both models
+    """
+    Export a fastai tabular learner into a NumPy model for segment_classification.py
+    """
+    learner = inference.load_model(learner_path)
+    inference.export_learner(learner, out_path)
+    print(f"Exported {learner_path} to {out_path}")
+
+    if check_data is not None:
+        _, features = read_segments(check_data)
+        model = inference.NumpyMLP.load(out_path)
+        same = predict_species(features, learner) == model.predict(features)
+        print(f"Same prediction for {same.sum()} / {len(same)} segments")
@@ -1,54 +1,82 @@
 from fastcore.script import *
 import os 
 import re 
-import geopandas as gpd
-from shapely.geometry import Polygon
+import shapely
+from src import geo_io, instrument, manifest
 import multiprocessing
 from pathlib import Path
 
-def merge_files(ttop_fname:Path, crown_fname:Path, outfile:Path):
-    "Read, merge and fix CRS"
+def merge_frames(ttops, crowns, tile_id):
+    """
+    Join the treetops to the crowns, fill the holes of the crowns and add the
+    bounding box shapes and the tile id
 
-    print(f'Processing files {ttop_fname} and {crown_fname}')
-    ttops = gpd.read_file(ttop_fname)
-    ttops.rename(columns={'geometry':'ttop', 'Z':'max_height'}, inplace=True)
+    Parameters
+    ----------
+    ttops : Treetops with treeID, Z and the point geometries
+    crowns : Crowns with the tree id in the value column
+    tile_id : The tile of the trees
+    """
+    ttops = ttops.rename(columns={'geometry':'ttop', 'Z':'max_height'})
     ttops.set_index('treeID', drop=True, inplace=True)
-    ttops['ttop_x'] = ttops.apply(lambda row: row.ttop.x, axis=1)
-    ttops['ttop_y'] = ttops.apply(lambda row: row.ttop.y, axis=1)
+    ttops['ttop_x'] = shapely.get_x(ttops.ttop.values)
+    ttops['ttop_y'] = shapely.get_y(ttops.ttop.values)
     ttops = ttops.drop(['ttop', 'max_height'], axis=1)
-    # Open crowns
-    crowns = gpd.read_file(crown_fname)
-    crowns.set_index('value', drop=True, inplace=True)
+    crowns = crowns.set_index('value', drop=True)
     crowns.sort_values(by='value', inplace=True)
     # Join dataframes
     crowns = crowns.join(ttops, how='outer')
     crowns = crowns.dropna()
     
     # Fill holes in polygons.
-    crowns['geometry'] = crowns.apply(lambda row: Polygon(row.geometry.exterior), axis=1)
+    crowns['geometry'] = shapely.polygons(shapely.get_exterior_ring(crowns.geometry.values))
     # Add treeID column back
     crowns.rename(columns={'value':'treeID'}, inplace=True)
     
     # Add information about bounding box shapes
-    crowns['bounds_x'] = crowns.apply(lambda row: row.geometry.bounds[2] - row.geometry.bounds[0], axis=1)
-    crowns['bounds_y'] = crowns.apply(lambda row: row.geometry.bounds[3] - row.geometry.bounds[1], axis=1)
+    bounds = shapely.bounds(crowns.geometry.values)
+    crowns['bounds_x'] = bounds[:,2] - bounds[:,0]
+    crowns['bounds_y'] = bounds[:,3] - bounds[:,1]
 
     crowns.set_crs('EPSG:32635', inplace=True, allow_override=True)
 
-    tile_id = outfile.stem
-
     crowns['tile_id'] = tile_id
-    crowns.to_file(filename=outfile, driver='GeoJSON')
+    return crowns
+
+def merge_files(ttop_fname:Path, crown_fname:Path, outfile:Path):
+    "Read, merge and fix CRS"
+    ttops = geo_io.read_frame(ttop_fname)
+    # Open crowns
+    crowns = geo_io.read_frame(crown_fname)
+    merged = merge_frames(ttops, crowns, outfile.stem)
+    instrument.count(crowns=len(merged))
+    geo_io.write_frame(merged, outfile)
     return 
 
+def _merge_tile(args):
+    run, tile_id, inputs, outputs = args
+    with instrument.task('merge', tile_id):
+        records = run.input_records(inputs)
+        merge_files(inputs['treetops'], inputs['crowns'], outputs[0])
+        run.record(tile_id, records, outputs)
 
 @call_parse
 def fix_crown_data(path_to_treetops:Path, # Folder containing the treetops
                    path_to_crowns:Path, # Folder containing the crowns
-                   outdir:Path): # Where to save the combined results
+                   outdir:Path, # Where to save the combined results
+                   fmt:str=geo_io.DEFAULT_FORMAT, # Output format, parquet or geojson
+                   force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                   profile_tile:str=None): # Run the task of this tile under cProfile
     "Fix CRS information and combine crowns and treetops to single files"
     if not os.path.exists(outdir): os.makedirs(outdir)
-    fnames = os.listdir(path_to_treetops)
-    inputs = [(path_to_treetops/f, path_to_crowns/f, outdir/f) for f in fnames]
-    with multiprocessing.Pool(10) as pool:
-        res = pool.starmap(merge_files, inputs)
+    events = instrument.configure(outdir, 'merge', profile_tile)
+    ttop_fns = geo_io.list_frames(path_to_treetops)
+    run = manifest.Manifest(outdir, 'merge')
+    inputs = [(run, f.stem, {'treetops': f, 'crowns': geo_io.find_frame(path_to_crowns, f.stem)},
+               [outdir/f'{f.stem}{geo_io.suffix(fmt)}']) for f in ttop_fns]
+    inputs = [(run, *t) for t in run.pending([t[1:] for t in inputs], force)]
+    # Tiles are handed out one at a time and workers are recycled, so the
+    # memory of a pool worker does not grow with the number of tiles it has seen
+    with multiprocessing.Pool(10, maxtasksperchild=20) as pool:
+        for _ in pool.imap_unordered(_merge_tile, inputs): pass
+    instrument.summary(events)
@@ -1,66 +1,89 @@
 from fastcore.script import *
 import os
-import rioxarray as rxr
 import numpy as np 
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from itertools import product
-import multiprocessing
 from pathlib import Path
-from scipy.stats import skew, kurtosis
+from src import catalog, feature_spec, feature_store, geo_io, instrument, normalization, rle, scheduler, stats, tiles
+from generate_features_treemap import feature_columns, reflectance_statistics
 
-def generate_reflectance_features(tile_fn, trees_in_tile):
-    tile = rxr.open_rasterio(tile_fn)
-    print(f'Processing tile {tile_fn}, {len(trees_in_tile)} trees to extract')
-    means = []
-    sds = []
-    mins = []
-    maxs = []
-    skews = []
-    kurts = []
-    for tree in trees_in_tile.itertuples():
-        xmin, ymin, xmax, ymax = tree.geometry.bounds
-        cropped = tile.sel(y=slice(ymax, ymin),
-                           x=slice(xmin, xmax)).copy()
-        for x,y in product(range(cropped.shape[2]), range(cropped.shape[1])):
-            if not Point(cropped[:,y,x].x.values, cropped[:,y,x].y.values).within(tree.geometry):
-                cropped[:,y,x] = np.nan
-        means.append(np.nanmean(cropped, axis=(1,2)))    
-        sds.append(np.nanstd(cropped, axis=(1,2)))
-        mins.append(np.nanmin(cropped, axis=(1,2)))
-        maxs.append(np.nanmax(cropped, axis=(1,2)))
-        skews.append(skew(cropped, axis=(1,2), nan_policy = "omit"))
-        kurts.append(kurtosis(cropped, axis=(1,2), nan_policy = "omit"))
-        
-    return means,sds,mins,maxs,skews,kurts
+def generate_reflectance_features(tile_fn, trees_in_tile, dtype=np.float64, max_bytes=tiles.DEFAULT_MAX_BYTES, spec=None,
+                                  norm=None):
+    return reflectance_statistics(tile_fn, trees_in_tile, dtype, max_bytes, spec, norm)
+
+def extract_batch(tile_fn, partition_dir, tile_id, batch, dtype=np.float64, max_bytes=tiles.DEFAULT_MAX_BYTES, spec=None,
+                  norm=None):
+    "Read a batch of trees from the partition of a tile and compute their features"
+    with instrument.task('features', tile_id):
+        trees = catalog.read_partition(partition_dir, tile_id).iloc[batch]
+        return rle.drop_masks(trees), generate_reflectance_features(tile_fn, trees, dtype, max_bytes, spec, norm)
+
+def tile_features(inputs, parts):
+    "The trees and features of a tile from the results of its batches, in the order of the trees in the tile"
+    order = np.argsort(np.concatenate([inputs[i][3] for i, _ in parts]))
+    trees = pd.concat([trees for _, (trees, _) in parts]).iloc[order]
+    return trees, np.concatenate([data for _, (_, data) in parts])[order]
 
 @call_parse
-def make_train_data(tree_path:Path, # Path to the file containing the matched trees
+def make_train_data(tree_path:Path, # Path to the file containing the matched trees, or a catalog directory
                     tile_dir:Path, # Directory for the hyperspectral data 
-                    save_dir:Path): # Where to save the resulting files
+                    save_dir:Path, # Where to save the resulting files
+                    float32:bool=False, # Accumulate the statistics in float32
+                    max_memory:int=512, # Memory ceiling in MB for the tile rows held by each worker
+                    store:bool=False, # Write a memory-mappable feature store instead of features.parquet
+                    store_dtype:str='float32', # Dtype of the stored features, float32 or float16
+                    feature_names:str=None, # A model, a file of feature names or comma separated names to compute, all features by default
+                    normalize:str=None, # Normalize the spectrum of each pixel before the statistics, snv or sum
+                    drop_bands:str=None, # Bands left out, e.g. interpolated or interpolated,1-5
+                    chm:str='keep', # keep the CHM band unnormalized, or exclude it
+                    num_workers:int=20, # The number of worker processes
+                    batch_size:int=scheduler.DEFAULT_BATCH_SIZE, # The maximum number of trees per task
+                    profile_tile:str=None): # Run the tasks of this tile under cProfile
     """
     Extract individual data cube files based on detected trees
     """
     # We have a preprocessed dataframe containing the trees
     if not os.path.exists(save_dir): os.makedirs(save_dir, exist_ok=True)
-    all_trees = gpd.read_file(tree_path)
-    inputs = [(f'{tile_dir}/{t}.tif', all_trees[all_trees.tile_id == t],) for t in all_trees.tile_id.unique()]
-    with multiprocessing.Pool(20) as pool:
-        features = pool.starmap(generate_reflectance_features, inputs)
-    collated = None
-    for fs, i in zip(features, inputs):
-        data = np.hstack([np.array(feature) for feature in fs])
-        prefixes = ['mean_', 'sd_', 'min_', 'max_', 'skew_', 'kurt_']
-        subs = [f'band_{b+1}' for b in range(461)]
-        colnames = np.hstack([[prefix + sub for sub in subs] for prefix in prefixes])
-        temp = pd.DataFrame(data=data, columns=colnames)
-        if collated is None:
-            collated = pd.concat([i[1], temp.set_index(i[1].index)], axis=1)
-        else:
-            temp = pd.concat([i[1], temp.set_index(i[1].index)], axis=1)
-            collated = pd.concat([collated, temp])
-    
-    print("Writing collated file")
-    collated.to_parquet(save_dir/'features.parquet')
-    #collated.to_file(save_dir/'features.geojson')
+    events = instrument.configure(save_dir, 'features', profile_tile)
+    dtype = np.float32 if float32 else np.float64
+    spec = feature_spec.load(feature_names)
+    norm = normalization.load(normalize, drop_bands, chm)
+
+    # Workers get a tile id and read the trees of the tile from its partition
+    partition_dir, counts = catalog.partitions(tree_path, save_dir/'.catalog')
+
+    # Split the tiles into batches of adjacent trees
+    inputs, groups, first_rows = [], [], []
+    for t in counts.index:
+        trees = catalog.read_partition(partition_dir, t, columns=['geometry'])
+        geometries = trees.geometry.values
+        first_rows.append(trees.index.min())
+        for batch in scheduler.tree_batches(geometries, batch_size):
+            inputs.append((f'{tile_dir}/{t}.tif', partition_dir, t, batch, dtype, max_memory*2**20, spec, norm))
+            groups.append(t)
+    results = scheduler.run(extract_batch, inputs, [len(i[3]) for i in inputs], num_workers)
+    columns = feature_columns(inputs[0][0], spec, norm) if inputs else None
+
+    if store:
+        fs = None
+        for tile_id, parts in scheduler.gather(results, groups):
+            trees, features = tile_features(inputs, parts)
+            if fs is None:
+                fs = feature_store.FeatureStore.create(save_dir, n_bands=features.shape[1] // len(stats.STATISTICS),
+                                                       dtype=store_dtype, columns=columns)
+            fs.write_tile(tile_id, trees, features)
+        instrument.summary(events)
+        return
+
+    # Write the tiles in the order they first appear in the trees, each as soon
+    # as it and the tiles before it are done, so the rows keep the input order
+    tile_order = list(counts.index[np.argsort(first_rows, kind='stable')])
+    done = {}
+    with geo_io.ParquetAppender(save_dir/'features.parquet') as out:
+        for tile_id, parts in scheduler.gather(results, groups):
+            done[tile_id] = tile_features(inputs, parts)
+            while tile_order and tile_order[0] in done:
+                trees, data = done.pop(tile_order.pop(0))
+                colnames = stats.feature_names(data.shape[1] // len(stats.STATISTICS)) if columns is None else columns
+                temp = pd.DataFrame(data=data.astype(np.float32, copy=False), columns=colnames)
+                out.write(pd.concat([trees, temp.set_index(trees.index)], axis=1))
+    instrument.summary(events)
@@ -1,96 +1,167 @@
 from fastcore.script import *
 import os
-import rioxarray as rxr
 import numpy as np 
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from itertools import product, repeat
-import multiprocessing
 from pathlib import Path
-from scipy.stats import skew, kurtosis
-
-def generate_reflectance_features(tile_fn, trees_in_tile):
-    tile = rxr.open_rasterio(tile_fn)
-
-    means = []
-    sds = []
-    mins = []
-    maxs = []
-    skews = []
-    kurts = []
-
-    for tree in trees_in_tile.itertuples():
-        xmin, ymin, xmax, ymax = tree.geometry.bounds
-
-        # Extract pixels from within the bounding box of the current tree
-        cropped = tile.sel(y=slice(ymax, ymin),
-                           x=slice(xmin, xmax)).copy()
-
-        # Set pixels outside the tree to nan
-        for x,y in product(range(cropped.shape[2]), range(cropped.shape[1])):
-            if not Point(cropped[:,y,x].x.values, cropped[:,y,x].y.values).within(tree.geometry):
-                cropped[:,y,x] = np.nan
-                
-        means.append(np.nanmean(cropped, axis=(1,2)))    
-        sds.append(np.nanstd(cropped, axis=(1,2)))
-        mins.append(np.nanmin(cropped, axis=(1,2)))
-        maxs.append(np.nanmax(cropped, axis=(1,2)))
-        skews.append(skew(cropped, axis=(1,2), nan_policy = "omit"))
-        kurts.append(kurtosis(cropped, axis=(1,2), nan_policy = "omit"))
-    
-    # Stack all trees and features into a single dataframe
-    prefixes = ['mean_', 'sd_', 'min_', 'max_', 'skew_', 'kurt_']
-    subs = [f'band_{b+1}' for b in range(461)]
-    colnames = np.hstack([[prefix + sub for sub in subs] for prefix in prefixes])
-    features = np.hstack([np.array(feature) for feature in (means, sds, mins, maxs, skews, kurts)])
+from src import feature_spec, feature_store, geo_io, instrument, manifest, normalization, rle, scheduler, sharding, stats, tiles
+
+def reflectance_statistics(tile_fn, trees_in_tile, dtype=np.float64, max_bytes=tiles.DEFAULT_MAX_BYTES, spec=None,
+                           norm=None):
+    # With a feature spec only its bands are read and only its statistics derived
+    statistics = stats.STATISTICS if spec is None else spec.statistics
+    bands = None if spec is None else spec.bands
+    # A normalization reads the bands it keeps, the spec bands are selected after normalizing
+    if norm is not None: bands = norm.read_bands(normalization.band_count(tile_fn), bands)
+    with tiles.TileReader(tile_fn, bands) as reader:
+        n_features = len(stats.STATISTICS)*reader.shape[0] if spec is None else len(spec)
+        features = np.empty((len(trees_in_tile), n_features), dtype=dtype)
+        selected = None if spec is None or reader.bands == spec.bands else [reader.bands.index(b) for b in spec.bands]
+
+        # Read the tile in block-aligned batches of trees and compute the
+        # statistics of each batch in a single pass over its pixels
+        for idx, values, labels in tiles.crown_pixel_batches(reader, trees_in_tile.geometry.values, max_bytes,
+                                                                  rle.stored_pixels(trees_in_tile)):
+            if norm is not None: values = norm.apply(values, reader.bands)
+            if selected is not None: values = values[:, selected]
+            moments = stats.grouped_moments(values, labels, len(idx), dtype=dtype, stats=statistics)
+            computed = stats.crown_features(moments, statistics)
+            features[idx] = computed if spec is None else spec.select(computed)
+    return features
+
+def to_feature_frame(features, columns=None):
+    """
+    Converts the statistics of all trees in a tile into a float32 dataframe
+    with NaNs replaced by the feature means of the tile. The columns are all
+    statistics of all bands unless given.
+    """
+    colnames = stats.feature_names(features.shape[1] // len(stats.STATISTICS)) if columns is None else columns
     features = pd.DataFrame(data=features, columns=colnames)
 
     # Replace NaNs with feature means
     features.fillna(features.mean(), inplace=True)
-    
-    return features
 
-def process_single_tile(tree_fn:Path, # Path to a file containing tree segments
-                        tile_fn:Path, # Path to a file containing a hyperspectral tile
-                        save_dir:Path): # The directory for storing the data
+    # The statistics are accumulated in float64, the feature tables stay float32
+    return features.astype(np.float32)
+
+def feature_columns(tile_fn, spec=None, norm=None):
+    "The names of the features computed from a tile, None for all statistics of all bands"
+    if spec is not None: return spec.columns
+    if norm is not None: return norm.columns(normalization.band_count(tile_fn))
+    return None
+
+def generate_reflectance_features(tile_fn, trees_in_tile, dtype=np.float64, max_bytes=tiles.DEFAULT_MAX_BYTES, spec=None,
+                                  norm=None):
+    features = reflectance_statistics(tile_fn, trees_in_tile, dtype, max_bytes, spec, norm)
+    return to_feature_frame(features, feature_columns(tile_fn, spec, norm))
+
+def process_batch(tree_fn:Path, # Path to a file containing tree segments
+                  tile_fn:Path, # Path to a file containing a hyperspectral tile
+                  batch:np.ndarray, # Positions of the trees of this batch in the file
+                  dtype=np.float64, # The accumulation dtype of the statistics
+                  max_bytes:int=tiles.DEFAULT_MAX_BYTES, # Memory ceiling for the tile rows held in memory
+                  run:manifest.Manifest=None, # If given, also return the input records of the tile for the manifest
+                  spec:feature_spec.FeatureSpec=None, # Only compute these features
+                  norm:normalization.Normalization=None): # Leave out bands and normalize the pixels first
     """ 
-    A helper function computing and storing features for a single tile.
+    A helper function computing the statistics for a batch of trees in a tile.
     """
-    print(f'Processing tile {tile_fn.stem}')
-    
-    # Read the tree segments
-    trees_in_tile = gpd.read_file(tree_fn)
-
-    # Compute the features
-    features = generate_reflectance_features(tile_fn, trees_in_tile)
-
-    # Merge the features with the tree segments
-    collated = pd.concat([trees_in_tile, features.set_index(trees_in_tile.index)], axis = 1)
-
-    collated.to_parquet(save_dir/f"{tree_fn.stem}.parquet")
-
-    print(f'Finished with tile {tile_fn.stem}')
+    with instrument.task('features', tree_fn.stem):
+        records = run.input_records({'trees': tree_fn, 'tile': tile_fn}) if run is not None else None
+        trees_in_tile = geo_io.read_frame(tree_fn, columns=['geometry'] + rle.stored_columns(tree_fn))
+        return reflectance_statistics(tile_fn, trees_in_tile.iloc[batch], dtype, max_bytes, spec, norm), records
+
+def write_tile(tree_fn:Path, # Path to a file containing tree segments
+               features:np.ndarray, # The statistics of all trees in the tile
+               save_dir:Path, # The directory for storing the data
+               store:bool=False, # Write to the feature store in save_dir instead of a parquet file
+               columns:list=None): # The feature names, all statistics of all bands by default
+    """ 
+    A helper function storing the features of a single tile. Returns the paths
+    of the written files.
+    """
+    trees_in_tile = rle.drop_masks(geo_io.read_frame(tree_fn))
+    features = to_feature_frame(features, columns)
+
+    if store:
+        # Keep the segments and the features apart in the feature store
+        fs = feature_store.FeatureStore(save_dir)
+        fs.write_tile(tree_fn.stem, trees_in_tile, features)
+        outputs = [fs.meta_path(tree_fn.stem), fs.feature_path(tree_fn.stem)]
+    else:
+        # Merge the features with the tree segments
+        collated = pd.concat([trees_in_tile, features.set_index(trees_in_tile.index)], axis = 1)
+
+        outputs = [save_dir/f"{tree_fn.stem}.parquet"]
+        with instrument.phase('write'), manifest.atomic_path(outputs[0]) as tmp:
+            collated.to_parquet(tmp)
+    return outputs
 
 @call_parse
 def make_train_data(tree_dir:Path, # Directory containing the tree segments
                     tile_dir:Path, # Directory for the hyperspectral data 
-                    save_dir:Path): # Where to save the resulting files
+                    save_dir:Path, # Where to save the resulting files
+                    float32:bool=False, # Accumulate the statistics in float32
+                    max_memory:int=512, # Memory ceiling in MB for the tile rows held by each worker
+                    store:bool=False, # Write a memory-mappable feature store instead of parquet files
+                    store_dtype:str='float32', # Dtype of the stored features, float32 or float16
+                    feature_names:str=None, # A model, a file of feature names or comma separated names to compute, all features by default
+                    normalize:str=None, # Normalize the spectrum of each pixel before the statistics, snv or sum
+                    drop_bands:str=None, # Bands left out, e.g. interpolated or interpolated,1-5
+                    chm:str='keep', # keep the CHM band unnormalized, or exclude it
+                    num_workers:int=30, # The number of worker processes
+                    batch_size:int=scheduler.DEFAULT_BATCH_SIZE, # The maximum number of trees per task
+                    force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                    profile_tile:str=None, # Run the tasks of this tile under cProfile
+                    shard:int=None, # Only process the tiles of this shard, SLURM_ARRAY_TASK_ID by default
+                    n_shards:int=None): # The number of shards, SLURM_ARRAY_TASK_COUNT by default
     """
     Extract individual data cube files based on detected trees
     """
     
     # Create the output directory if it does not exist
     if not os.path.exists(save_dir): os.makedirs(save_dir, exist_ok=True)
-
-    tree_fns = [tree_dir/f for f in os.listdir(tree_dir)]
-    tile_fns = [tile_dir/f"{Path(f).stem}.tif" for f in os.listdir(tree_dir)]
-    save_dirs = [save_dir] * len(tile_fns)
-
-    # Go through each tile and compute the features for each tree in the tile
-    inputs = zip(tree_fns,tile_fns,repeat(save_dir))
-    with multiprocessing.Pool(30) as pool:
-        pool.starmap(process_single_tile, inputs)
-
- 
-
+    events = instrument.configure(save_dir, 'features', profile_tile)
+
+    # Keep the tiles of this shard, balanced by the number of trees
+    tree_fns = geo_io.list_frames(tree_dir)
+    tree_fns, _ = sharding.select(tree_fns, [sharding.count_rows(f) for f in tree_fns], shard, n_shards)
+    if not tree_fns: return
+    tile_fns = [tile_dir/f"{f.stem}.tif" for f in tree_fns]
+    spec = feature_spec.load(feature_names)
+    norm = normalization.load(normalize, drop_bands, chm)
+    columns = feature_columns(tile_fns[0], spec, norm)
+
+    if store:
+        with tiles.TileReader(tile_fns[0]) as reader:
+            fs = feature_store.FeatureStore.create(save_dir, n_bands=reader.shape[0], dtype=store_dtype, columns=columns)
+        outputs = [[fs.meta_path(f.stem), fs.feature_path(f.stem)] for f in tree_fns]
+    else:
+        outputs = [[save_dir/f"{f.stem}.parquet"] for f in tree_fns]
+
+    # Skip the tiles that are up to date
+    params = {'statistics': stats.STATISTICS, 'float32': float32, 'store': store, 'store_dtype': store_dtype}
+    if spec is not None: params['features'] = columns
+    if norm is not None: params['normalization'] = norm.params
+    run = manifest.Manifest(save_dir, 'features', params)
+    todo = run.pending([(f.stem, {'trees': f, 'tile': t}, o) for f, t, o in zip(tree_fns, tile_fns, outputs)], force)
+
+    # Split each tile into batches of adjacent trees
+    dtype = np.float32 if float32 else np.float64
+    inputs, groups = [], []
+    for i, (tile_id, files, _) in enumerate(todo):
+        geometries = geo_io.read_frame(files['trees'], columns=['geometry']).geometry.values
+        for b, batch in enumerate(scheduler.tree_batches(geometries, batch_size)):
+            inputs.append((files['trees'], files['tile'], batch, dtype, max_memory*2**20, run if b == 0 else None, spec, norm))
+            groups.append(i)
+
+    # Compute the batches largest first and write each tile once all of its batches are done
+    results = scheduler.run(process_batch, inputs, [len(i[2]) for i in inputs], num_workers)
+    for i, parts in scheduler.gather(results, groups):
+        order = np.argsort(np.concatenate([inputs[j][2] for j, _ in parts]))
+        features = np.concatenate([data for _, (data, _) in parts])[order]
+        records = parts[0][1][1]
+        tile_id, files, _ = todo[i]
+        with instrument.task('features_write', tile_id, crowns=len(features)):
+            outputs = write_tile(files['trees'], features, save_dir, store, columns)
+        run.record(tile_id, records, outputs)
+    instrument.summary(events)
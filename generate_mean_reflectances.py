@@ -1,53 +1,58 @@
 from fastcore.script import *
 import os
-import rioxarray as rxr
 import numpy as np 
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from itertools import product
 import multiprocessing
 from pathlib import Path
+from src import catalog, instrument, rle, stats, tiles
 
-def generate_mean_reflectances(tile_fn, trees_in_tile):
-    tile = rxr.open_rasterio(tile_fn)
-    print(f'Processing tile {tile_fn}, {len(trees_in_tile)} trees to extract')
-    means = []
-    for tree in trees_in_tile.itertuples():
-        xmin, ymin, xmax, ymax = tree.geometry.bounds
-        cropped = tile.sel(y=slice(ymax, ymin),
-                           x=slice(xmin, xmax)).copy()[:-1]
-        for x,y in product(range(cropped.shape[2]), range(cropped.shape[1])):
-            if not Point(cropped[:,y,x].x.values, cropped[:,y,x].y.values).within(tree.geometry):
-                cropped[:,y,x] = np.nan
-        means.append(np.nanmean(cropped, axis=(1,2)))    
+def generate_mean_reflectances(tile_fn, trees_in_tile, max_bytes=tiles.DEFAULT_MAX_BYTES):
+    with tiles.TileReader(tile_fn) as reader:
+        # Skip the CHM band
+        reader.bands = reader.bands[:-1]
+        means = np.empty((len(trees_in_tile), len(reader.bands)))
+        for idx, values, labels in tiles.crown_pixel_batches(reader, trees_in_tile.geometry.values, max_bytes,
+                                                                  rle.stored_pixels(trees_in_tile)):
+            moments = stats.grouped_moments(values, labels, len(idx), stats=('mean',))
+            means[idx] = stats.crown_features(moments, stats=('mean',))
     return means
 
+def tile_means(tile_fn, partition_dir, tile_id, max_bytes=tiles.DEFAULT_MAX_BYTES):
+    "Read the trees of a tile from its partition and compute their mean reflectances"
+    with instrument.task('means', tile_id):
+        trees_in_tile = catalog.read_partition(partition_dir, tile_id)
+        return rle.drop_masks(trees_in_tile), generate_mean_reflectances(tile_fn, trees_in_tile, max_bytes)
+
 @call_parse
-def make_train_data(tree_path:Path, # Path to the file containing the matched trees
+def make_train_data(tree_path:Path, # Path to the file containing the matched trees, or a catalog directory
                     tile_dir:Path, # Directory for the hyperspectral data 
-                    save_dir:Path): # Where to save the resulting files
+                    save_dir:Path, # Where to save the resulting files
+                    max_memory:int=512, # Memory ceiling in MB for the tile rows held by each worker
+                    profile_tile:str=None): # Run the task of this tile under cProfile
     """
     Extract individual data cube files based on detected trees
     """
     # We have a preprocessed dataframe containing the trees
     if not os.path.exists(save_dir): os.makedirs(save_dir, exist_ok=True)
-    all_trees = gpd.read_file(tree_path)
-    inputs = [(f'{tile_dir}/{t}.tif', all_trees[all_trees.tile_id == t],) for t in all_trees.tile_id.unique()]
+    events = instrument.configure(save_dir, 'means', profile_tile)
+    # Workers get a tile id and read the trees of the tile from its partition
+    partition_dir, counts = catalog.partitions(tree_path, save_dir/'.catalog')
+    inputs = [(f'{tile_dir}/{t}.tif', partition_dir, t, max_memory*2**20) for t in counts.index]
     with multiprocessing.Pool(10) as pool:
-        means = pool.starmap(generate_mean_reflectances, inputs)
+        means = pool.starmap(tile_means, inputs)
     collated = None
-    for m, i in zip(means, inputs):
-        temp = pd.DataFrame(data=np.array(m), columns=[f'band_{b+1}' for b in range(460)])
+    for trees, m in means:
+        temp = pd.DataFrame(data=np.array(m), columns=[f'band_{b+1}' for b in range(m.shape[1])])
         if collated is None:
-            collated = pd.concat([i[1], temp], axis=1)
+            collated = pd.concat([trees, temp.set_index(trees.index)], axis=1)
         else:
-            temp = pd.concat([i[1], temp], axis=1)
+            temp = pd.concat([trees, temp.set_index(trees.index)], axis=1)
             collated = pd.concat([collated, temp])
 
     collated.to_file(save_dir/'means.geojson')
+    instrument.summary(events)
 
 
 if __name__ == "__main__":
 
-    make_train_data("./data/matched/matched_trees.geojson", "./data/tiles", "./data/matched_w_features")
\ No newline at end of file
+    make_train_data("./data/matched/matched_trees.parquet", "./data/tiles", "./data/matched_w_features")
\ No newline at end of file
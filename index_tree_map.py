@@ -0,0 +1,15 @@
+from fastcore.script import *
+from pathlib import Path
+from src import geo_io, tree_index
+
+@call_parse
+def index_tree_map(tree_map:Path, # The tree map, a directory of per-tile outputs of map_species.py or a merged file
+                   out_dir:Path, # Where to write the index
+                   cell_size:float=tree_index.CELL_SIZE): # Side of the grid cells of the index in metres
+    """
+    Build the index over the classified trees that serve_tree_map.py queries,
+    reading one tile (or one row group of a merged GeoParquet file) at a time
+    """
+    paths = geo_io.list_frames(tree_map) if tree_map.is_dir() else [tree_map]
+    n = tree_index.build(paths, out_dir, cell_size)
+    print(f'Indexed {n} trees from {len(paths)} files into {out_dir}')
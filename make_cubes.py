@@ -1,43 +1,167 @@
 from fastcore.script import *
 import os
-import rioxarray as rxr
 import numpy as np 
-import geopandas as gpd
-from shapely.geometry import Point
-from itertools import product
-import multiprocessing
+import pandas as pd
 from pathlib import Path
+from src import catalog, cube_store, instrument, manifest, masking, normalization, rle, scheduler, tiles
 
-def generate_cubes_from_tile(tile_fn, trees_in_tile, save_dir, ws, delineate=False, normalize=False):
-    tile = rxr.open_rasterio(tile_fn)
-    print(f'Processing tile {tile_fn}, {len(trees_in_tile)} trees to extract')
-    for tree in trees_in_tile.itertuples():
-        cropped = tile.sel(y=slice(tree.ttop_y + ws, tree.ttop_y - ws ),
-                           x=slice(tree.ttop_x - ws,  tree.ttop_x + ws)).copy()
-        if cropped.shape[1] != ws*4 + 1: continue
-
-        if cropped.shape[2] != ws*4 + 1: continue
-        if delineate:
-            for x,y in product(range(cropped.shape[2]), range(cropped.shape[1])):
-                if not Point(cropped[:,y,x].x.values, cropped[:,y,x].y.values).within(tree.geometry):
-                    cropped[:,y,x] = np.nan
-        np.save(f'{save_dir}/{tree.filename}', cropped.values)
-    return
+def cube_windows(trees_in_tile, xs, ys, ws):
+    "Pixel windows of the cubes around the treetops, and which of them are full-sized"
+    bounds = np.stack([trees_in_tile.ttop_x - ws, trees_in_tile.ttop_y - ws,
+                       trees_in_tile.ttop_x + ws, trees_in_tile.ttop_y + ws], axis=1)
+    windows = masking.bbox_windows(bounds, xs, ys)
+    full = (windows[:,1] - windows[:,0] == ws*4 + 1) & (windows[:,3] - windows[:,2] == ws*4 + 1)
+    return windows, full
+
+def tile_cubes(reader, trees_in_tile, windows, ws, masks=False, max_bytes=tiles.DEFAULT_MAX_BYTES, norm=None):
+    """
+    Cut the full-sized cubes of a tile in batches of block rows, normalized
+    by `norm` if given.
+
+    Yields
+    ------
+    idx : Positions of the trees in this batch
+    cubes : An array of shape (len(idx), bands, 4*ws+1, 4*ws+1)
+    crown_masks : Boolean crown masks of shape (len(idx), 4*ws+1, 4*ws+1), or None
+    """
+    for idx, block, row_off in reader.batches(windows, max_bytes):
+        cubes = cube_store.cut_windows(block, windows[idx,0] - row_off, windows[idx,2], ws*4 + 1)
+        if norm is not None: cubes = norm.apply(cubes, reader.bands, axis=1)
+        crown_masks = None
+        if masks:
+            crowns = trees_in_tile.iloc[idx]
+            crown_masks = masking.window_masks(crowns.geometry.values, windows[idx], reader.xs, reader.ys,
+                                               rle.stored_pixels(crowns))
+        instrument.count(crowns=len(idx), pixels=len(idx) * (ws*4 + 1)**2)
+        yield idx, cubes, crown_masks
+
+def read_bands(tile_fn, norm=None):
+    "The bands of the cubes, all bands of the tile unless the normalization leaves some out"
+    return None if norm is None else norm.bands(normalization.band_count(tile_fn))
+
+def generate_cubes_from_tile(tile_fn, trees_in_tile, save_dir, ws, delineate=False, norm=None,
+                             max_bytes=tiles.DEFAULT_MAX_BYTES):
+    written = []
+    with tiles.TileReader(tile_fn, read_bands(tile_fn, norm)) as reader:
+        windows, full = cube_windows(trees_in_tile, reader.xs, reader.ys, ws)
+        # Only full-sized cubes are extracted
+        trees_in_tile, windows = trees_in_tile[full], windows[full]
+        for idx, cubes, crown_masks in tile_cubes(reader, trees_in_tile, windows, ws, delineate, max_bytes, norm):
+            for j, i in enumerate(idx):
+                cropped = cubes[j]
+                if delineate: cropped = masking.mask_outside(cropped, crown_masks[j])
+                # np.save adds the suffix if it is missing
+                out_fn = Path(save_dir)/trees_in_tile.filename.iloc[i]
+                if out_fn.suffix != '.npy': out_fn = out_fn.with_name(f'{out_fn.name}.npy')
+                with instrument.phase('write'), manifest.atomic_path(out_fn) as tmp:
+                    np.save(tmp, cropped)
+                written.append(out_fn)
+    return written
+
+def store_cubes_from_tile(tile_fn, trees_in_tile, positions, store_dir, ws, masks=False,
+                          max_bytes=tiles.DEFAULT_MAX_BYTES, norm=None):
+    "Write the cubes of full-sized windows into the store at `positions`"
+    store = cube_store.CubeStore(store_dir, 'r+')
+    with tiles.TileReader(tile_fn, read_bands(tile_fn, norm)) as reader:
+        windows, full = cube_windows(trees_in_tile, reader.xs, reader.ys, ws)
+        windows = windows[full]
+        for idx, cubes, crown_masks in tile_cubes(reader, trees_in_tile[full], windows, ws, masks, max_bytes, norm):
+            store.write(positions[idx], cubes, crown_masks)
+    store.flush()
+    return len(windows)
+
+def _cube_batch(run, inputs, partition_dir, tile_id, batch, *args):
+    "Extract a batch of cubes, and for the first batch of a tile also hash the inputs for the manifest"
+    with instrument.task('cubes', tile_id):
+        records = run.input_records(inputs) if run is not None else None
+        trees_in_tile = catalog.read_partition(partition_dir, tile_id).iloc[batch]
+        return generate_cubes_from_tile(inputs['tile'], trees_in_tile, *args), records
+
+def _store_batch(partition_dir, tile_id, batch, tile_fn, positions, *args):
+    with instrument.task('cubes', tile_id):
+        trees_in_tile = catalog.read_partition(partition_dir, tile_id).iloc[batch]
+        return store_cubes_from_tile(tile_fn, trees_in_tile, positions, *args)
+
+def make_store(partition_dir, counts, tile_dir, save_dir, window_size, masks, max_bytes, num_workers, batch_size,
+               norm=None):
+    """
+    Write the cubes of all tiles into a single cube store in `save_dir`. The
+    cubes of a tile are contiguous in the store, in partition order.
+    """
+    index, inputs = [], []
+    n_bands = dtype = None
+    for t in counts.index:
+        tile_fn = Path(f'{tile_dir}/{t}.tif')
+        trees_in_tile = catalog.read_partition(partition_dir, t)
+        with tiles.TileReader(tile_fn) as reader:
+            _, full = cube_windows(trees_in_tile, reader.xs, reader.ys, window_size)
+            n_bands, dtype = n_bands or reader.dataset.count, dtype or reader.dataset.dtypes[0]
+            # Normalized cubes are float32 and hold the kept bands only
+            if norm is not None:
+                n_bands = len(norm.bands(reader.dataset.count))
+                if norm.method is not None: dtype = 'float32'
+        rows = np.flatnonzero(full)
+        start = sum(len(i) for i in index)
+        index.append(rle.drop_masks(trees_in_tile).iloc[rows].rename_axis(catalog.ROW_COLUMN).reset_index())
+        for batch in scheduler.tree_batches(trees_in_tile.geometry.values[rows], batch_size):
+            inputs.append((partition_dir, t, rows[batch], tile_fn, start + batch,
+                           save_dir, window_size, masks, max_bytes, norm))
+    index = pd.concat(index, ignore_index=True)
+    cube_store.CubeStore.create(save_dir, index, n_bands, window_size, dtype, masks,
+                                None if norm is None else norm.params)
+    for _ in scheduler.run(_store_batch, inputs, [len(i[2]) for i in inputs], num_workers): pass
+    print(f'Wrote {len(index)} cubes into {save_dir}')
 
 @call_parse
-def make_train_data(tree_path:Path, # Path to the file containing the matched trees
+def make_train_data(tree_path:Path, # Path to the file containing the matched trees, or a catalog directory
                     tile_dir:Path, # Directory for the hyperspectral data 
                     save_dir:Path, # Where to save the resulting files
                     delineate:bool, # Whether to mask all data outside the crown. 
-                    window_size:int=4): # Radius of the squares extracted around treetops
+                    window_size:int=4, # Radius of the squares extracted around treetops
+                    max_memory:int=512, # Memory ceiling in MB for the tile rows held by each worker
+                    num_workers:int=10, # The number of worker processes
+                    batch_size:int=scheduler.DEFAULT_BATCH_SIZE, # The maximum number of trees per task
+                    force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                    store:bool=False, # Write all cubes into a single cube store instead of one file per tree
+                    normalize:str=None, # Normalize the spectrum of each pixel, snv or sum
+                    drop_bands:str=None, # Bands left out, e.g. interpolated or interpolated,1-5
+                    chm:str='keep', # keep the CHM band unnormalized, or exclude it
+                    profile_tile:str=None): # Run the tasks of this tile under cProfile
     """
     Extract individual data cube files based on detected trees
     """
     # We have a preprocessed dataframe containing the trees
     if not os.path.exists(save_dir): os.makedirs(save_dir, exist_ok=True)
-    all_trees = gpd.read_file(tree_path)
-    inputs = [(f'{tile_dir}/{t}.tif', all_trees[all_trees.tile_id == t], 
-              save_dir, window_size, delineate) for t in all_trees.tile_id.unique()]
-    with multiprocessing.Pool(10) as pool:
-        pool.starmap(generate_cubes_from_tile, inputs)
-    return
+    events = instrument.configure(save_dir, 'cubes', profile_tile)
+
+    # Workers get a tile id and read the trees of the tile from its partition
+    partition_dir, counts = catalog.partitions(tree_path, save_dir/'.catalog')
+    norm = normalization.load(normalize, drop_bands, chm)
+
+    if store:
+        # The crown masks are stored next to the cubes instead of being applied
+        make_store(partition_dir, counts, tile_dir, save_dir, window_size, delineate,
+                   max_memory*2**20, num_workers, batch_size, norm)
+        instrument.summary(events)
+        return
+
+    # Skip the tiles that are up to date
+    params = {'window_size': window_size, 'delineate': delineate}
+    if norm is not None: params['normalization'] = norm.params
+    run = manifest.Manifest(save_dir, 'cubes', params)
+    todo = run.pending([(t, {'trees': catalog.partition_path(partition_dir, t), 'tile': Path(f'{tile_dir}/{t}.tif')}, None)
+                        for t in counts.index], force)
+
+    inputs, groups = [], []
+    for i, (t, files, _) in enumerate(todo):
+        geometries = catalog.read_partition(partition_dir, t, columns=['geometry']).geometry.values
+        # Each task extracts the cubes of a batch of adjacent trees
+        for b, batch in enumerate(scheduler.tree_batches(geometries, batch_size)):
+            inputs.append((run if b == 0 else None, files, partition_dir, t, batch,
+                           save_dir, window_size, delineate, norm, max_memory*2**20))
+            groups.append(i)
+    results = scheduler.run(_cube_batch, inputs, [len(i[4]) for i in inputs], num_workers)
+    for i, parts in scheduler.gather(results, groups):
+        t, files, _ = todo[i]
+        run.record(t, parts[0][1][1], [f for _, (written, _) in parts for f in written])
+    instrument.summary(events)
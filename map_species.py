@@ -0,0 +1,106 @@
+from fastcore.script import *
+import os
+import numpy as np
+from pathlib import Path
+from src import feature_spec, feature_store, geo_io, inference, instrument, manifest, normalization, rle, scheduler, sharding, stats, tiles
+from generate_features_treemap import feature_columns, generate_reflectance_features
+from segment_classification import predict_species
+
+def classify_tile(tree_fn:Path, # Path to a file containing tree segments
+                  tile_fn:Path, # Path to a file containing a hyperspectral tile
+                  out_dir:Path, # The directory for the species-labelled segments
+                  fmt:str="geojson", # The output format, geojson or parquet
+                  dtype=np.float64, # The accumulation dtype of the statistics
+                  max_bytes:int=tiles.DEFAULT_MAX_BYTES, # Memory ceiling for the tile rows held in memory
+                  feature_dir:Path=None, # Optional feature store for keeping the features
+                  spec:feature_spec.FeatureSpec=None, # Only compute the features the model uses
+                  norm:normalization.Normalization=None): # Leave out bands and normalize the pixels first
+    """
+    Computes the features of the segments of a single tile and predicts their
+    species with the model loaded by inference.init_worker. Only the segments
+    and the species are written, the features are kept in memory.
+    """
+    # Read the tree segments
+    trees_in_tile = geo_io.read_frame(tree_fn)
+
+    if len(trees_in_tile):
+        # Compute the features and predict the species of each segment
+        features = generate_reflectance_features(tile_fn, trees_in_tile, dtype, max_bytes, spec, norm)
+        trees_in_tile = rle.drop_masks(trees_in_tile)
+        if feature_dir is not None:
+            feature_store.FeatureStore(feature_dir).write_tile(tree_fn.stem, trees_in_tile, features)
+        trees_in_tile["species"] = predict_species(features, inference.worker_model())
+    else:
+        trees_in_tile["species"] = []
+
+    geo_io.write_frame(trees_in_tile, out_dir/f"{tree_fn.stem}{geo_io.suffix(fmt)}")
+
+def classify_tile_in_worker(tile_id:str, inputs:dict, outputs:list, run:manifest.Manifest, *args):
+    """
+    Runs classify_tile and records the finished tile in the run manifest.
+    """
+    with instrument.task('map_species', tile_id):
+        records = run.input_records(inputs)
+        classify_tile(inputs['trees'], inputs['tile'], outputs[0].parent, *args)
+        run.record(tile_id, records, outputs)
+
+@call_parse
+def map_species(tree_dir:Path, # Directory containing the tree segments
+                tile_dir:Path, # Directory for the hyperspectral data
+                learner_path:Path, # The learner used for prediction, a fastai learner or an exported .npz model
+                out_dir:Path, # Where to save the species-labelled segments
+                num_workers:int=30, # The number of worker processes
+                fmt:str="geojson", # The output format, geojson or parquet
+                float32:bool=False, # Accumulate the statistics in float32
+                max_memory:int=512, # Memory ceiling in MB for the tile rows held by each worker
+                feature_dir:Path=None, # Also write the features to a feature store in this directory
+                store_dtype:str='float32', # Dtype of the stored features, float32 or float16
+                normalize:str=None, # Normalize the spectrum of each pixel as the model was trained, snv or sum
+                drop_bands:str=None, # Bands left out when the model was trained, e.g. interpolated
+                chm:str='keep', # keep the CHM band unnormalized, or exclude it
+                all_features:bool=False, # Compute all features instead of only the inputs of the model, implied by feature_dir
+                force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                profile_tile:str=None, # Run the task of this tile under cProfile
+                shard:int=None, # Only process the tiles of this shard, SLURM_ARRAY_TASK_ID by default
+                n_shards:int=None): # The number of shards, SLURM_ARRAY_TASK_COUNT by default
+    """
+    Create the tree map in a single pass: compute the features of each tree
+    segment and predict its species without writing the features to disk.
+    """
+
+    # Create the output directory if it does not exist
+    if not os.path.exists(out_dir): os.makedirs(out_dir, exist_ok=True)
+    events = instrument.configure(out_dir, 'map_species', profile_tile)
+
+    # Keep the tiles of this shard, balanced by the number of trees
+    tree_fns = geo_io.list_frames(tree_dir)
+    tree_fns, _ = sharding.select(tree_fns, [sharding.count_rows(f) for f in tree_fns], shard, n_shards)
+    if not tree_fns: return
+    tile_fns = [tile_dir/f"{f.stem}.tif" for f in tree_fns]
+
+    norm = normalization.load(normalize, drop_bands, chm)
+    outputs = [[out_dir/f"{f.stem}{geo_io.suffix(fmt)}"] for f in tree_fns]
+    if feature_dir is not None:
+        with tiles.TileReader(tile_fns[0]) as reader:
+            fs = feature_store.FeatureStore.create(feature_dir, n_bands=reader.shape[0], dtype=store_dtype,
+                                                   columns=feature_columns(tile_fns[0], norm=norm))
+        for f, o in zip(tree_fns, outputs): o += [fs.meta_path(f.stem), fs.feature_path(f.stem)]
+
+    # Read only the bands and derive only the statistics the model uses
+    spec = None if all_features or feature_dir is not None else feature_spec.load(learner_path)
+
+    # Skip the tiles that are up to date
+    dtype = np.float32 if float32 else np.float64
+    params = {'statistics': stats.STATISTICS, 'float32': float32, 'feature_dir': feature_dir, 'store_dtype': store_dtype}
+    if spec is not None: params['features'] = spec.columns
+    if norm is not None: params['normalization'] = norm.params
+    run = manifest.Manifest(out_dir, 'map_species', params)
+    tasks = [(f.stem, {'trees': f, 'tile': t, 'model': learner_path}, o, run, fmt, dtype, max_memory*2**20, feature_dir, spec,
+              norm)
+             for f, t, o in zip(tree_fns, tile_fns, outputs)]
+    tasks = run.pending(tasks, force)
+
+    # Each worker loads the model once and processes whole tiles, largest first
+    costs = [sharding.count_rows(t[1]['trees']) for t in tasks]
+    for _ in scheduler.run(classify_tile_in_worker, tasks, costs, num_workers, inference.init_worker, (learner_path,)): pass
+    instrument.summary(events)
@@ -1,8 +1,7 @@
 import sys
 import os
 import pandas as pd
-import geopandas as gpd
-from src import utils
+from src import geo_io, instrument, matching, sharding
 from pathlib import Path
 
 from fastcore.script import *
@@ -10,14 +9,18 @@ from fastcore.script import *
 @call_parse
 def generate_data_contour(field_measurements:Path, # Path to the file containing field measurements
                           tree_crown_dir:Path, # Path to the directory containing the segmented crowns  
-                          output_directory:Path): # Where to save the results.
+                          output_directory:Path, # Where to save the results.
+                          fmt:str=geo_io.DEFAULT_FORMAT, # Output format, parquet or geojson
+                          profile_tile:str=None, # Run the matching of this tile under cProfile
+                          shard:int=None, # Only match the tiles of this shard, SLURM_ARRAY_TASK_ID by default
+                          n_shards:int=None): # The number of shards, SLURM_ARRAY_TASK_COUNT by default
     """
     Main function for training data generation
     """
     
     # Read shapefile containing field measurements
-    if os.path.splitext(field_measurements)[1] in ['.shp', '.geojson']:
-        trees_shp = gpd.read_file(field_measurements)
+    if os.path.splitext(field_measurements)[1] in ['.shp', '.geojson', '.parquet']:
+        trees_shp = geo_io.read_frame(field_measurements)
     elif os.path.splitext(field_measurements)[1] == '.csv':
         trees_shp = pd.read_csv(field_measurements)
     else:
@@ -25,47 +28,58 @@ def generate_data_contour(field_measurements:Path, # Path to the file containing
         sys.exit(1)
     trees_shp = trees_shp[['species', 'tree_X', 'tree_Y', 'DBH', 'nov_2019', 'sum_2019', 'is_gps']]
     trees_shp.drop_duplicates(['tree_X', 'tree_Y'], inplace=True)
-    tiles = [tree_crown_dir/f for f in os.listdir(tree_crown_dir) if f.endswith('.geojson')]
-    tree_shapes = None
+    # Keep the tiles of this shard, balanced by the number of crowns
+    shard, n_shards = sharding.shard_args(shard, n_shards)
+    tiles = geo_io.list_frames(tree_crown_dir)
+    tiles, _ = sharding.select(tiles, [sharding.count_rows(t) for t in tiles], shard, n_shards)
+    tree_shapes = []
+
+    # Index the field trees once for the bounding box lookups of each tile
+    index = matching.field_index(trees_shp)
 
     # Create outdir if it doesn't exist
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
+    events = instrument.configure(output_directory, 'match', profile_tile)
 
     for t in tiles:
         # Extract tile_id
         tile_id = t.stem
-        print(f'Processing tile {tile_id}')
-
-        # Read delineated crowns from shp
-        tile_lidar_detected = gpd.read_file(f'{tree_crown_dir}/{tile_id}.geojson')
-        xdims = tile_lidar_detected.ttop_x.min(), tile_lidar_detected.ttop_x.max()
-        ydims = tile_lidar_detected.ttop_y.min(), tile_lidar_detected.ttop_y.max()
-        # Filter treetops
-        tile_field_plot = trees_shp[trees_shp['tree_Y'].between(ydims[0], ydims[1]) & 
-                                    trees_shp['tree_X'].between(xdims[0], xdims[1])].copy()
-        if len(tile_field_plot) == 0:
-            print(f'No measured trees in tile {tile_id}')
-            continue
+        with instrument.task('match', tile_id):
+            # Read delineated crowns from shp
+            tile_lidar_detected = geo_io.read_frame(t)
+            xdims = tile_lidar_detected.ttop_x.min(), tile_lidar_detected.ttop_x.max()
+            ydims = tile_lidar_detected.ttop_y.min(), tile_lidar_detected.ttop_y.max()
+            # Filter treetops
+            tile_field_plot = matching.trees_in_bbox(trees_shp, xdims, ydims, index)
+            if len(tile_field_plot) == 0:
+                print(f'No measured trees in tile {tile_id}')
+                continue
         
-        tile_lidar_detected[['meas_x', 'meas_y', 'species', 'dbh', 'sum_2019', 'nov_2019', 'is_gps']] = tile_lidar_detected.apply(lambda row: utils.label_contours(row, tile_field_plot), axis=1, result_type='expand')
-        tile_lidar_detected.dropna(inplace=True)
-        # Match lidar and field plot trees
-        if len(tile_lidar_detected) == 0:
-            print(f'No detected trees in tile {tile_id}')
-            continue
-        print(f'{len(tile_lidar_detected)} remain after correction and drop')
-        # Separate files for each tile
-        tile_lidar_detected.to_file(filename=output_directory/f'{tile_id}.geojson', driver='GeoJSON')
-        # Extract data cubes for each tree. Do not normalize any other channel except CHM one.
-        for tree in tile_lidar_detected.itertuples():
+            matched = matching.match_crowns(tile_lidar_detected, tile_field_plot)
+            for col in matching.MATCH_COLUMNS:
+                tile_lidar_detected[col] = matched[col]
+            tile_lidar_detected.dropna(inplace=True)
+            # Match lidar and field plot trees
+            if len(tile_lidar_detected) == 0:
+                print(f'No detected trees in tile {tile_id}')
+                continue
+            instrument.count(crowns=len(tile_lidar_detected))
+            # Separate files for each tile
+            geo_io.write_frame(tile_lidar_detected, output_directory/f'{tile_id}{geo_io.suffix(fmt)}')
             # Save tree information
-            if tree_shapes is None:
-                tree_shapes = gpd.GeoDataFrame([tree], crs=tile_lidar_detected.crs)
-            else:
-                tree_shapes = pd.concat([tree_shapes, gpd.GeoDataFrame([tree],crs=tile_lidar_detected.crs)])
-    tree_shapes.drop('Index', inplace=True, axis=1)
+            tree_shapes.append(tile_lidar_detected)
+    if n_shards > 1:
+        # The matched trees of all shards are collected by merge_shards.py --filenames
+        instrument.summary(events)
+        return
+    if len(tree_shapes) == 0:
+        print('No matched trees')
+        instrument.summary(events)
+        return
+    tree_shapes = pd.concat(tree_shapes, ignore_index=True)
     tree_shapes['filename'] = [f'{i}.npy' for i in range(len(tree_shapes))]
     # Finally save a data frame containing the information of all detected trees
-    tree_shapes.to_file(filename=f'{output_directory}/matched_trees.geojson', driver='GeoJSON')
+    geo_io.write_frame(tree_shapes, output_directory/f'matched_trees{geo_io.suffix(fmt)}')
+    instrument.summary(events)
     return
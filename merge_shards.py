@@ -0,0 +1,46 @@
+from fastcore.script import *
+import pandas as pd
+from pathlib import Path
+from src import geo_io, manifest
+
+def merge_tiles(paths:list, # The per-tile files, in output order
+                out_path:Path, # The merged file
+                filenames:bool=False): # Number the trees in a filename column like match_field_data.py
+    """
+    Append the trees of the tiles to a single file one tile at a time, so
+    only one tile is held in memory. GeoParquet gets a row group per tile,
+    other formats are appended through GDAL. Returns the number of trees.
+    """
+    n = 0
+    parquet = geo_io.is_parquet(out_path)
+    with geo_io.ParquetAppender(out_path) if parquet else manifest.atomic_path(out_path) as out:
+        for path in paths:
+            frame = geo_io.read_frame(path)
+            if len(frame) == 0: continue
+            frame.index = pd.RangeIndex(n, n + len(frame))
+            if filenames:
+                # Keep the geometry last, as geo_io.write_frame does
+                frame.insert(len(frame.columns) - 1, 'filename', [f'{i}.npy' for i in frame.index])
+            if parquet: out.write(frame)
+            else: frame.to_file(out, driver='GeoJSON', layer=out_path.stem, mode='a' if n else 'w')
+            n += len(frame)
+    return n
+
+@call_parse
+def merge_shards(in_dir:Path, # Directory of the per-tile outputs written by the shards
+                 out_path:Path, # The merged file, GeoParquet or GeoJSON by suffix
+                 filenames:bool=False, # Number the trees in a filename column, for the outputs of match_field_data.py
+                 input_dir:Path=None): # Input directory of the sharded stage, every tile in it must have an output
+    """
+    Assemble the per-tile outputs of a sharded stage into one file, e.g. the
+    tree map from the outputs of map_species.py:
+
+        for i in 0 1 2 3; do python map_species.py ... --shard $i --n-shards 4 & done; wait
+        python merge_shards.py segs_w_species tree_map.parquet --input-dir merged
+    """
+    paths = [p for p in geo_io.list_frames(in_dir) if p.resolve() != out_path.resolve()]
+    if input_dir is not None:
+        missing = sorted({p.stem for p in geo_io.list_frames(input_dir)} - {p.stem for p in paths})
+        if missing: raise FileNotFoundError(f'{len(missing)} tiles have no output in {in_dir}, e.g. {missing[:5]}')
+    n = merge_tiles(paths, out_path, filenames)
+    print(f'Merged {n} trees from {len(paths)} tiles into {out_path}')
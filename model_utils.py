@@ -1,38 +1,136 @@
+import os
+import shutil
+import tempfile
+import time
 import numpy as np
 import pandas as pd
 from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay, cohen_kappa_score, matthews_corrcoef, accuracy_score, f1_score
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.base import clone
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import RandomizedSearchCV, HalvingRandomSearchCV
+from sklearn.pipeline import Pipeline
 import matplotlib.pyplot as plt
 
-def train_classifier(classifier, param_grid, X, y, scoring = "f1_macro", **search_args):
+def _shared_memmap(X, folder):
+    """ Writes the features to a .npy file and opens it as a read-only memmap.
+
+    joblib sends memmaps to the worker processes by file name, so all workers
+    share a single copy of X in the page cache instead of receiving their own.
+    A DataFrame comes back as a DataFrame over the memmap with the same index
+    and columns, so steps selecting columns by name still work.
+    """
+    path = os.path.join(folder, "X.npy")
+    np.save(path, np.ascontiguousarray(X))
+    shared = np.load(path, mmap_mode = "r")
+    if hasattr(X, "columns"): return pd.DataFrame(shared, index = X.index, columns = X.columns, copy = False)
+    return shared
+
+
+def timing_report(search):
+    """ Summarises the fit and score times of every candidate of a fitted search.
+
+    Parameters
+    ----------
+
+    search: A fitted RandomizedSearchCV or HalvingRandomSearchCV
+
+    Returns
+    -------
+
+    report: A DataFrame with one row per candidate (and halving iteration), the slowest first
+
+    """
+    results = pd.DataFrame(search.cv_results_)
+    columns = ["iter", "n_resources", "params", "mean_fit_time", "std_fit_time", "mean_score_time", "mean_test_score", "rank_test_score"]
+    report = results[[c for c in columns if c in results.columns]].copy()
+    n_splits = search.n_splits_
+    report["total_time"] = (results.mean_fit_time + results.mean_score_time) * n_splits
+    return report.sort_values("total_time", ascending = False).reset_index(drop = True)
+
+
+def train_classifier(classifier, param_grid, X, y, scoring = "f1_macro", search = "random", resource = "n_samples",
+                     preprocessing = None, features = None, memmap = False, cache_dir = None, return_report = False, **search_args):
     """ Trains a classifier and optimizes its hyperparameters.
 
     Parameters
     ----------
 
     classifier: The classifier to be trained.
-    param_grid: A dictionary containing the hyperparameters and their corresponding values to be input into RandomizedSearchCV.
+    param_grid: A dictionary containing the hyperparameters and their corresponding values to be input into the search.
     X, y: The features and labels of the training dataset.
     scoring: The evaluation metric to be used for selecting the best classifier. The default is f1_macro.
-    **search_args: Additional keyword arguments to be passed to RandomizedSearchCV.
+    search: "random" for RandomizedSearchCV, or "halving" for HalvingRandomSearchCV, which trains all candidates
+            on a small budget and only the best ones on the full data.
+    resource: The resource allocated by successive halving, "n_samples" or a parameter of the classifier such
+              as "n_estimators".
+    preprocessing: An optional list of (name, transformer) steps, e.g. [("scale", StandardScaler())], fitted once
+                   per fold and cached across candidates.
+    features: Optional column names (or a src.feature_spec.FeatureSpec) to train on, selected once before the search.
+    memmap: Share X with the workers as a read-only memmap.
+    cache_dir: Directory for caching the fitted preprocessing steps, a temporary directory by default.
+    return_report: Also return the timing report of the candidates, see timing_report.
+    **search_args: Additional keyword arguments to be passed to the search. n_iter is used as the number of
+                   candidates of the halving search. refit only selects the best candidate, which is always
+                   refitted on X: the metric to rank by for multiple scoring metrics, or a callable returning
+                   its index. refit=False is an error.
 
     Returns
     -------
 
-    best_classifier: The classifier with the highest cross-validated performance
-    
+    best_classifier: The classifier with the highest cross-validated performance, refitted on X
+    report: The timing report, if return_report is set
+
     """ 
-    
-    # Optimize the hyperparameters and extract the best model
-    clf = RandomizedSearchCV(classifier, 
-                             param_grid,
-                             scoring = scoring,
-                             **search_args)
-    
-    # Find the best hyperparameters using cross-validation and extract the best classifier
-    clf.fit(X,y)
-    
-    return clf.best_estimator_
+    start = time.perf_counter()
+    if features is not None:
+        X = X[list(getattr(features, "columns", features))]
+
+    # Fit the preprocessing and the classifier as one pipeline so that the
+    # preprocessing of each fold is cached and reused by all candidates
+    estimator, params = classifier, param_grid
+    tmp_dir = tempfile.mkdtemp() if memmap or (preprocessing and cache_dir is None) else None
+    if preprocessing:
+        estimator = Pipeline(list(preprocessing) + [("clf", classifier)], memory = cache_dir or tmp_dir)
+        params = {f"clf__{k}": v for k, v in param_grid.items()}
+        if resource != "n_samples": resource = f"clf__{resource}"
+
+    # The best candidate is always refitted below on X, refit only selects it
+    refit = search_args.pop("refit", True)
+    if refit is False: raise ValueError("train_classifier always refits the best candidate, refit only selects it")
+    multimetric = not (scoring is None or isinstance(scoring, str) or callable(scoring))
+    if multimetric and not (isinstance(refit, str) or callable(refit)):
+        raise ValueError("With multiple scoring metrics, refit must name the metric to select the best candidate by "
+                         "or be a callable")
+    if search == "halving":
+        if "n_iter" in search_args: search_args["n_candidates"] = search_args.pop("n_iter")
+        clf = HalvingRandomSearchCV(estimator, params, scoring = scoring, resource = resource, refit = False, **search_args)
+    elif search == "random":
+        clf = RandomizedSearchCV(estimator, params, scoring = scoring, refit = False, **search_args)
+    else:
+        raise ValueError(f"Unknown search {search}, expected random or halving")
+
+    try:
+        # Find the best hyperparameters using cross-validation
+        clf.fit(_shared_memmap(X, tmp_dir) if memmap else X, np.asarray(y))
+        search_time = time.perf_counter() - start
+
+        # Refit the best candidate on the original X, which keeps the feature names of a DataFrame
+        # The best candidate of a halving search over estimators gets the full budget
+        if callable(refit): best_index = refit(clf.cv_results_)
+        elif multimetric: best_index = clf.cv_results_[f"rank_test_{refit}"].argmin()
+        else: best_index = clf.best_index_
+        best_params = dict(clf.cv_results_["params"][best_index])
+        if search == "halving" and resource != "n_samples": best_params[resource] = clf.max_resources_
+        best_classifier = clone(estimator).set_params(**best_params).fit(X, y)
+        if preprocessing and cache_dir is None: best_classifier.set_params(memory = None)
+    finally:
+        if tmp_dir is not None: shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    refit_time = time.perf_counter() - start - search_time
+    print(f"Searched {len(clf.cv_results_['params'])} candidates in {search_time:.1f} s, refitted the best in {refit_time:.1f} s")
+    if return_report:
+        return best_classifier, timing_report(clf)
+    return best_classifier
 
 
 def plot_report(y_true, y_pred):
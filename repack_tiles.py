@@ -0,0 +1,42 @@
+from fastcore.script import *
+import os
+import multiprocessing
+from pathlib import Path
+from src import instrument, manifest, segmentation, tiles
+
+def repack_file(tile_fn:Path, out_fn:Path, chm_fn:Path, chm_band:int, block_size:int, compress:str, interleave:str):
+    "Repack a tile and its CHM band, writing both under temporary names"
+    with manifest.atomic_path(out_fn) as tmp, manifest.atomic_path(chm_fn) as chm_tmp:
+        tiles.repack(tile_fn, tmp, chm_tmp, chm_band, block_size, compress, interleave)
+
+def _repack_tile(args):
+    run, tile_id, inputs, outputs, params = args
+    with instrument.task('repack', tile_id):
+        records = run.input_records(inputs)
+        repack_file(inputs['tile'], *outputs, *params)
+        run.record(tile_id, records, outputs)
+
+@call_parse
+def repack_tiles(tile_dir:Path, # Directory for the hyperspectral tiles
+                 out_dir:Path, # Where to save the repacked tiles, the CHM files go to out_dir/chm
+                 chm_band:int=segmentation.CHM_BAND, # Band of the canopy height model
+                 block_size:int=tiles.REPACK_BLOCK_SIZE, # Width and height of the blocks in pixels
+                 compress:str=tiles.REPACK_COMPRESS, # GDAL compression, e.g. zstd, deflate or none
+                 interleave:str=tiles.REPACK_INTERLEAVE, # band, or pixel to keep all bands of a pixel together
+                 num_workers:int=10, # The number of worker processes
+                 force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                 profile_tile:str=None): # Run the task of this tile under cProfile
+    """
+    Repack the tiles once into GeoTIFFs of compressed square blocks, which all
+    stages read like the original tiles, and copy the CHM band into separate
+    files for the segmentation
+    """
+    os.makedirs(out_dir/tiles.CHM_DIR, exist_ok=True)
+    events = instrument.configure(out_dir, 'repack', profile_tile)
+    params = (chm_band, block_size, compress, interleave)
+    run = manifest.Manifest(out_dir, 'repack', dict(zip(['chm_band', 'block_size', 'compress', 'interleave'], params)))
+    tasks = [(f.stem, {'tile': f}, [out_dir/f.name, tiles.chm_path(out_dir/f.name)]) for f in sorted(tile_dir.glob('*.tif'))]
+    inputs = [(run, *t, params) for t in run.pending(tasks, force)]
+    with multiprocessing.Pool(num_workers, maxtasksperchild=20) as pool:
+        for _ in pool.imap_unordered(_repack_tile, inputs): pass
+    instrument.summary(events)
@@ -4,25 +4,28 @@ import numpy as np
 import geopandas as gpd
 import pandas as pd
 from pathlib import Path
-from fastai.tabular.all import *
-import multiprocessing
-from itertools import repeat
+import pyarrow.parquet as pq
+from src import feature_store, geo_io, inference, instrument, manifest, scheduler, sharding, stats
 
+@instrument.timed('predict')
 def predict_species(features:pd.DataFrame, 
-                    learner:TabularLearner):
+                    learner):
     """
     Predicts the species for a set of observations.
 
     Parameters
     ----------
     features : A DataFrame containing observations
-    learner : A fastai tabular learner
+    learner : A fastai tabular learner, or a model exported with export_model.py
 
     Return
     ------
     preds : A numpy array containing the predictions for each observation
     """
 
+    if isinstance(learner, inference.NumpyMLP):
+        return learner.predict(features)
+
     # Create a dataloader for the data
     dl = learner.dls.test_dl(features)
     
@@ -31,61 +34,133 @@ def predict_species(features:pd.DataFrame,
     return np.array(dl.vocab[decoded])
 
 
+def read_segments(data_fn:Path):
+    """
+    Reads the tree segments and features of a single tile.
+
+    Parameters
+    ----------
+    data_fn : A parquet file containing a geodataframe, or the feature array
+              of a tile in a feature store
+
+    Return
+    ------
+    info : A geodataframe containing the segments without the features
+    features : A DataFrame containing the features of each segment
+    """
+    store_dir = data_fn.parent.parent
+    if data_fn.suffix == '.npy' and feature_store.is_store(store_dir):
+        store = feature_store.FeatureStore(store_dir)
+        info = store.meta(data_fn.stem)
+        features = pd.DataFrame(store.features(data_fn.stem), columns=store.columns, copy=False)
+        return info, features.set_index(info.index)
+
+    data = gpd.read_parquet(data_fn)
+    feature_cols = stats.feature_columns(data.columns)
+    return data.drop(columns=feature_cols), data[feature_cols]
+
+
+def count_segments(data_fn:Path):
+    """
+    Returns the number of segments in a file without reading the data.
+    """
+    if data_fn.suffix == '.npy': return np.load(data_fn, mmap_mode='r').shape[0]
+    return pq.ParquetFile(data_fn).metadata.num_rows
+
+
 def process_file(data_fn:Path,
-                 learner:TabularLearner,
-                 out_dir:Path):
+                 learner,
+                 out_dir:Path,
+                 fmt:str="geojson"):
     """
     Processes a single file of observations.
 
     Extracts the species for each segment in the given geodataframe file. 
     Adds the extracted species to the geodataframe, and removes the features 
-    used for predicting. Stores the modified geodataframe as a geojson file in 
-    the given output directory.
+    used for predicting. Stores the modified geodataframe as a geojson (or 
+    GeoParquet) file in the given output directory.
 
     Parameters
     ----------
-    data_fn : A filepath to a parquet file containing a geodataframe
-    learner : A fastai tabular learner used for prediction
+    data_fn : A filepath to a parquet file containing a geodataframe, or to
+              the feature array of a tile in a feature store
+    learner : A fastai tabular learner or an exported model used for prediction
     out_dir : The output directory
+    fmt : The output format, geojson or parquet
     """
 
-    print(f"Processing tile {data_fn.stem}")
-    
     # Read the tree segments
-    data = gpd.read_parquet(data_fn)
-    info = data.iloc[:,:10]
-    features = data.iloc[:,10:]
+    info, features = read_segments(data_fn)
+    instrument.count(crowns=len(info))
 
     # Predict the species for each segment
     info["species"] = predict_species(features, learner)
 
-    # Write the data (excluding the features) to a geojson
-    info.to_file(out_dir/f"{data_fn.stem}.geojson", driver="GeoJSON")
+    # Write the data (excluding the features)
+    geo_io.write_frame(info, out_dir/f"{data_fn.stem}{geo_io.suffix(fmt)}")
 
-    print(f"Finished with tile {data_fn.stem}")
+def process_file_in_worker(tile_id:str, inputs:dict, outputs:list, run:manifest.Manifest, fmt:str="geojson"):
+    """
+    Processes a single file with the model loaded by inference.init_worker
+    and records the finished tile in the run manifest.
+    """
+    with instrument.task('species', tile_id):
+        records = run.input_records(inputs)
+        process_file(inputs['features'], inference.worker_model(), outputs[0].parent, fmt)
+        run.record(tile_id, records, outputs)
 
 @call_parse
 def batch_inference(data_dir:Path,
                     learner_path:Path,
                     out_dir:Path,
-                    num_workers:int = 1):
+                    num_workers:int = 1,
+                    fmt:str = "geojson",
+                    force:bool = False,
+                    profile_tile:str = None,
+                    shard:int = None,
+                    n_shards:int = None):
 
     """
     Extracts the tree species for each tile in the given folder of data.
 
     Parameters
     ----------
-    data_dir : A directory containing the tree segments in each tile
-    learner_path : A filepath to the learner used for prediction
+    data_dir : A directory containing the tree segments in each tile, or a
+               feature store
+    learner_path : A filepath to the learner used for prediction, either a
+                   fastai learner or a .npz model exported with export_model.py
     out_dir : The directory in which the processed data is stored
+    num_workers : The number of worker processes
+    fmt : The output format, geojson or parquet
+    force : Also recompute the tiles recorded as up to date in the run manifest
+    profile_tile : Run the task of this tile under cProfile
+    shard, n_shards : Only process the tiles of this shard out of n_shards,
+                      SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT by default
     """
 
     # Create the output directory if it does not exist
     if not os.path.exists(out_dir): os.makedirs(out_dir, exist_ok=True)
-
-    data_fns = [data_dir/f for f in os.listdir(data_dir)]
-    learner = load_learner(learner_path)
-
-    with multiprocessing.Pool(num_workers) as pool:
-        pool.starmap(process_file, zip(data_fns, repeat(learner), repeat(out_dir)))
+    events = instrument.configure(out_dir, 'species', profile_tile)
+
+    if feature_store.is_store(data_dir):
+        store = feature_store.FeatureStore(data_dir)
+        inputs = [{'features': store.feature_path(t), 'meta': store.meta_path(t)} for t in store.tile_ids]
+    else:
+        inputs = [{'features': data_fn} for data_fn in geo_io.list_frames(data_dir)]
+    for i in inputs: i['model'] = learner_path
+
+    # Keep the tiles of this shard, balanced by the number of segments
+    inputs, _ = sharding.select(inputs, [count_segments(i['features']) for i in inputs], shard, n_shards)
+
+    # Skip the tiles that are up to date
+    run = manifest.Manifest(out_dir, 'species')
+    tasks = [(i['features'].stem, i, [out_dir/f"{i['features'].stem}{geo_io.suffix(fmt)}"], run, fmt) for i in inputs]
+    tasks = run.pending(tasks, force)
+
+    # Each worker loads the model once instead of receiving it with every tile,
+    # and the largest tiles are processed first
+    costs = [count_segments(t[1]['features']) for t in tasks]
+    for _ in scheduler.run(process_file_in_worker, tasks, costs, num_workers, inference.init_worker, (learner_path,),
+                           unit='segments'): pass
+    instrument.summary(events)
         
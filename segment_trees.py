@@ -0,0 +1,50 @@
+from fastcore.script import *
+import os
+import multiprocessing
+from pathlib import Path
+from src import geo_io, instrument, manifest, masking, rle, segmentation
+from fix_crown_data import merge_frames
+
+def segment_file(tile_fn:Path, outfile:Path, band:int, ws:float, hmin:float, th_seed:float, th_cr:float, max_cr:int, masks:bool=False):
+    "Segment the trees of a tile and write them in the format of fix_crown_data.py"
+    ttops, crowns, labels, transform = segmentation.segment_tile(tile_fn, band, ws, hmin, th_seed, th_cr, max_cr)
+    trees = merge_frames(ttops, crowns, outfile.stem)
+    if masks: trees = rle.add_masks(trees, *masking.pixel_centres(transform, labels.shape[1], labels.shape[0]))
+    instrument.count(crowns=len(trees), pixels=labels.size)
+    geo_io.write_frame(trees, outfile)
+
+def _segment_tile(args):
+    run, tile_id, inputs, outputs, params = args
+    with instrument.task('segment', tile_id):
+        records = run.input_records(inputs)
+        segment_file(inputs['tile'], outputs[0], *params)
+        run.record(tile_id, records, outputs)
+
+@call_parse
+def segment_trees(tile_dir:Path, # Directory for the hyperspectral tiles
+                  outdir:Path, # Where to save the trees of each tile
+                  band:int=segmentation.CHM_BAND, # Band of the canopy height model
+                  ws:float=segmentation.WINDOW_SIZE, # Diameter of the treetop search window in metres
+                  hmin:float=segmentation.HMIN, # Minimum height of a tree
+                  th_seed:float=segmentation.TH_SEED, # Crown pixels are higher than th_seed times the treetop
+                  th_cr:float=segmentation.TH_CR, # Crown pixels are higher than th_cr times the mean crown height
+                  max_cr:int=segmentation.MAX_CR, # Maximum distance in pixels from the treetop along each axis
+                  fmt:str=geo_io.DEFAULT_FORMAT, # Output format, parquet or geojson
+                  masks:bool=False, # Store run-length encoded crown masks with the trees, parquet only
+                  num_workers:int=10, # The number of worker processes
+                  force:bool=False, # Also recompute the tiles recorded as up to date in the run manifest
+                  profile_tile:str=None): # Run the task of this tile under cProfile
+    """
+    Detect the treetops and delineate the crowns on the CHM of each tile, and
+    save the merged trees like fix_crown_data.py does for the outputs of detect_trees.R
+    """
+    if masks and fmt != 'parquet': raise ValueError('Crown masks can only be stored in parquet files')
+    if not os.path.exists(outdir): os.makedirs(outdir)
+    events = instrument.configure(outdir, 'segment', profile_tile)
+    params = (band, ws, hmin, th_seed, th_cr, max_cr, masks)
+    run = manifest.Manifest(outdir, 'segment', dict(zip(['band', 'ws', 'hmin', 'th_seed', 'th_cr', 'max_cr', 'masks'], params)))
+    tasks = [(f.stem, {'tile': f}, [outdir/f'{f.stem}{geo_io.suffix(fmt)}']) for f in sorted(tile_dir.glob('*.tif'))]
+    inputs = [(run, *t, params) for t in run.pending(tasks, force)]
+    with multiprocessing.Pool(num_workers, maxtasksperchild=20) as pool:
+        for _ in pool.imap_unordered(_segment_tile, inputs): pass
+    instrument.summary(events)
@@ -0,0 +1,145 @@
+from fastcore.script import *
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+import shapely
+from src import tree_index
+
+# Content types of the formats of /trees
+FORMATS = {'ndjson': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet',
+           'count': 'application/json'}
+
+# Bytes collected before sending a chunk of a streamed response
+CHUNK_BYTES = 2**16
+
+class ChunkedWriter:
+    "A binary file-like object sending what is written as the chunks of an HTTP/1.1 response"
+    def __init__(self, wfile):
+        self.wfile, self.closed = wfile, False
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_BYTES: self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer: self.wfile.write(b'%x\r\n%s\r\n' % (len(self.buffer), self.buffer))
+        self.buffer = bytearray()
+
+    def finish(self):
+        "Send the buffered data and the last chunk"
+        self.flush()
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+def _floats(value, n, name):
+    values = [float(v) for v in value.split(',')]
+    if len(values) != n: raise ValueError(f'{name} takes {n} comma-separated numbers')
+    return values
+
+def query_args(params:dict):
+    """
+    The arguments of TreeIndex.query from the parameters of a request:
+
+        bbox=xmin,ymin,xmax,ymax  x=..&y=..&r=..  polygon=<WKT>
+        species=Scots pine,Birch  min_height=..  max_height=..  limit=..
+    """
+    args = {}
+    if 'bbox' in params: args['bbox'] = _floats(params['bbox'], 4, 'bbox')
+    if 'x' in params or 'y' in params or 'r' in params:
+        if not {'x', 'y', 'r'} <= set(params): raise ValueError('A radius query takes x, y and r')
+        args['center'], args['radius'] = (float(params['x']), float(params['y'])), float(params['r'])
+    if 'polygon' in params:
+        try: args['polygon'] = shapely.from_wkt(params['polygon'])
+        except shapely.errors.GEOSException as e: raise ValueError(f'Invalid polygon: {e}')
+    if 'species' in params: args['species'] = params['species'].split(',')
+    for k in ('min_height', 'max_height'):
+        if k in params: args[k] = float(params[k])
+    if 'limit' in params: args['limit'] = int(params['limit'])
+    return args
+
+def make_handler(index:tree_index.TreeIndex, log_requests:bool=False):
+    "A request handler class answering the queries over `index`"
+    info = {'trees': len(index), 'species': index.species_names, 'tiles': len(index.tile_ids),
+            'cell_size': index.cell_size, 'crs': index.crs.to_string() if index.crs else None}
+
+    class Handler(BaseHTTPRequestHandler):
+        # Chunked responses need HTTP/1.1, which also keeps connections alive
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes, which Nagle's algorithm
+        # would hold back for the delayed ACK of the client, 40 ms a request
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            if log_requests: super().log_message(*args)
+
+        def send_json(self, value, status=200):
+            body = json.dumps(value).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path == '/info': return self.send_json(info)
+                if url.path == '/trees': return self.trees(params)
+                if url.path == '/counts': return self.counts(params)
+                self.send_json({'error': f'Unknown path {url.path}, expected /info, /trees or /counts'}, 404)
+            except (ValueError, KeyError) as e:
+                self.send_json({'error': str(e).strip('"\'')}, 400)
+
+        def trees(self, params):
+            fmt = params.pop('format', 'ndjson')
+            if fmt not in FORMATS: raise ValueError(f'Unknown format {fmt}, expected one of {list(FORMATS)}')
+            idx = index.query(**query_args(params))
+            if fmt == 'count': return self.send_json({'count': len(idx)})
+            self.send_response(200)
+            self.send_header('Content-Type', FORMATS[fmt])
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            out = ChunkedWriter(self.wfile)
+            if fmt == 'parquet': index.write_parquet(idx, out)
+            else: index.write_ndjson(idx, out)
+            out.finish()
+
+        def counts(self, params):
+            cell_size = float(params.pop('cell', tree_index.CELL_SIZE))
+            counts = index.counts(index.query(**query_args(params)), cell_size)
+            self.send_json({'cell_size': cell_size, 'species': index.species_names,
+                            'cells': counts.to_dict('records')})
+
+    return Handler
+
+def make_server(index_dir:Path, host:str='127.0.0.1', port:int=8000, log_requests:bool=False):
+    "A threaded HTTP server over the index in `index_dir`, port 0 picks a free port"
+    index = tree_index.TreeIndex(index_dir)
+    return ThreadingHTTPServer((host, port), make_handler(index, log_requests))
+
+@call_parse
+def serve_tree_map(index_dir:Path, # The index written by index_tree_map.py
+                   host:str='127.0.0.1', # Address to listen on
+                   port:int=8000, # Port to listen on
+                   log_requests:bool=False): # Log every request to stderr
+    """
+    Answer queries over the tree map over HTTP until interrupted:
+
+        /info                                  number of trees, species and grid
+        /trees?bbox=xmin,ymin,xmax,ymax        the trees as NDJSON GeoJSON features
+        /trees?x=..&y=..&r=..&format=parquet   the trees as GeoParquet
+        /trees?species=Birch&format=count      the number of trees
+        /counts?polygon=<WKT>&cell=100         species counts per hectare
+
+    /trees and /counts take the filters bbox, x/y/r, polygon, species,
+    min_height, max_height and limit, treetops locating the trees.
+    """
+    server = make_server(index_dir, host, port, log_requests)
+    print(f'Serving {index_dir} on http://{host}:{server.server_port}')
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
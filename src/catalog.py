@@ -0,0 +1,169 @@
+"""
+Tile catalog and per-tile partitions of the tree data.
+
+The catalog holds the extent, band count, resolution and size of every tile,
+together with the number of crowns and field trees in it, and answers
+spatial lookups through an STRtree over the tile extents. The crowns are
+split into one file per tile in a single pass, so that workers get a tile id
+and read only their own partition instead of filtering the full table.
+
+Layout of a catalog directory:
+
+    catalog.parquet              one row per tile, geometry is the tile extent
+    partitions/{tile_id}.parquet the trees of a tile
+"""
+
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+import rasterio
+import shapely
+from src import geo_io, masking, rle
+
+CATALOG_FILE = 'catalog.parquet'
+PARTITION_DIR = 'partitions'
+
+# Column keeping the row of each tree in the partitioned table
+ROW_COLUMN = 'row'
+
+
+def scan_tiles(tile_dir):
+    "Read the metadata of the tiles in `tile_dir` into a GeoDataFrame"
+    records, crs = [], None
+    for fn in sorted(Path(tile_dir).glob('*.tif')):
+        with rasterio.open(fn) as src:
+            crs = crs or src.crs
+            records.append({'tile_id': fn.stem, 'path': str(fn), 'n_bands': src.count,
+                            'width': src.width, 'height': src.height,
+                            'res_x': src.res[0], 'res_y': src.res[1], 'dtype': src.dtypes[0],
+                            'geometry': shapely.box(*src.bounds)})
+    columns = ['tile_id', 'path', 'n_bands', 'width', 'height', 'res_x', 'res_y', 'dtype', 'geometry']
+    return gpd.GeoDataFrame(records, columns=columns, geometry='geometry', crs=crs)
+
+
+class TileCatalog:
+    "Tile metadata with an STRtree over the tile extents"
+
+    def __init__(self, frame):
+        self.frame = frame.reset_index(drop=True)
+        self.tile_ids = self.frame.tile_id.astype(str).values
+        self._positions = {t: i for i, t in enumerate(self.tile_ids)}
+        self._index = shapely.STRtree(self.frame.geometry.values)
+
+    @classmethod
+    def build(cls, tile_dir, trees=None, field=None, field_xy=('tree_X', 'tree_Y')):
+        """
+        Scan the tiles and count the crowns and field trees of each tile.
+
+        Parameters
+        ----------
+        tile_dir : The directory of the hyperspectral tiles
+        trees : Optional frame of crowns with a tile_id column
+        field : Optional frame of field trees, located by the `field_xy` columns
+        """
+        catalog = cls(scan_tiles(tile_dir))
+        if trees is not None:
+            counts = trees.tile_id.astype(str).value_counts()
+            catalog.frame['n_crowns'] = counts.reindex(catalog.tile_ids, fill_value=0).values
+        if field is not None:
+            x, y = (field[c].values for c in field_xy)
+            _, tile_idx = catalog.locate(x, y)
+            catalog.frame['n_field_trees'] = np.bincount(tile_idx, minlength=len(catalog.tile_ids))
+        return catalog
+
+    @classmethod
+    def load(cls, path):
+        "Load a catalog from a catalog file or directory"
+        path = Path(path)
+        return cls(gpd.read_parquet(path/CATALOG_FILE if path.is_dir() else path))
+
+    def save(self, path):
+        "Save the catalog into a catalog file or directory"
+        path = Path(path)
+        if path.suffix == '':
+            os.makedirs(path, exist_ok=True)
+            path = path/CATALOG_FILE
+        geo_io.write_frame(self.frame, path)
+
+    def __len__(self): return len(self.tile_ids)
+
+    def tile(self, tile_id):
+        "The catalog row of a tile"
+        return self.frame.iloc[self._positions[str(tile_id)]]
+
+    def tiles_in(self, bounds):
+        "Ids of the tiles intersecting the (xmin, ymin, xmax, ymax) bounds"
+        return self.tile_ids[np.sort(self._index.query(shapely.box(*bounds), predicate='intersects'))]
+
+    def locate(self, x, y):
+        """
+        Find the tiles containing the points (x, y). Points on a shared tile
+        edge are returned once for each tile.
+
+        Return
+        ------
+        point_idx, tile_idx : Positions of the points and of their tiles
+        """
+        return self._index.query(shapely.points(x, y), predicate='intersects')
+
+
+def partition_path(partition_dir, tile_id):
+    "Path of the partition of a tile"
+    return Path(partition_dir)/f'{tile_id}.parquet'
+
+
+def partition_trees(trees, partition_dir, tile_dir=None):
+    """
+    Write the trees of each tile into its own file with a single groupby.
+    The row of each tree in `trees` is kept and restored by `read_partition`.
+    If `tile_dir` is given, the run-length encoded crown masks on the grid of
+    each tile are stored with the trees, see `rle`.
+
+    Return
+    ------
+    counts : A Series with the number of trees in each partition
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    trees = trees.rename_axis(ROW_COLUMN)
+    for tile_id, part in trees.groupby(trees.tile_id.astype(str), sort=True):
+        if tile_dir is not None:
+            with rasterio.open(Path(tile_dir)/f'{tile_id}.tif') as src:
+                xs, ys = masking.pixel_centres(src.transform, src.width, src.height)
+            part = rle.add_masks(part, xs, ys)
+        geo_io.write_frame(part, partition_path(partition_dir, tile_id))
+    return trees.tile_id.astype(str).value_counts().sort_index()
+
+
+def read_partition(partition_dir, tile_id, columns=None):
+    "The trees of a tile, indexed by their row in the partitioned table"
+    if columns is not None: columns = list(columns) + [ROW_COLUMN]
+    part = geo_io.read_frame(partition_path(partition_dir, tile_id), columns=columns)
+    return part.set_index(ROW_COLUMN).rename_axis(None)
+
+
+def partitions(tree_path, work_dir):
+    """
+    The partition directory and per-tile tree counts for `tree_path`.
+
+    `tree_path` is either a catalog directory with partitions, or a single
+    file of trees, which is partitioned into `work_dir` first.
+
+    Return
+    ------
+    partition_dir : The directory of the partitions
+    counts : A Series with the number of trees in each tile
+    """
+    tree_path = Path(tree_path)
+    if tree_path.is_dir():
+        partition_dir = tree_path/PARTITION_DIR
+        tile_ids = sorted(p.stem for p in partition_dir.glob('*.parquet') if not p.stem.endswith('.tmp'))
+        if not tile_ids:
+            raise FileNotFoundError(f'No tree partitions in {partition_dir}, expected a catalog directory '
+                                    'written by build_catalog.py or a file of trees')
+        counts = [pq.ParquetFile(partition_path(partition_dir, t)).metadata.num_rows for t in tile_ids]
+        return partition_dir, pd.Series(counts, index=tile_ids)
+    partition_dir = Path(work_dir)/PARTITION_DIR
+    return partition_dir, partition_trees(geo_io.read_frame(tree_path), partition_dir)
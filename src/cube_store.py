@@ -0,0 +1,143 @@
+"""
+Packed storage for the data cubes cut around the treetops.
+
+All cubes of a run live in one memory-mappable array instead of one .npy file
+per tree, so a training loader reads a random batch with a few large reads
+rather than one file open per cube. An index table maps cube positions to the
+trees, and the crown masks are kept as a boolean side array instead of being
+burnt into the cubes as NaNs.
+
+Layout of a store directory:
+
+    cube_store.json  window size, cube shape, dtype, whether masks are stored
+                     and the normalization of the cubes, if any
+    cubes.npy        array of shape (n, bands, 4*ws+1, 4*ws+1)
+    masks.npy        optional boolean array of shape (n, 4*ws+1, 4*ws+1)
+    index.parquet    one row per cube, the cube of row i is cubes[i]
+"""
+
+import os
+import json
+from pathlib import Path
+import numpy as np
+from numpy.lib.format import open_memmap
+from numpy.lib.stride_tricks import sliding_window_view
+from src import geo_io, instrument
+
+SCHEMA_FILE = 'cube_store.json'
+
+
+def cut_windows(block, rows, cols, size):
+    """
+    Cut square windows out of a (bands, rows, cols) block in one batched copy.
+
+    Parameters
+    ----------
+    block : The array holding the pixels
+    rows, cols : The top left pixel of each window within `block`
+    size : The side of the windows
+
+    Return
+    ------
+    cubes : An array of shape (n, bands, size, size)
+    """
+    # A strided view of every size x size window of the block, without copying
+    windows = sliding_window_view(block, (size, size), axis=(1, 2))
+    return np.ascontiguousarray(windows[:, rows, cols].transpose(1, 0, 2, 3))
+
+
+def is_store(path):
+    "Whether `path` is a cube store directory"
+    return (Path(path)/SCHEMA_FILE).exists()
+
+
+class CubeStore:
+    "A directory holding all cubes of a run in a single array"
+
+    def __init__(self, path, mode='r'):
+        """
+        Parameters
+        ----------
+        path : The store directory
+        mode : 'r' to read, 'r+' to fill in cubes
+        """
+        self.path = Path(path)
+        with open(self.path/SCHEMA_FILE) as f:
+            self.schema = json.load(f)
+        self.window_size = self.schema['window_size']
+        self.cubes = np.load(self.path/'cubes.npy', mmap_mode=mode)
+        self.masks = np.load(self.path/'masks.npy', mmap_mode=mode) if self.schema['masks'] else None
+        self._index = None
+
+    @classmethod
+    def create(cls, path, index, n_bands, window_size, dtype='float32', masks=False, normalization=None):
+        """
+        Allocate a store for the cubes of the trees in `index`.
+
+        Parameters
+        ----------
+        path : The store directory
+        index : A (Geo)DataFrame with one row per cube, in cube order
+        n_bands : Number of bands in each cube
+        window_size : Radius of the squares extracted around treetops in metres
+        dtype : The dtype of the cubes
+        masks : Whether to allocate the crown masks
+        normalization : The parameters of the normalization applied to the cubes
+        """
+        path = Path(path)
+        os.makedirs(path, exist_ok=True)
+        side = window_size*4 + 1
+        open_memmap(path/'cubes.npy', mode='w+', dtype=dtype, shape=(len(index), n_bands, side, side)).flush()
+        if masks: open_memmap(path/'masks.npy', mode='w+', dtype=bool, shape=(len(index), side, side)).flush()
+        geo_io.write_frame(index.reset_index(drop=True), path/'index.parquet')
+        schema = {'window_size': window_size, 'shape': [len(index), n_bands, side, side],
+                  'dtype': np.dtype(dtype).name, 'masks': masks, 'normalization': normalization}
+        tmp = path/f'{SCHEMA_FILE}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(schema, f, indent=1)
+        os.replace(tmp, path/SCHEMA_FILE)
+        return cls(path, 'r+')
+
+    def __len__(self): return len(self.cubes)
+
+    @property
+    def index(self):
+        "The table describing each cube"
+        if self._index is None: self._index = geo_io.read_frame(self.path/'index.parquet')
+        return self._index
+
+    @instrument.timed('write')
+    def write(self, positions, cubes, masks=None):
+        "Store cubes (and masks) at the given positions"
+        self.cubes[positions] = cubes
+        if masks is not None: self.masks[positions] = masks
+
+    @instrument.timed('write')
+    def flush(self):
+        self.cubes.flush()
+        if self.masks is not None: self.masks.flush()
+
+    def batch(self, positions, delineate=False):
+        """
+        Read a batch of cubes. The positions are read in sorted order, which
+        turns a random batch into ordered reads of contiguous cubes.
+
+        Parameters
+        ----------
+        positions : The cubes to read
+        delineate : Set the pixels outside the crown masks to nan
+
+        Return
+        ------
+        cubes : An array of shape (len(positions), bands, side, side) in the order of `positions`
+        """
+        positions = np.asarray(positions)
+        order = np.argsort(positions, kind='stable')
+        cubes = np.empty((len(positions),) + self.cubes.shape[1:], self.cubes.dtype)
+        cubes[order] = self.cubes[positions[order]]
+        if delineate:
+            if self.masks is None: raise ValueError('The store has no crown masks')
+            masks = np.empty((len(positions),) + self.masks.shape[1:], bool)
+            masks[order] = self.masks[positions[order]]
+            cubes = np.where(masks[:, None], cubes, np.nan)
+        return cubes
@@ -0,0 +1,136 @@
+"""
+Elimination of crowns delineated more than once, within a tile or by two
+tiles that overlap or meet.
+
+The treetops of all tiles are snapped to a grid (0.5 m, the pixel size of the
+CHM) and the cells are hashed into 64-bit keys. Only crowns whose treetops
+fall into the same or neighbouring cells are candidates, and a candidate pair
+is a duplicate when the crowns overlap by at least a given fraction of the
+smaller one. Of each group of duplicates the largest crown is kept, as a
+crown cut at a tile edge is smaller than its complete copy, with ties going
+to the tile sorted first and then to the earlier row. The result depends
+neither on the order the tiles are processed in nor on the workers.
+"""
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from src import instrument
+
+# Side of the grid cells in metres
+GRID_SIZE = 0.5
+
+# Fraction of the smaller crown that must be covered by the other one
+MIN_OVERLAP = 0.5
+
+# Bits of the row of a cell in its key
+_ROW_BITS = 32
+
+
+def cell_keys(x, y, grid_size=GRID_SIZE):
+    "The keys of the grid cells of points, the column in the high and the row in the low bits"
+    col = np.floor(np.asarray(x) / grid_size).astype(np.int64)
+    row = np.floor(np.asarray(y) / grid_size).astype(np.int64)
+    return (col << _ROW_BITS) + (row & ((1 << _ROW_BITS) - 1))
+
+
+@instrument.timed('hash')
+def candidate_pairs(keys, radius=1):
+    """
+    Pairs of points in the same cell or within `radius` cells of each other.
+
+    Parameters
+    ----------
+    keys : The `cell_keys` of all points
+    radius : Distance in cells up to which points are paired
+
+    Return
+    ------
+    i, j : Indices of the points of each pair with i < j, sorted
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    pairs_i, pairs_j = [], []
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            target = keys + (dx << _ROW_BITS) + dy
+            lo = np.searchsorted(sorted_keys, target, 'left')
+            hi = np.searchsorted(sorted_keys, target, 'right')
+            n = hi - lo
+            i = np.repeat(np.arange(len(keys)), n)
+            # Position within each run of matches, added to its start
+            offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            j = order[np.repeat(lo, n) + offset]
+            keep = i < j
+            pairs_i.append(i[keep])
+            pairs_j.append(j[keep])
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+
+@instrument.timed('overlap')
+def crown_overlap(a, b):
+    "Area of the intersection of two arrays of crowns relative to the smaller crown of each pair"
+    a, b = np.asarray(a), np.asarray(b)
+    smaller = np.minimum(shapely.area(a), shapely.area(b))
+    inter = shapely.area(shapely.intersection(a, b))
+    return np.divide(inter, smaller, out=np.zeros(len(a)), where=smaller > 0)
+
+
+def resolve(n, i, j, duplicate, area, tile, row):
+    """
+    Pick one crown of each group of duplicates.
+
+    Parameters
+    ----------
+    n : The number of crowns
+    i, j : Candidate pairs from `candidate_pairs`
+    duplicate : Whether each pair is a duplicate
+    area, tile, row : Area, tile rank and row of each crown, deciding the
+                      winner in this order
+
+    Return
+    ------
+    drop : Boolean mask of the crowns duplicating a kept one
+    group : The group of duplicates of each crown, a crown without
+            duplicates forms a group of its own
+    """
+    i, j = np.asarray(i)[duplicate], np.asarray(j)[duplicate]
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    _, group = connected_components(graph, directed=False)
+    # The first crown of each group in the winner order
+    order = np.lexsort((row, tile, -np.asarray(area), group))
+    first = np.r_[True, group[order][1:] != group[order][:-1]]
+    drop = np.ones(n, dtype=bool)
+    drop[order[first]] = False
+    return drop, group
+
+
+def group_tiles(group, tile, n_tiles):
+    """
+    The tiles each tile shares a group of duplicates with. A group can chain
+    across several tile boundaries, and a change in any of its tiles can
+    change which of its crowns are kept.
+
+    Parameters
+    ----------
+    group : The group of each crown, see `resolve`
+    tile : The tile rank of each crown
+    n_tiles : The number of tiles
+
+    Return
+    ------
+    tiles : A list of sorted arrays, the other tiles of each tile
+    """
+    # Unique (group, tile) pairs of the groups spanning several tiles
+    pairs = np.unique(np.stack([group, tile], axis=1), axis=0)
+    starts = np.flatnonzero(np.r_[True, pairs[1:,0] != pairs[:-1,0]])
+    sizes = np.diff(np.r_[starts, len(pairs)])
+    related = [set() for _ in range(n_tiles)]
+    for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+        members = pairs[start:start + size, 1]
+        for t in members: related[t].update(members)
+    return [np.array(sorted(r - {t}), dtype=np.int64) for t, r in enumerate(related)]
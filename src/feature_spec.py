@@ -0,0 +1,86 @@
+"""
+Feature specs: the crown features a model needs.
+
+A spec lists feature names like mean_band_12, in the naming of the feature
+tables. The extraction stages read only the bands in the spec from the tiles
+and derive only its statistics, and the resulting columns hold the same
+values as the corresponding columns of a full extraction.
+
+A spec is loaded from a model, which declares the names of its inputs, or
+from a list of names:
+
+    model.npz           a model exported with export_model.py
+    model.joblib        a pickled scikit-learn or LightGBM model fitted on a DataFrame
+    model.pkl           a fastai tabular learner
+    features.txt        one name per line, or separated by commas
+    features.json       a list of names
+    mean_band_12,...    the names themselves
+"""
+
+import json
+from pathlib import Path
+import numpy as np
+from src import stats
+
+
+class FeatureSpec:
+    "The features to extract, in output column order"
+
+    def __init__(self, names):
+        names = [str(n) for n in names]
+        parsed = [stats.parse_feature_name(n) for n in names]
+        unknown = [n for n, p in zip(names, parsed) if p is None]
+        if unknown: raise ValueError(f'Not feature names: {unknown[:5]}')
+        if len(set(names)) != len(names): raise ValueError('The feature names are not unique')
+        self.columns = names
+        self.bands = sorted({b for _, b in parsed})
+        self.statistics = tuple(s for s in stats.STATISTICS if any(p[0] == s for p in parsed))
+        # Position of each column among the statistics of the bands read
+        band_pos = {b: i for i, b in enumerate(self.bands)}
+        stat_pos = {s: i for i, s in enumerate(self.statistics)}
+        self._index = np.array([stat_pos[s] * len(self.bands) + band_pos[b] for s, b in parsed], dtype=np.int64)
+
+    def __len__(self): return len(self.columns)
+
+    def __repr__(self):
+        return f'FeatureSpec({len(self)} features, {len(self.bands)} bands, statistics={self.statistics})'
+
+    def select(self, features):
+        """
+        The spec columns of features computed by `stats.crown_features` for
+        `self.statistics` over the bands in `self.bands`
+        """
+        return features[:, self._index]
+
+
+def model_features(model):
+    "The input feature names declared by a model"
+    if hasattr(model, 'cont_names') and not hasattr(model, 'dls'): return list(model.cont_names)
+    if hasattr(model, 'dls'):
+        if len(model.dls.cat_names): raise ValueError('Categorical inputs are not supported')
+        return list(model.dls.cont_names)
+    if hasattr(model, 'feature_names_in_'): return list(model.feature_names_in_)
+    if hasattr(model, 'feature_name_'): return list(model.feature_name_)
+    if hasattr(model, 'feature_name'): return list(model.feature_name())
+    raise ValueError(f'Cannot find the input features of {type(model).__name__}, fit it on a DataFrame')
+
+
+def load(source):
+    """
+    Load a spec from a model, a file of feature names or a comma separated
+    list of names, see the module docstring. Returns None for None.
+    """
+    if source is None or isinstance(source, FeatureSpec): return source
+    if not isinstance(source, (str, Path)): return FeatureSpec(model_features(source))
+    path = Path(source)
+    if not path.exists(): return FeatureSpec([n.strip() for n in str(source).split(',') if n.strip()])
+    suffix = path.suffix.lower()
+    if suffix == '.json':
+        with open(path) as f: return FeatureSpec(json.load(f))
+    if suffix in ('.txt', '.csv'):
+        return FeatureSpec([n for n in path.read_text().replace(',', '\n').split() if n])
+    if suffix == '.joblib':
+        import joblib
+        return FeatureSpec(model_features(joblib.load(path)))
+    from src import inference
+    return FeatureSpec(model_features(inference.load_model(path)))
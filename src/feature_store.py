@@ -0,0 +1,188 @@
+"""
+Compact, memory-mappable storage for the crown features.
+
+Segment metadata and geometry are kept in a small GeoParquet table per tile,
+and the features in a contiguous float32 (or float16) array per tile that can
+be memory-mapped. The feature names live in a schema file, so consumers
+select features by name instead of by column position.
+
+Layout of a store directory:
+
+    schema.json             feature names, bands, statistics and dtype
+    meta/{tile_id}.parquet  one row per segment
+    features/{tile_id}.npy  array of shape (n_segments, n_features)
+"""
+
+import os
+import re
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from src import geo_io, instrument, stats
+
+SCHEMA_FILE = 'schema.json'
+
+# Tiles of the test set, the tile columns 5, 6, 11 and 12 (see data_exploration.ipynb)
+TEST_TILES = r'C(5|6|11|12)$'
+
+
+def is_store(path):
+    "Whether `path` is a feature store directory"
+    return (Path(path)/SCHEMA_FILE).exists()
+
+
+class FeatureStore:
+    "A directory of per-tile feature arrays described by a shared schema"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/SCHEMA_FILE) as f:
+            self.schema = json.load(f)
+        self.columns = self.schema['columns']
+        self.dtype = np.dtype(self.schema['dtype'])
+        self._positions = {c: i for i, c in enumerate(self.columns)}
+
+    @classmethod
+    def create(cls, path, n_bands=461, statistics=stats.STATISTICS, dtype='float32', columns=None):
+        """
+        Create a store, or open it if one with the same schema already exists.
+
+        Parameters
+        ----------
+        path : The store directory
+        n_bands : Number of bands the statistics are computed for
+        statistics : The feature families, see stats.STATISTICS
+        dtype : float32 or float16
+        columns : The feature names, by default all statistics of all bands
+        """
+        path = Path(path)
+        if columns is None: columns = stats.feature_names(n_bands, statistics)
+        schema = {'columns': list(columns),
+                  'bands': sorted({stats.parse_feature_name(c)[1] for c in columns}),
+                  'statistics': [s for s in stats.STATISTICS if any(stats.parse_feature_name(c)[0] == s for c in columns)],
+                  'dtype': np.dtype(dtype).name}
+        if is_store(path):
+            store = cls(path)
+            if store.schema != schema: raise ValueError(f'A feature store with a different schema exists in {path}')
+            return store
+        os.makedirs(path/'meta', exist_ok=True)
+        os.makedirs(path/'features', exist_ok=True)
+        # Shards of a run may create the store at the same time
+        tmp = path/f'{SCHEMA_FILE}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(schema, f, indent=1)
+        os.replace(tmp, path/SCHEMA_FILE)
+        return cls(path)
+
+    @property
+    def tile_ids(self):
+        "Tiles with both metadata and features in the store"
+        return sorted(Path(f).stem for f in os.listdir(self.path/'features')
+                      if f.endswith('.npy') and not f.endswith('.tmp.npy')
+                      and self.meta_path(Path(f).stem).exists())
+
+    @instrument.timed('write')
+    def write_tile(self, tile_id, meta, features):
+        """
+        Store the segments and features of a tile. Files are written under
+        temporary names and moved in place, features last.
+
+        Parameters
+        ----------
+        tile_id : The tile
+        meta : A GeoDataFrame with one row per segment and no feature columns
+        features : An array or DataFrame of shape (n_segments, n_features) in schema order
+        """
+        if isinstance(features, pd.DataFrame): features = features[self.columns].values
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        if features.shape != (len(meta), len(self.columns)):
+            raise ValueError(f'Expected features of shape {(len(meta), len(self.columns))}, got {features.shape}')
+        geo_io.write_frame(meta, self.meta_path(tile_id))
+        feat_tmp = self.path/'features'/f'{tile_id}.tmp.npy'
+        np.save(feat_tmp, features)
+        os.replace(feat_tmp, self.feature_path(tile_id))
+
+    def meta(self, tile_id, columns=None):
+        "The segment metadata of a tile"
+        return geo_io.read_frame(self.meta_path(tile_id), columns=columns)
+
+    def meta_path(self, tile_id):
+        "Path of the segment metadata of a tile"
+        return self.path/'meta'/f'{tile_id}.parquet'
+
+    def feature_path(self, tile_id):
+        "Path of the feature array of a tile"
+        return self.path/'features'/f'{tile_id}.npy'
+
+    def features(self, tile_id, mmap=True):
+        "The feature array of a tile, memory-mapped read-only by default"
+        return np.load(self.feature_path(tile_id), mmap_mode='r' if mmap else None)
+
+    def column_index(self, names):
+        "Positions of the named features in the feature arrays"
+        return np.array([self._positions[n] for n in names], dtype=np.int64)
+
+    def select(self, tile_id, names=None):
+        """
+        Features of a tile restricted to `names`. Runs of consecutive columns,
+        such as all bands of one statistic, are returned as zero-copy views.
+        """
+        features = self.features(tile_id)
+        if names is None: return features
+        idx = self.column_index(names)
+        if len(idx) and np.all(np.diff(idx) == 1): return features[:, idx[0]:idx[-1]+1]
+        return features[:, idx]
+
+    def load(self, tile_ids=None, names=None):
+        """
+        Concatenate the metadata and features of several tiles.
+
+        Return
+        ------
+        meta : A GeoDataFrame of all segments
+        features : An array with one row per segment
+        """
+        if tile_ids is None: tile_ids = self.tile_ids
+        metas = [self.meta(t) for t in tile_ids]
+        features = [self.select(t, names) for t in tile_ids]
+        meta = pd.concat(metas, ignore_index=True) if metas else None
+        return meta, np.concatenate(features) if features else np.empty((0, len(names or self.columns)), self.dtype)
+
+    def to_frame(self, tile_id, names=None):
+        "A tile as a single GeoDataFrame with the metadata and feature columns"
+        names = self.columns if names is None else names
+        features = pd.DataFrame(self.select(tile_id, names), columns=names)
+        meta = self.meta(tile_id)
+        return pd.concat([meta, features.set_index(meta.index)], axis=1)
+
+
+def train_test(path, test_tiles=TEST_TILES, names=None):
+    """
+    The training and test sets of the store in `path`, split by tile. Missing
+    features are filled with the feature means of the training set.
+
+    Parameters
+    ----------
+    path : The store directory
+    test_tiles : A regular expression matching the ids of the test tiles
+    names : The features to load, all by default
+
+    Return
+    ------
+    train_info, train_features, test_info, test_features : The segment
+        metadata as GeoDataFrames and the features as DataFrames over the
+        loaded float arrays, with the feature names as columns
+    """
+    store = FeatureStore(path)
+    names = store.columns if names is None else list(names)
+    test = [t for t in store.tile_ids if re.search(test_tiles, t)]
+    train = [t for t in store.tile_ids if t not in set(test)]
+    train_info, train_features = store.load(train, names)
+    test_info, test_features = store.load(test, names)
+    means = np.nanmean(train_features, axis=0)
+    for features in (train_features, test_features):
+        missing = np.isnan(features)
+        features[missing] = np.broadcast_to(means, features.shape)[missing]
+    return (train_info, pd.DataFrame(train_features, columns=names, copy=False),
+            test_info, pd.DataFrame(test_features, columns=names, copy=False))
@@ -0,0 +1,187 @@
+"""
+Reading and writing the vector products passed between pipeline stages.
+
+GeoParquet is the default format for intermediate products. It supports
+reading a subset of the columns and skipping the row groups of other tiles
+when filtering by tile_id. GeoJSON (and any other format readable by
+geopandas) stays available, and the format is picked from the file suffix.
+"""
+
+import os
+import json
+from pathlib import Path
+import pandas as pd
+from pandas.api.types import is_integer_dtype
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src import instrument
+from src.manifest import atomic_path
+
+DEFAULT_FORMAT = 'parquet'
+
+# File suffix of each output format
+SUFFIXES = {'parquet': '.parquet', 'geojson': '.geojson'}
+
+# Suffixes recognised when listing the products of a stage, in order of preference
+VECTOR_SUFFIXES = ['.parquet', '.geoparquet', '.geojson', '.json', '.gpkg', '.shp']
+
+# Rows per parquet row group. Rows of a tile are written contiguously so that
+# the row group statistics of tile_id allow skipping other tiles.
+ROW_GROUP_SIZE = 50_000
+
+
+def is_parquet(path):
+    return Path(path).suffix.lower() in ('.parquet', '.geoparquet')
+
+
+def suffix(fmt):
+    "File suffix of an output format"
+    if fmt not in SUFFIXES: raise ValueError(f'Unknown format {fmt}, expected one of {list(SUFFIXES)}')
+    return SUFFIXES[fmt]
+
+
+@instrument.timed('read')
+def read_frame(path, columns=None, tile_ids=None):
+    """
+    Read a vector product in any supported format.
+
+    Parameters
+    ----------
+    path : The file to read
+    columns : Optional list of columns to read. A plain DataFrame is returned
+              if the geometry column is not included.
+    tile_ids : Optional list of tile ids, only rows of these tiles are returned
+
+    Return
+    ------
+    frame : A GeoDataFrame (or DataFrame, see `columns`)
+    """
+    if tile_ids is not None: tile_ids = [str(t) for t in tile_ids]
+    if is_parquet(path):
+        kwargs = {'filters': [('tile_id', 'in', tile_ids)]} if tile_ids is not None else {}
+        if columns is not None and 'geometry' not in columns:
+            return pd.read_parquet(path, columns=columns, **kwargs)
+        return gpd.read_parquet(path, columns=columns, **kwargs)
+
+    frame = gpd.read_file(path)
+    if tile_ids is not None: frame = frame[frame.tile_id.astype(str).isin(tile_ids)]
+    if columns is not None:
+        frame = frame[columns] if 'geometry' in columns else pd.DataFrame(frame[columns])
+    return frame
+
+
+@instrument.timed('write')
+def write_frame(frame, path):
+    """
+    Write a vector product, the format is picked from the suffix of `path`.
+    The file is written under a temporary name and moved in place.
+    """
+    path = Path(path)
+    if not is_parquet(path) and path.suffix.lower() not in ('.geojson', '.json'):
+        # Multi-file formats such as shapefiles are written in place
+        frame.to_file(filename=path)
+        return
+    with atomic_path(path) as tmp:
+        _write_frame(frame, path, tmp)
+
+
+def _write_frame(frame, path, tmp):
+    if is_parquet(path):
+        # Keep the index as a column in the same cases as the GeoJSON driver,
+        # so both formats read back with the same columns
+        named = any(name is not None for name in frame.index.names)
+        frame = frame.reset_index(drop=not (named or not is_integer_dtype(frame.index.dtype)))
+        # The GeoJSON driver returns the geometry as the last column
+        if isinstance(frame, gpd.GeoDataFrame):
+            geometry = frame.geometry.name
+            frame = frame[[c for c in frame.columns if c != geometry] + [geometry]]
+        frame.to_parquet(tmp, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        # The layer is named after the final file
+        frame.to_file(filename=tmp, driver='GeoJSON', layer=path.stem)
+
+
+def list_frames(directory):
+    """
+    List the vector products in a directory, one per file stem.
+    If a stem exists in several formats, GeoParquet is preferred.
+    """
+    directory = Path(directory)
+    found = {}
+    for f in sorted(os.listdir(directory)):
+        path = directory/f
+        # Skip unfinished files, see write_frame
+        if path.suffix.lower() not in VECTOR_SUFFIXES or path.stem.endswith('.tmp'): continue
+        rank = VECTOR_SUFFIXES.index(path.suffix.lower())
+        if path.stem not in found or rank < found[path.stem][0]:
+            found[path.stem] = (rank, path)
+    return [found[stem][1] for stem in sorted(found)]
+
+
+def find_frame(directory, stem):
+    "The product with the given stem in `directory`, preferring GeoParquet"
+    for s in VECTOR_SUFFIXES:
+        if (Path(directory)/f'{stem}{s}').exists(): return Path(directory)/f'{stem}{s}'
+    raise FileNotFoundError(f'No vector file {stem} in {directory}')
+
+
+def geo_metadata(geometry, crs):
+    "The GeoParquet metadata of a table with WKB geometries in the column `geometry`"
+    crs = crs.to_json_dict() if crs is not None else None
+    return {'version': '1.0.0', 'primary_column': geometry,
+            'columns': {geometry: {'encoding': 'WKB', 'geometry_types': [], 'crs': crs}}}
+
+
+class ParquetAppender:
+    """
+    Write a GeoParquet file in chunks as they become available.
+
+    The index of every chunk is kept as a column, so the original row order
+    can be restored with `sort_index` after reading. The file is written
+    under a temporary name and moved in place by `close`.
+
+        with ParquetAppender(path) as out:
+            for frame in frames: out.write(frame)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(f'{self.path.stem}.tmp{self.path.suffix}')
+        self.writer = None
+        self.rows = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None: self.close()
+        elif self.writer is not None:
+            self.writer.close()
+            os.remove(self.tmp)
+
+    def _table(self, frame):
+        geo = None
+        if isinstance(frame, gpd.GeoDataFrame):
+            geometry = frame.geometry.name
+            geo = geo_metadata(geometry, frame.crs)
+            frame = pd.DataFrame(frame.to_wkb())
+        table = pa.Table.from_pandas(frame, preserve_index=True)
+        if geo is not None:
+            table = table.replace_schema_metadata({**table.schema.metadata, b'geo': json.dumps(geo).encode()})
+        return table
+
+    @instrument.timed('write')
+    def write(self, frame):
+        "Append the rows of a (Geo)DataFrame"
+        table = self._table(frame)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp, table.schema)
+        elif not table.schema.equals(self.writer.schema, check_metadata=False):
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is None: return
+        self.writer.close()
+        os.replace(self.tmp, self.path)
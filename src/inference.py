@@ -0,0 +1,201 @@
+"""
+Species prediction without fastai.
+
+`export_learner` converts a trained fastai tabular MLP into a plain .npz
+file holding the input normalization, the linear layers and the batch-norm
+parameters. `NumpyMLP` loads such a file and predicts with batched float32
+matrix products, so inference workers only need NumPy.
+
+The .npz file contains
+
+    cont_names  the feature names in model input order
+    vocab       the class labels
+    ops         the layer types in order: fill, affine, linear or relu
+    {i}_w       weights of op i (per-feature fill value for fill, nan for none, per-feature
+                scale for affine, (in, out) matrix for linear)
+    {i}_b       bias of op i (per-feature shift for affine)
+"""
+
+import numpy as np
+
+# Rows per matrix product
+BATCH_SIZE = 65536
+
+
+def _numpy(x):
+    "Convert a tensor, array or scalar to a flat float64 array"
+    if hasattr(x, 'detach'): x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=np.float64).reshape(-1)
+
+
+def _proc_stats(values, names):
+    "Per-feature values of a fastai proc, stored either by name or by position"
+    if isinstance(values, dict): return np.array([float(_numpy(values[n])[0]) for n in names])
+    values = _numpy(values)
+    return np.broadcast_to(values, (len(names),)).copy() if values.size == 1 else values
+
+
+def _batchnorm(bn):
+    "The eval-mode batch norm as a (scale, shift) pair"
+    scale = 1 / np.sqrt(_numpy(bn.running_var) + bn.eps)
+    shift = -_numpy(bn.running_mean) * scale
+    if bn.affine:
+        weight = _numpy(bn.weight)
+        scale, shift = scale * weight, shift * weight + _numpy(bn.bias)
+    return scale, shift
+
+
+def export_learner(learner, path):
+    """
+    Export a fastai tabular learner with continuous inputs only.
+
+    Parameters
+    ----------
+    learner : A fastai TabularLearner, e.g. from `load_learner`
+    path : The .npz file to write
+    """
+    import torch.nn as nn
+
+    dls = learner.dls
+    names = list(dls.cont_names)
+    ops = []
+
+    # Preprocessing of the continuous variables, missing values are filled
+    # with the training values before the normalization
+    for proc in dls.procs:
+        kind = type(proc).__name__
+        if kind == 'Normalize':
+            mean, std = _proc_stats(proc.means, names), _proc_stats(proc.stds, names)
+            ops.append(('affine', 1 / std, -mean / std))
+        elif kind == 'FillMissing':
+            na_dict = dict(getattr(proc, 'na_dict', {}))
+            if na_dict and getattr(proc, 'add_col', True):
+                raise ValueError(f'The missing value indicators of FillMissing are not supported: '
+                                 f'{[f"{n}_na" for n in na_dict]}, train with FillMissing(add_col=False)')
+            if na_dict:
+                fill = np.array([float(_numpy(na_dict[n])[0]) if n in na_dict else np.nan for n in names])
+                ops.insert(0, ('fill', fill, None))
+        elif kind != 'Categorify':
+            raise ValueError(f'Unsupported preprocessing step {kind}')
+    if len(dls.cat_names): raise ValueError(f'Categorical inputs are not supported: {list(dls.cat_names)}')
+
+    model = learner.model.eval()
+    if getattr(model, 'n_cont', 0) and getattr(model, 'bn_cont', None) is not None:
+        ops.append(('affine', *_batchnorm(model.bn_cont)))
+    for layer in model.layers.modules():
+        if len(list(layer.children())): continue
+        if isinstance(layer, nn.Linear):
+            bias = _numpy(layer.bias) if layer.bias is not None else np.zeros(layer.out_features)
+            ops.append(('linear', layer.weight.detach().cpu().numpy().T.astype(np.float64), bias))
+        elif isinstance(layer, nn.BatchNorm1d):
+            ops.append(('affine', *_batchnorm(layer)))
+        elif isinstance(layer, nn.ReLU):
+            ops.append(('relu', None, None))
+        elif not isinstance(layer, nn.Dropout):
+            raise ValueError(f'Unsupported layer {type(layer).__name__}')
+
+    arrays = {'cont_names': np.array(names, dtype=str),
+              'vocab': np.array([str(v) for v in dls.vocab], dtype=str),
+              'ops': np.array([op for op, _, _ in ops], dtype=str)}
+    for i, (op, w, b) in enumerate(ops):
+        if op == 'relu': continue
+        arrays[f'{i}_w'] = w
+        if b is not None: arrays[f'{i}_b'] = b
+    np.savez(path, **arrays)
+
+
+def _compile(ops, dtype):
+    """
+    Fold every affine op into the following linear layer, leaving a sequence
+    of fill, linear and relu ops (plus a trailing affine, if any).
+    """
+    layers = []
+    scale = shift = None
+    for op, w, b in ops:
+        if op == 'fill':
+            if scale is not None: layers.append(('affine', scale.astype(dtype), shift.astype(dtype)))
+            scale = shift = None
+            layers.append(('fill', w.astype(dtype), None))
+        elif op == 'affine':
+            scale, shift = (w, b) if scale is None else (scale * w, shift * w + b)
+        elif op == 'linear':
+            if scale is not None:
+                w, b = scale[:, None] * w, shift @ w + b
+                scale = shift = None
+            layers.append(('linear', w.astype(dtype), b.astype(dtype)))
+        else:
+            if scale is not None: layers.append(('affine', scale.astype(dtype), shift.astype(dtype)))
+            scale = shift = None
+            layers.append(('relu', None, None))
+    if scale is not None: layers.append(('affine', scale.astype(dtype), shift.astype(dtype)))
+    return layers
+
+
+class NumpyMLP:
+    "An MLP exported with `export_learner`"
+
+    def __init__(self, cont_names, vocab, ops, dtype=np.float32):
+        self.cont_names = list(cont_names)
+        self.vocab = np.asarray(vocab)
+        self.dtype = np.dtype(dtype)
+        self.layers = _compile(ops, self.dtype)
+
+    @classmethod
+    def load(cls, path, dtype=np.float32):
+        with np.load(path) as f:
+            ops = [(op, f.get(f'{i}_w'), f.get(f'{i}_b')) for i, op in enumerate(f['ops'])]
+            return cls(f['cont_names'], f['vocab'], ops, dtype)
+
+    def _inputs(self, features):
+        "The model inputs as an array, selecting DataFrame columns by name"
+        if hasattr(features, 'columns'): features = features[self.cont_names].to_numpy()
+        if features.shape[1] != len(self.cont_names):
+            raise ValueError(f'Expected {len(self.cont_names)} features, got {features.shape[1]}')
+        return features
+
+    def logits(self, features, batch_size=BATCH_SIZE):
+        "The outputs of the final layer, computed `batch_size` rows at a time"
+        features = self._inputs(features)
+        out = np.empty((len(features), len(self.vocab)), dtype=self.dtype)
+        for start in range(0, len(features), batch_size):
+            x = np.asarray(features[start:start+batch_size], dtype=out.dtype)
+            for op, w, b in self.layers:
+                if op == 'linear': x = x @ w + b
+                elif op == 'affine': x = x * w + b
+                elif op == 'fill': x = np.where(np.isnan(x), w, x)
+                else: np.maximum(x, 0, out=x)
+            out[start:start+batch_size] = x
+        return out
+
+    def predict_proba(self, features, batch_size=BATCH_SIZE):
+        "Class probabilities, the columns follow `vocab`"
+        x = self.logits(features, batch_size)
+        x = np.exp(x - x.max(axis=1, keepdims=True))
+        return x / x.sum(axis=1, keepdims=True)
+
+    def predict(self, features, batch_size=BATCH_SIZE):
+        "The predicted class label of each row"
+        return self.vocab[np.argmax(self.logits(features, batch_size), axis=1)]
+
+
+def load_model(path):
+    "Load an exported .npz model, or a fastai learner from any other file"
+    if str(path).endswith('.npz'): return NumpyMLP.load(path)
+    from fastai.tabular.all import load_learner
+    return load_learner(path)
+
+
+# The model of a worker process, loaded once by init_worker
+_worker_model = None
+
+
+def init_worker(path):
+    "Pool initializer loading the model of a worker process"
+    global _worker_model
+    _worker_model = load_model(path)
+
+
+def worker_model():
+    "The model loaded by init_worker in this process"
+    if _worker_model is None: raise RuntimeError('No model loaded, use init_worker as the pool initializer')
+    return _worker_model
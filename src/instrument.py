@@ -0,0 +1,229 @@
+"""
+Structured timing events for the pipeline stages.
+
+Every task of a stage, usually a tile or a batch of its trees, runs inside
+`task` and emits one JSON line when it finishes, with the wall time spent in
+each phase, the crowns and pixels it processed and the memory of the worker:
+
+    {"event": "task", "stage": "features", "tile": "R1C1", "pid": 4711,
+     "start": 1700000000.0, "seconds": 12.3,
+     "phases": {"read": 4.1, "mask": 2.0, "stats": 5.9},
+     "crowns": 2000, "pixels": 81234, "bytes_read": 1234567,
+     "rss_mb": 812.4, "max_rss_mb": 1024.0}
+
+The library code marks its phases with `phase` or `timed`, which cost next to
+nothing outside a task. Nested phases are charged to the outermost one, and
+the time outside any phase is reported as "other" in the summary.
+
+An entry point calls `configure` once, which makes its workers append their
+events to `{out_dir}/.events/{stage}-{time}-{pid}.jsonl` as well as print
+them, and `summary` at the end. The settings travel to the workers in
+environment variables, so they also reach pools started after `configure`.
+Given a tile id, the tasks of that tile also run under cProfile and dump
+their statistics next to the events.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import cProfile
+import pstats
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+import pandas as pd
+
+EVENTS_DIR = '.events'
+
+# Environment variables passing the settings to the workers
+EVENTS_ENV = 'EVO_EVENTS'
+PROFILE_ENV = 'EVO_PROFILE_TILE'
+
+# Column order of the phases in the summary, others follow alphabetically
+PHASES = ('read', 'mask', 'normalize', 'stats', 'segment', 'vectorize', 'match', 'predict', 'write')
+
+# Functions listed when printing a profile
+PROFILE_LINES = 25
+
+# The tasks running in this process, innermost last
+_tasks = []
+
+
+def rss_mb():
+    "Current and peak resident set size of this process in MB"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        current = peak
+    return current, peak
+
+
+def configure(out_dir, stage, profile_tile=None):
+    """
+    Record the events of a run of `stage` under `out_dir`, and profile the
+    tasks of `profile_tile` if given. Returns the path of the events file.
+    """
+    path = Path(out_dir)/EVENTS_DIR/f'{stage}-{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}.jsonl'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.environ[EVENTS_ENV] = str(path)
+    if profile_tile is None: os.environ.pop(PROFILE_ENV, None)
+    else: os.environ[PROFILE_ENV] = str(profile_tile)
+    return path
+
+
+def emit(event):
+    "Print an event as a single line and append it to the events file of the run"
+    line = json.dumps(event, default=str) + '\n'
+    # One write per line keeps the lines of concurrent workers apart
+    sys.stdout.write(line)
+    sys.stdout.flush()
+    path = os.environ.get(EVENTS_ENV)
+    if path:
+        with open(path, 'a') as f: f.write(line)
+
+
+class Task:
+    "Phase times and counters of a running task"
+
+    def __init__(self, stage, tile_id, counts):
+        self.stage, self.tile_id = stage, str(tile_id)
+        self.phases = defaultdict(float)
+        self.counts = defaultdict(int, counts)
+        self.active = None
+
+    def event(self, start, seconds):
+        current, peak = rss_mb()
+        return {'event': 'task', 'stage': self.stage, 'tile': self.tile_id, 'pid': os.getpid(),
+                'start': round(start, 3), 'seconds': round(seconds, 4),
+                'phases': {k: round(v, 4) for k, v in self.phases.items()},
+                **self.counts, 'rss_mb': round(current, 1), 'max_rss_mb': round(peak, 1)}
+
+
+@contextmanager
+def task(stage, tile_id, **counts):
+    """
+    Time a task of `stage` on the tile `tile_id` and emit its event when it
+    finishes, also when it fails. `counts` are reported with the event, like
+    the ones added with `count` while the task runs.
+    """
+    t = Task(stage, tile_id, counts)
+    profile_tile = os.environ.get(PROFILE_ENV)
+    profiler = cProfile.Profile() if profile_tile == t.tile_id else None
+    _tasks.append(t)
+    start, begin = time.time(), time.perf_counter()
+    error = None
+    if profiler is not None: profiler.enable()
+    try:
+        yield t
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiler is not None: profiler.disable()
+        _tasks.pop()
+        event = t.event(start, time.perf_counter() - begin)
+        if error is not None: event['error'] = error
+        if profiler is not None: event['profile'] = str(_dump_profile(profiler, t))
+        emit(event)
+
+
+def _dump_profile(profiler, t):
+    "Write the statistics of a profiled task and print its hottest functions"
+    events = os.environ.get(EVENTS_ENV)
+    folder = Path(events).parent if events else Path('.')
+    path = folder/f'{t.stage}-{t.tile_id}-{os.getpid()}-{time.time_ns()}.prof'
+    profiler.dump_stats(path)
+    report = pstats.Stats(profiler, stream=sys.stdout)
+    print(f'Profile of {t.stage} on tile {t.tile_id}, written to {path}')
+    report.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    sys.stdout.flush()
+    return path
+
+
+@contextmanager
+def phase(name):
+    "Charge the time of the block to phase `name` of the running task"
+    t = _tasks[-1] if _tasks else None
+    if t is None or t.active is not None:
+        yield
+        return
+    t.active = name
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        t.phases[name] += time.perf_counter() - begin
+        t.active = None
+
+
+def timed(name):
+    "Decorator charging the calls of a function to phase `name`, see `phase`"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _tasks: return func(*args, **kwargs)
+            with phase(name): return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(**counts):
+    "Add to the counters of the running task, e.g. count(crowns=10, pixels=321)"
+    if not _tasks: return
+    for k, v in counts.items(): _tasks[-1].counts[k] += int(v)
+
+
+def read_events(path):
+    "The task events of an events file as a DataFrame with one column per phase"
+    path = Path(path)
+    if not path.exists(): return pd.DataFrame()
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events = [e for e in events if e.get('event') == 'task']
+    if not events: return pd.DataFrame()
+    phases = pd.DataFrame([e.pop('phases') for e in events]).fillna(0.0)
+    return pd.concat([pd.DataFrame(events), phases.add_prefix('phase_')], axis=1)
+
+
+def summary(path, slowest=5):
+    """
+    Print a table summarising the events of a run per stage, and the slowest
+    tiles. The phase columns and "other" hold seconds summed over all tasks.
+
+    Return
+    ------
+    table : The summary as a DataFrame, empty if there were no events
+    """
+    events = read_events(path)
+    if events.empty: return events
+    names = [c[len('phase_'):] for c in events.columns if c.startswith('phase_')]
+    names = [p for p in PHASES if p in names] + sorted(p for p in names if p not in PHASES)
+    for c in ('crowns', 'pixels', 'bytes_read'):
+        if c not in events.columns: events[c] = 0
+    events[['crowns', 'pixels', 'bytes_read']] = events[['crowns', 'pixels', 'bytes_read']].fillna(0)
+    events['end'] = events.start + events.seconds
+
+    rows = []
+    for stage, e in events.groupby('stage', sort=False):
+        row = {'stage': stage, 'tasks': len(e), 'tiles': e.tile.nunique(),
+               'crowns': int(e.crowns.sum()), 'pixels': int(e.pixels.sum()),
+               'read_mb': round(e.bytes_read.sum() / 2**20, 1),
+               'wall_s': round(e.end.max() - e.start.min(), 1), 'task_s': round(e.seconds.sum(), 1)}
+        for p in names: row[p] = round(e[f'phase_{p}'].sum(), 1)
+        row['other'] = round(e.seconds.sum() - sum(e[f'phase_{p}'].sum() for p in names), 1)
+        row['crowns_per_s'] = round(e.crowns.sum() / max(e.seconds.sum(), 1e-9), 1)
+        row['max_rss_mb'] = round(e.max_rss_mb.max(), 1)
+        if 'error' in e.columns: row['errors'] = int(e.error.notna().sum())
+        rows.append(row)
+    table = pd.DataFrame(rows).set_index('stage')
+
+    print(table.to_string())
+    tiles = events.groupby('tile').seconds.sum().sort_values(ascending=False)
+    print('Slowest tiles: ' + ', '.join(f'{t} {s:.1f} s' for t, s in tiles.head(slowest).items()))
+    print(f'Events written to {path}')
+    return table
@@ -0,0 +1,153 @@
+"""
+Run manifests for resuming interrupted pipeline stages.
+
+Every finished tile of a stage gets a small JSON record in
+`{out_dir}/.manifest/{stage}/{tile_id}.json` holding the size, modification
+time and blake2b hash of each input, the stage parameters and the outputs.
+A rerun skips the tiles whose record still matches: inputs are only rehashed
+when their size or modification time changed, and outputs must still exist
+with the recorded size. Records and outputs are written under temporary names
+and moved in place, so a killed job never leaves a file that looks complete.
+"""
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+MANIFEST_DIR = '.manifest'
+
+# Bytes read at a time when hashing
+CHUNK_SIZE = 16 * 2**20
+
+# Hashes computed in this process, keyed by (path, size, mtime_ns)
+_hash_cache = {}
+
+
+def file_hash(path):
+    "The blake2b digest of a file"
+    path = Path(path)
+    st = path.stat()
+    key = (str(path.resolve()), st.st_size, st.st_mtime_ns)
+    if key not in _hash_cache:
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''): h.update(chunk)
+        _hash_cache[key] = h.hexdigest()
+    return _hash_cache[key]
+
+
+def file_record(path, hash=True):
+    "Size, modification time and (optionally) hash of a file"
+    st = os.stat(path)
+    record = {'path': str(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if hash: record['blake2b'] = file_hash(path)
+    return record
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path next to `path` with the same suffix, and move it
+    to `path` once the block finishes without an exception.
+    """
+    path = Path(path)
+    tmp = path.with_name(f'{path.stem}.tmp{path.suffix}')
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists(): os.remove(tmp)
+
+
+def _json(value):
+    "Normalise parameters to what they read back as from JSON"
+    return json.loads(json.dumps(value, default=str))
+
+
+class Manifest:
+    "The records of the finished tiles of one stage"
+
+    def __init__(self, out_dir, stage, params=None):
+        """
+        Parameters
+        ----------
+        out_dir : The output directory of the stage
+        stage : The name of the stage
+        params : The parameters affecting the outputs, a JSON-serialisable dict
+        """
+        self.dir = Path(out_dir)/MANIFEST_DIR/stage
+        self.stage = stage
+        self.params = _json(params or {})
+
+    def path(self, tile_id):
+        return self.dir/f'{tile_id}.json'
+
+    def load(self, tile_id):
+        "The record of a tile, or None"
+        try:
+            with open(self.path(tile_id)) as f: return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_current(self, tile_id, inputs, outputs):
+        """
+        Whether a tile was finished with the same parameters and inputs, and
+        its outputs are still in place.
+
+        Parameters
+        ----------
+        tile_id : The tile
+        inputs : A dict of input name to path
+        outputs : A list of output paths, or None to check the recorded outputs
+        """
+        record = self.load(tile_id)
+        if record is None or record['params'] != self.params: return False
+        if outputs is None: outputs = [o['path'] for o in record['outputs']]
+        if set(record['inputs']) != set(inputs) or len(record['outputs']) != len(outputs): return False
+        for name, path in inputs.items():
+            old = record['inputs'][name]
+            try: st = os.stat(path)
+            except FileNotFoundError: return False
+            if (st.st_size, st.st_mtime_ns) == (old['size'], old['mtime_ns']): continue
+            if st.st_size != old['size'] or file_hash(path) != old['blake2b']: return False
+        for path, old in zip(outputs, record['outputs']):
+            if str(path) != old['path']: return False
+            try:
+                if os.stat(path).st_size != old['size']: return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def input_records(self, inputs):
+        "File records of the inputs, e.g. computed by a worker before the tile is recorded"
+        return {name: file_record(path) for name, path in inputs.items()}
+
+    def record(self, tile_id, inputs, outputs):
+        """
+        Record a finished tile, see `is_current`. The inputs are given as
+        paths or as records from `input_records`.
+        """
+        record = {'tile_id': str(tile_id), 'stage': self.stage, 'params': self.params,
+                  'inputs': {name: p if isinstance(p, dict) else file_record(p) for name, p in inputs.items()},
+                  'outputs': [file_record(path, hash=False) for path in outputs],
+                  'finished': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        os.makedirs(self.dir, exist_ok=True)
+        with atomic_path(self.path(tile_id)) as tmp:
+            with open(tmp, 'w') as f: json.dump(record, f, indent=1)
+
+    def pending(self, tasks, force=False):
+        """
+        The tasks whose tile is not up to date.
+
+        Parameters
+        ----------
+        tasks : A list of (tile_id, inputs, outputs, ...) tuples
+        force : Return all tasks
+        """
+        if force: return list(tasks)
+        todo = [t for t in tasks if not self.is_current(*t[:3])]
+        if len(todo) < len(tasks): print(f'Skipping {len(tasks) - len(todo)} up-to-date tiles of {self.stage}')
+        return todo
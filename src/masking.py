@@ -0,0 +1,180 @@
+"""
+Rasterized crown masks on the hyperspectral tile grid.
+
+A pixel belongs to a crown when its centre lies strictly inside the crown
+polygon, which is the same rule as the former per-pixel
+``Point(x, y).within(crown)`` test. All crowns of a tile are resolved with a
+single vectorized shapely call instead of one Point object per pixel.
+"""
+
+import numpy as np
+import shapely
+from src import instrument
+
+
+def pixel_centres(transform, width, height):
+    """
+    Pixel centre coordinates of a north-up raster, computed the same way as
+    rioxarray computes the x and y coordinates of a tile
+    """
+    transform = transform * transform.translation(0.5, 0.5)
+    xs, _ = transform * (np.arange(width), np.zeros(width))
+    _, ys = transform * (np.zeros(height), np.arange(height))
+    return np.asarray(xs), np.asarray(ys)
+
+
+def bbox_windows(bounds, xs, ys):
+    """
+    Convert coordinate bounding boxes to pixel windows.
+
+    The window of a box contains every pixel whose centre lies within the box
+    (edges included), matching ``tile.sel(y=slice(ymax, ymin), x=slice(xmin, xmax))``.
+
+    Parameters
+    ----------
+    bounds : An array of shape (n, 4) containing xmin, ymin, xmax, ymax
+    xs : Increasing pixel centre x coordinates of the tile
+    ys : Decreasing pixel centre y coordinates of the tile
+
+    Return
+    ------
+    windows : An integer array of shape (n, 4) containing row_start, row_stop,
+              col_start and col_stop of each box
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    windows = np.empty((len(bounds), 4), dtype=np.int64)
+    windows[:,0] = np.searchsorted(-ys, -bounds[:,3], side='left')
+    windows[:,1] = np.searchsorted(-ys, -bounds[:,1], side='right')
+    windows[:,2] = np.searchsorted(xs, bounds[:,0], side='left')
+    windows[:,3] = np.searchsorted(xs, bounds[:,2], side='right')
+    # Boxes entirely outside the tile give stop < start, clip them to empty windows
+    windows[:,1] = np.maximum(windows[:,1], windows[:,0])
+    windows[:,3] = np.maximum(windows[:,3], windows[:,2])
+    return windows
+
+
+def crown_windows(geometries, xs, ys):
+    "Pixel windows covering the bounding box of each crown"
+    return bbox_windows(shapely.bounds(np.asarray(geometries)), xs, ys)
+
+
+def window_mask(geometry, window, xs, ys):
+    """
+    Boolean mask of the pixels in `window` whose centre is inside `geometry`.
+    The window does not need to be the bounding box of the geometry.
+    """
+    r0, r1, c0, c1 = window
+    return shapely.contains_xy(geometry, xs[None,c0:c1], ys[r0:r1,None])
+
+
+@instrument.timed('mask')
+def crown_pixels(geometries, xs, ys, windows=None):
+    """
+    Find the pixels of every crown in a tile with one point-in-polygon pass.
+
+    Overlapping crowns each keep their own copy of the shared pixels, so the
+    result is exact even where neighbouring convex hulls intersect.
+
+    Parameters
+    ----------
+    geometries : A sequence of crown polygons
+    xs, ys : Pixel centre coordinates of the tile
+    windows : Precomputed crown windows, see `crown_windows`
+
+    Return
+    ------
+    labels : The position of the crown in `geometries` for each pixel, sorted
+    rows, cols : The row and column of each pixel in the tile
+    """
+    geometries = np.asarray(geometries)
+    if windows is None: windows = crown_windows(geometries, xs, ys)
+    heights = windows[:,1] - windows[:,0]
+    widths = windows[:,3] - windows[:,2]
+    sizes = heights * widths
+    total = int(sizes.sum())
+
+    # Enumerate the candidate pixels of every bounding box at once
+    labels = np.repeat(np.arange(len(geometries)), sizes)
+    local = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    w = np.repeat(widths, sizes)
+    rows = np.repeat(windows[:,0], sizes) + local // np.maximum(w, 1)
+    cols = np.repeat(windows[:,2], sizes) + local % np.maximum(w, 1)
+
+    inside = shapely.contains_xy(geometries[labels], xs[cols], ys[rows])
+    return labels[inside], rows[inside], cols[inside]
+
+
+def crown_offsets(labels, n_crowns):
+    "Start offsets of each crown in the sorted `labels` array, with a final end offset"
+    return np.searchsorted(labels, np.arange(n_crowns + 1))
+
+
+def pixel_windows(labels, rows, cols, n_crowns):
+    "Pixel windows covering the given pixels of each crown, empty for crowns without pixels"
+    offsets = crown_offsets(labels, n_crowns)
+    windows = np.zeros((n_crowns, 4), dtype=np.int64)
+    has_pixels = np.diff(offsets) > 0
+    starts = offsets[:-1][has_pixels]
+    if len(starts):
+        windows[has_pixels,0] = np.minimum.reduceat(rows, starts)
+        windows[has_pixels,1] = np.maximum.reduceat(rows, starts) + 1
+        windows[has_pixels,2] = np.minimum.reduceat(cols, starts)
+        windows[has_pixels,3] = np.maximum.reduceat(cols, starts) + 1
+    return windows
+
+
+def crown_masks(geometries, xs, ys):
+    """
+    Yield the pixel window and the boolean crown mask within that window for
+    each crown, in input order. All masks come from a single `crown_pixels` pass.
+    """
+    geometries = np.asarray(geometries)
+    windows = crown_windows(geometries, xs, ys)
+    labels, rows, cols = crown_pixels(geometries, xs, ys, windows)
+    offsets = crown_offsets(labels, len(geometries))
+    for i, (r0, r1, c0, c1) in enumerate(windows):
+        mask = np.zeros((r1 - r0, c1 - c0), dtype=bool)
+        start, stop = offsets[i], offsets[i+1]
+        mask[rows[start:stop] - r0, cols[start:stop] - c0] = True
+        yield windows[i], mask
+
+
+@instrument.timed('mask')
+def window_masks(geometries, windows, xs, ys, pixels=None):
+    """
+    Boolean crown masks within windows of equal size, one per crown, from a
+    single `crown_pixels` pass. Same as stacking `window_mask` for each crown.
+    The crown pixels can also be given as `pixels`, e.g. from `rle.decode`.
+
+    Return
+    ------
+    masks : An array of shape (n, rows, cols)
+    """
+    geometries = np.asarray(geometries)
+    windows = np.asarray(windows).reshape(-1, 4)
+    h = int(windows[0,1] - windows[0,0]) if len(windows) else 0
+    w = int(windows[0,3] - windows[0,2]) if len(windows) else 0
+    masks = np.zeros((len(windows), h, w), dtype=bool)
+    labels, rows, cols = crown_pixels(geometries, xs, ys) if pixels is None else pixels
+    rows, cols = rows - windows[labels,0], cols - windows[labels,2]
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    masks[labels[inside], rows[inside], cols[inside]] = True
+    return masks
+
+
+def label_raster(labels, rows, cols, shape):
+    """
+    Burn crown pixels into a single integer raster aligned with the tile.
+    Crown i is stored as i+1 and background as 0. Where crowns overlap the
+    crown appearing later in the input wins.
+    """
+    raster = np.zeros(shape, dtype=np.int32)
+    raster[rows, cols] = labels + 1
+    return raster
+
+
+def mask_outside(cropped, mask):
+    "Return a copy of a (bands, rows, cols) window with pixels outside the mask set to nan"
+    cropped = np.array(cropped, copy=True)
+    cropped[:, ~mask] = np.nan
+    return cropped
@@ -0,0 +1,80 @@
+"""
+Matching of delineated crowns with field-measured reference trees.
+
+A crown is matched with the reference trees located within its polygon. If
+several trees are within the crown, GPS-measured trees are preferred and the
+tree closest to the detected treetop is selected. The point-in-polygon test is
+done for all crowns of a tile at once through an STRtree over the field trees.
+"""
+
+import numpy as np
+import shapely
+from src import instrument
+
+# Columns taken from the field data and the names they get in the matched crowns
+FIELD_COLUMNS = ['tree_X', 'tree_Y', 'species', 'DBH', 'sum_2019', 'nov_2019', 'is_gps']
+MATCH_COLUMNS = ['meas_x', 'meas_y', 'species', 'dbh', 'sum_2019', 'nov_2019', 'is_gps']
+
+
+def field_index(field_trees):
+    "An STRtree over the field tree locations, for repeated `trees_in_bbox` lookups"
+    return shapely.STRtree(shapely.points(field_trees.tree_X.values, field_trees.tree_Y.values))
+
+
+def trees_in_bbox(field_trees, xdims, ydims, index=None):
+    """
+    Select the field trees within a closed bounding box, in their original order.
+
+    Parameters
+    ----------
+    field_trees : A DataFrame containing the columns tree_X and tree_Y
+    xdims, ydims : (min, max) tuples of the box
+    index : Optional `field_index` of field_trees, reused between calls
+
+    Return
+    ------
+    trees : The trees with xmin <= tree_X <= xmax and ymin <= tree_Y <= ymax
+    """
+    if index is None: index = field_index(field_trees)
+    # The envelope of a point intersects the box exactly when the point is within the closed box
+    candidates = index.query(shapely.box(xdims[0], ydims[0], xdims[1], ydims[1]))
+    return field_trees.iloc[np.sort(candidates)]
+
+
+@instrument.timed('match')
+def match_crowns(crowns, field_plot):
+    """
+    Match every crown with at most one field tree.
+
+    Gives the same result as applying `utils.label_contours` to each crown:
+    trees must be strictly within the crown polygon, GPS-measured trees
+    (is_gps == 1) take priority over others and ties in the distance to the
+    treetop are resolved by the order of the field trees.
+
+    Parameters
+    ----------
+    crowns : A GeoDataFrame of crowns containing the columns ttop_x and ttop_y
+    field_plot : A DataFrame containing the FIELD_COLUMNS
+
+    Return
+    ------
+    matched : A DataFrame with the MATCH_COLUMNS indexed like `crowns`, with
+              missing values for crowns without a match
+    """
+    tree_x = field_plot.tree_X.values
+    tree_y = field_plot.tree_Y.values
+    index = shapely.STRtree(shapely.points(tree_x, tree_y))
+    crown_idx, tree_idx = index.query(crowns.geometry.values, predicate='contains')
+
+    # Rank the candidates of each crown: GPS first, then distance, then field order
+    dist = np.sqrt((tree_x[tree_idx] - crowns.ttop_x.values[crown_idx])**2 +
+                   (tree_y[tree_idx] - crowns.ttop_y.values[crown_idx])**2)
+    not_gps = field_plot.is_gps.values[tree_idx] != 1
+    order = np.lexsort((tree_idx, dist, not_gps, crown_idx))
+    crown_idx, tree_idx = crown_idx[order], tree_idx[order]
+    first = np.r_[True, crown_idx[1:] != crown_idx[:-1]] if len(crown_idx) else np.zeros(0, dtype=bool)
+
+    matched = field_plot.iloc[tree_idx[first]][FIELD_COLUMNS]
+    matched.columns = MATCH_COLUMNS
+    matched.index = crowns.index[crown_idx[first]]
+    return matched.reindex(crowns.index)
@@ -0,0 +1,181 @@
+"""
+Band masks and per-pixel normalization of the spectra.
+
+A `Normalization` leaves out bands, such as the interpolated bands of the
+water vapour absorption regions or the CHM, and normalizes the spectrum of
+every pixel with SNV or by its sum (Dalponte et al. 2016). It is applied to
+the pixels right after they are read, so the feature statistics and the cubes
+are computed over normalized values without rewriting the tiles. The CHM band
+can be kept, in which case it is passed through unchanged and does not count
+towards the spectrum.
+
+The pixels are normalized in float32 chunks of at most CHUNK_PIXELS pixels,
+so the temporaries stay small however large the input is.
+"""
+
+import numpy as np
+import rasterio
+from src import instrument, segmentation, stats
+
+METHODS = ('snv', 'sum')
+
+# Pixels normalized at a time
+CHUNK_PIXELS = 2**16
+
+# Atmospheric water vapour absorption regions in nm, where the preprocessing
+# interpolated the bands instead of discarding them
+WATER_VAPOUR = ((1340.0, 1460.0), (1790.0, 1960.0))
+
+
+def wavelengths():
+    "The centre wavelengths in nm of the 460 spectral bands, 186 VNIR and 274 SWIR bands"
+    vnir = np.linspace(406, 995, 187)
+    swir = np.linspace(956, 2525, 289)
+    return np.hstack([(vnir[1:] + vnir[:-1]) / 2, ((swir[1:] + swir[:-1]) / 2)[:274]])
+
+
+def interpolated_bands(regions=WATER_VAPOUR):
+    "The 1-based bands with the centre wavelength in one of the regions"
+    wl = wavelengths()
+    inside = np.zeros(len(wl), dtype=bool)
+    for lo, hi in regions: inside |= (wl >= lo) & (wl <= hi)
+    return [int(b) + 1 for b in np.flatnonzero(inside)]
+
+
+def parse_bands(text):
+    """
+    The bands of a comma separated list of band numbers, ranges and names,
+    e.g. 'interpolated,1-5,460'
+    """
+    bands = set()
+    for token in str(text).split(','):
+        token = token.strip()
+        if not token: continue
+        if token == 'interpolated': bands.update(interpolated_bands())
+        elif '-' in token:
+            lo, hi = (int(t) for t in token.split('-'))
+            bands.update(range(lo, hi + 1))
+        else: bands.add(int(token))
+    return sorted(bands)
+
+
+def band_count(tile_fn):
+    "The number of bands in a tile"
+    with rasterio.open(tile_fn) as src: return src.count
+
+
+@instrument.timed('normalize')
+def normalize(values, method, axis=-1, spectral=None, chunk_pixels=CHUNK_PIXELS):
+    """
+    Normalize the spectrum of every pixel.
+
+    Parameters
+    ----------
+    values : An array with the bands along `axis`
+    method : 'snv' subtracts the mean of the spectrum and divides by its
+             (population) standard deviation, 'sum' divides by its sum
+    spectral : Boolean mask of the bands forming the spectrum, all by default.
+               The other bands are copied unchanged.
+    chunk_pixels : The number of pixels normalized at a time
+
+    Return
+    ------
+    normalized : A new float32 array of the shape of `values`
+    """
+    if method not in METHODS: raise ValueError(f'Unknown normalization {method}, expected one of {METHODS}')
+    values = np.asarray(values)
+    out = np.empty(values.shape, dtype=np.float32)
+    src, dst = np.moveaxis(values, axis, -1), np.moveaxis(out, axis, -1)
+    if src.ndim == 1: src, dst = src[None], dst[None]
+    n_bands = src.shape[-1]
+    weights = np.ones(n_bands, np.float32) if spectral is None else np.asarray(spectral, dtype=np.float32)
+    n = weights.sum()
+    other = np.flatnonzero(weights == 0)
+
+    # Chunks along the first remaining axis
+    per_row = int(np.prod(src.shape[1:-1]))
+    step = max(1, chunk_pixels // max(per_row, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(0, src.shape[0], step):
+            chunk = np.array(src[i:i + step], dtype=np.float32, order='C')
+            flat = chunk.reshape(-1, n_bands)
+            if method == 'snv':
+                flat -= (flat @ weights / n)[:, None]
+                flat /= np.sqrt(np.einsum('ij,ij,j->i', flat, flat, weights) / n)[:, None]
+            else:
+                flat /= (flat @ weights)[:, None]
+            if len(other): chunk[..., other] = src[i:i + step][..., other]
+            dst[i:i + step] = chunk
+    return out
+
+
+class Normalization:
+    "Bands left out of the tiles and the normalization of the remaining spectra"
+
+    def __init__(self, method=None, drop_bands=(), chm_band=segmentation.CHM_BAND, keep_chm=True):
+        """
+        Parameters
+        ----------
+        method : 'snv', 'sum' or None to only leave out bands
+        drop_bands : 1-based bands left out, see `parse_bands`
+        chm_band : The band of the canopy height model
+        keep_chm : Pass the CHM band through unchanged instead of leaving it out
+        """
+        if method is not None and method not in METHODS:
+            raise ValueError(f'Unknown normalization {method}, expected one of {METHODS}')
+        self.method = method
+        self.drop_bands = sorted(int(b) for b in drop_bands)
+        self.chm_band, self.keep_chm = int(chm_band), bool(keep_chm)
+
+    def __repr__(self):
+        return (f'Normalization(method={self.method}, {len(self.drop_bands)} bands dropped, '
+                f'chm={"kept" if self.keep_chm else "excluded"})')
+
+    @property
+    def params(self):
+        "The settings, for the run manifests"
+        return {'method': self.method, 'drop_bands': self.drop_bands, 'chm_band': self.chm_band, 'keep_chm': self.keep_chm}
+
+    def bands(self, n_bands):
+        "The 1-based bands kept of a tile with `n_bands` bands"
+        drop = set(self.drop_bands)
+        if not self.keep_chm: drop.add(self.chm_band)
+        return [b for b in range(1, n_bands + 1) if b not in drop]
+
+    def read_bands(self, n_bands, spec_bands=None):
+        """
+        The bands to read for the features of the bands `spec_bands`, all kept
+        bands by default. The normalization needs the whole spectrum, so only
+        a mask without normalization reads just `spec_bands`.
+        """
+        kept = self.bands(n_bands)
+        if spec_bands is None: return kept
+        missing = sorted(set(spec_bands) - set(kept))
+        if missing: raise ValueError(f'The features use bands left out by the normalization: {missing[:10]}')
+        return kept if self.method is not None else sorted(spec_bands)
+
+    def columns(self, n_bands, statistics=stats.STATISTICS):
+        "The names of the features computed over the kept bands"
+        return stats.feature_names(stats=statistics, bands=self.bands(n_bands))
+
+    def apply(self, values, bands, axis=-1):
+        "Normalize `values` holding the 1-based `bands` along `axis`, see `normalize`"
+        if self.method is None: return values
+        return normalize(values, self.method, axis, [b != self.chm_band for b in bands])
+
+
+def load(method=None, drop_bands=None, chm='keep', chm_band=segmentation.CHM_BAND):
+    """
+    A `Normalization` from the command line options of the extraction stages,
+    or None if the tiles are used as they are.
+
+    Parameters
+    ----------
+    method : snv, sum or None
+    drop_bands : Bands left out, e.g. 'interpolated' or 'interpolated,1-3'
+    chm : 'keep' the CHM band as it is, or 'exclude' it
+    chm_band : The band of the canopy height model
+    """
+    if chm not in ('keep', 'exclude'): raise ValueError(f'chm is keep or exclude, not {chm}')
+    if method is None and drop_bands is None and chm == 'keep': return None
+    return Normalization(method, parse_bands(drop_bands or ''), chm_band, chm == 'keep')
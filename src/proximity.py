@@ -0,0 +1,99 @@
+"""
+Batch nearest-neighbour queries between detected and measured trees.
+
+Vectorized counterparts of the row-wise helpers in `src.utils`
+(`check_distance`, `get_closest_match`, `find_new_coords`, `filter_too_close`)
+backed by a cKDTree, answering all rows of a frame with a single query.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Search radius used by the row-wise helpers when looking for the closest tree
+MAX_SEARCH_RADIUS = 999
+
+
+def _coords(df, x, y):
+    return np.column_stack([df[x].values, df[y].values]).astype(float)
+
+
+def check_distances(df_detected, df_measured, radius, detected_xy=('X', 'Y'), measured_xy=('puu_x', 'puu_y')):
+    "For each detected tree, whether any measured tree lies within `radius`"
+    if len(df_measured) == 0: return np.zeros(len(df_detected), dtype=bool)
+    dist, _ = cKDTree(_coords(df_measured, *measured_xy)).query(_coords(df_detected, *detected_xy))
+    return dist <= radius
+
+
+def get_closest_matches(df_detected, df_measured, detected_xy=('X', 'Y'), measured_xy=('puu_x', 'puu_y'),
+                        label='puulaji', default='Undefined'):
+    """
+    Label each detected tree with the species of the closest measured tree.
+    Trees without a measured tree within MAX_SEARCH_RADIUS get `default`.
+    """
+    labels = np.full(len(df_detected), default, dtype=object)
+    if len(df_measured) == 0: return labels
+    dist, idx = cKDTree(_coords(df_measured, *measured_xy)).query(_coords(df_detected, *detected_xy))
+    found = dist <= MAX_SEARCH_RADIUS
+    labels[found] = df_measured[label].values[idx[found]]
+    return labels
+
+
+def find_new_coords(df_measured, df_detected, measured_xy=('puu_x', 'puu_y'), detected_xy=('X', 'Y')):
+    """
+    Coordinates of the detected treetop closest to each measured tree, or
+    (0, 0) if there is none within MAX_SEARCH_RADIUS.
+
+    Return
+    ------
+    corr_x, corr_y : Arrays with the corrected coordinates
+    """
+    corr = np.zeros((len(df_measured), 2))
+    if len(df_detected) == 0: return corr[:,0], corr[:,1]
+    detected = _coords(df_detected, *detected_xy)
+    dist, idx = cKDTree(detected).query(_coords(df_measured, *measured_xy))
+    found = dist <= MAX_SEARCH_RADIUS
+    corr[found] = detected[idx[found]]
+    return corr[:,0], corr[:,1]
+
+
+def close_pairs(df, radius, xy=('x', 'y')):
+    "Index pairs (i, j), i < j, of rows closer than `radius` to each other"
+    # query_pairs includes pairs at exactly `radius`, the filter is strict
+    return cKDTree(_coords(df, *xy)).query_pairs(np.nextafter(radius, 0), output_type='ndarray')
+
+
+def filter_too_close(df, radius, xy=('x', 'y'), label='species'):
+    """
+    Filter trees that are too close to each other.
+
+    Rows are visited in order. For each remaining row, its remaining
+    neighbours closer than `radius` are visited in order: a neighbour with the
+    same label is dropped, and a neighbour with a different label is dropped
+    together with the row itself. The input frame is not modified.
+
+    Return
+    ------
+    df : The remaining rows
+    """
+    pairs = close_pairs(df, radius, xy)
+    keep = np.ones(len(df), dtype=bool)
+    if len(pairs) == 0: return df.copy()
+
+    # Symmetric adjacency lists sorted by row position
+    src = np.concatenate([pairs[:,0], pairs[:,1]])
+    dst = np.concatenate([pairs[:,1], pairs[:,0]])
+    order = np.lexsort((dst, src))
+    src, dst = src[order], dst[order]
+    offsets = np.searchsorted(src, np.arange(len(df) + 1))
+
+    labels = df[label].values
+    for i in np.unique(src):
+        if not keep[i]: continue
+        for j in dst[offsets[i]:offsets[i+1]]:
+            if not keep[j]: continue
+            if labels[i] == labels[j]:
+                keep[j] = False
+            else:
+                keep[i] = keep[j] = False
+                break
+    return df[keep].copy()
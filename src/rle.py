@@ -0,0 +1,118 @@
+"""
+Run-length encoded crown masks on the hyperspectral tile grid.
+
+A crown is stored as the tile row and column of the top left corner of its
+pixel window, the window width, and the runs of crown pixels within the
+window flattened in row-major order, as alternating start and length values.
+The masks are kept in the tree tables next to the geometry, and turn finding
+the pixels of a crown into plain array indexing instead of a point-in-polygon
+test. The rows and columns refer to the tile given by the tile_id column.
+
+    mask_row    tile row of the first window row
+    mask_col    tile column of the first window column
+    mask_width  width of the window in pixels
+    mask_runs   int32 list of start, length pairs
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from src import geo_io, instrument, masking
+
+ROW_COLUMN = 'mask_row'
+COL_COLUMN = 'mask_col'
+WIDTH_COLUMN = 'mask_width'
+RUNS_COLUMN = 'mask_runs'
+MASK_COLUMNS = [ROW_COLUMN, COL_COLUMN, WIDTH_COLUMN, RUNS_COLUMN]
+
+
+def has_masks(frame):
+    "Whether the trees in `frame` carry run-length encoded masks"
+    return all(c in frame.columns for c in MASK_COLUMNS)
+
+
+def drop_masks(frame):
+    "The frame without the mask columns"
+    return frame.drop(columns=[c for c in MASK_COLUMNS if c in frame.columns])
+
+
+@instrument.timed('mask')
+def encode(labels, rows, cols, n_crowns):
+    """
+    Run-length encode crown pixels.
+
+    Parameters
+    ----------
+    labels : The crown of each pixel, sorted
+    rows, cols : The tile row and column of each pixel, in row-major order within each crown
+    n_crowns : The number of crowns
+
+    Return
+    ------
+    masks : A DataFrame with the mask columns, one row per crown. Crowns without
+            pixels get an empty window at the origin.
+    """
+    windows = masking.pixel_windows(labels, rows, cols, n_crowns)
+    row_off, col_off, width = windows[:,0], windows[:,2], windows[:,3] - windows[:,2]
+
+    # Position of each pixel within its window, and where a new run begins
+    flat = (rows - row_off[labels]) * width[labels] + cols - col_off[labels]
+    new_run = np.ones(len(flat), dtype=bool)
+    new_run[1:] = (labels[1:] != labels[:-1]) | (flat[1:] != flat[:-1] + 1)
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(flat)))
+    runs = np.stack([flat[run_starts], run_lengths], axis=1).astype(np.int32).reshape(-1)
+    runs_per_crown = np.bincount(labels[run_starts], minlength=n_crowns)
+    runs = np.split(runs, np.cumsum(2 * runs_per_crown)[:-1]) if n_crowns else []
+    return pd.DataFrame({ROW_COLUMN: row_off.astype(np.int32), COL_COLUMN: col_off.astype(np.int32),
+                         WIDTH_COLUMN: width.astype(np.int32),
+                         RUNS_COLUMN: runs})
+
+
+def encode_crowns(geometries, xs, ys):
+    "Run-length encoded masks of crown polygons on a tile grid, see `masking.crown_pixels`"
+    geometries = np.asarray(geometries)
+    return encode(*masking.crown_pixels(geometries, xs, ys), len(geometries))
+
+
+def add_masks(trees, xs, ys):
+    "A copy of `trees` with the masks of their crowns on the tile grid (xs, ys)"
+    masks = encode_crowns(trees.geometry.values, xs, ys).set_index(trees.index)
+    return pd.concat([drop_masks(trees), masks], axis=1)
+
+
+def stored_columns(path):
+    "The mask columns of a parquet file of trees, or an empty list if it has no masks"
+    if not geo_io.is_parquet(path): return []
+    names = pq.read_schema(path).names
+    return MASK_COLUMNS if all(c in names for c in MASK_COLUMNS) else []
+
+
+def stored_pixels(trees):
+    "The crown pixels decoded from the masks of `trees`, or None if they have no masks"
+    return decode(trees) if has_masks(trees) else None
+
+
+@instrument.timed('mask')
+def decode(trees):
+    """
+    The pixels of the crowns, with the same layout as `masking.crown_pixels`.
+
+    Return
+    ------
+    labels : The position of the crown in `trees` for each pixel, sorted
+    rows, cols : The row and column of each pixel in the tile
+    """
+    runs = list(trees[RUNS_COLUMN].values)
+    n_runs = np.array([len(r) // 2 for r in runs], dtype=np.int64)
+    runs = np.concatenate(runs).astype(np.int64).reshape(-1, 2) if len(runs) else np.empty((0, 2), np.int64)
+    run_labels = np.repeat(np.arange(len(n_runs)), n_runs)
+    lengths = runs[:,1]
+    labels = np.repeat(run_labels, lengths)
+    # Each pixel is the start of its run plus its position within the run
+    flat = np.repeat(runs[:,0] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    width = trees[WIDTH_COLUMN].to_numpy(np.int64)[labels]
+    rows = trees[ROW_COLUMN].to_numpy(np.int64)[labels] + flat // np.maximum(width, 1)
+    cols = trees[COL_COLUMN].to_numpy(np.int64)[labels] + flat % np.maximum(width, 1)
+    return labels, rows, cols
+
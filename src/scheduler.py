@@ -0,0 +1,122 @@
+"""
+Load-balanced scheduling of per-tree work over a process pool.
+
+Tiles are split into batches of spatially adjacent trees, so that a batch
+only reads a band of tile rows. Tasks are submitted largest first and their
+results are consumed as soon as any worker finishes, which keeps all workers
+busy until the end of the run instead of waiting for a few dense tiles.
+"""
+
+import time
+import multiprocessing
+import numpy as np
+import shapely
+
+# Trees per batch when splitting a tile
+DEFAULT_BATCH_SIZE = 2000
+
+# Seconds between progress reports
+REPORT_INTERVAL = 30.0
+
+
+def tree_batches(geometries, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Split the trees of a tile into batches of adjacent rows of the tile.
+
+    Parameters
+    ----------
+    geometries : The crown (or treetop) geometries of the tile
+    batch_size : The maximum number of trees per batch
+
+    Return
+    ------
+    batches : A list of position arrays, each sorted in ascending order
+    """
+    n = len(geometries)
+    if n <= batch_size: return [np.arange(n)]
+    # Trees ordered from the top row of the tile down
+    order = np.argsort(-shapely.bounds(np.asarray(geometries))[:,3], kind='stable')
+    n_batches = -(-n // batch_size)
+    return [np.sort(b) for b in np.array_split(order, n_batches)]
+
+
+def _format_time(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress:
+    "Prints the throughput and the estimated time remaining of a run"
+
+    def __init__(self, total, unit='trees', interval=REPORT_INTERVAL):
+        self.total, self.unit, self.interval = total, unit, interval
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, n):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last < self.interval and self.done < self.total: return
+        self.last = now
+        rate = self.done / max(now - self.start, 1e-9)
+        eta = (self.total - self.done) / rate if rate > 0 else float('nan')
+        print(f'{self.done}/{self.total} {self.unit} ({100 * self.done / max(self.total, 1):.1f}%), '
+              f'{rate:.1f} {self.unit}/s, elapsed {_format_time(now - self.start)}, ETA {_format_time(eta)}', flush=True)
+
+
+def _call(args):
+    func, i, task = args
+    return i, func(*task)
+
+
+def run(func, tasks, costs, processes, initializer=None, initargs=(), unit='trees'):
+    """
+    Run `func(*task)` for every task, largest first, over a process pool.
+
+    Parameters
+    ----------
+    func : A picklable function
+    tasks : A list of argument tuples
+    costs : The amount of work in each task, e.g. the number of trees
+    processes : The number of worker processes
+    initializer, initargs : Passed to multiprocessing.Pool
+    unit : The unit of `costs` in the progress reports
+
+    Yields
+    ------
+    i : The position of the finished task in `tasks`
+    result : The return value of `func`
+    """
+    costs = np.asarray(costs)
+    order = np.argsort(-costs, kind='stable')
+    progress = Progress(int(costs.sum()), unit)
+    with multiprocessing.Pool(processes, initializer, initargs) as pool:
+        for i, result in pool.imap_unordered(_call, ((func, i, tasks[i]) for i in order)):
+            progress.update(int(costs[i]))
+            yield i, result
+
+
+def gather(results, groups):
+    """
+    Collect the results of tasks that belong to the same group, e.g. the
+    batches of a tile, and yield every group as soon as it is complete.
+
+    Parameters
+    ----------
+    results : (i, result) pairs as yielded by `run`
+    groups : The group of each task
+
+    Yields
+    ------
+    group : The group
+    parts : A list of (i, result) pairs in task order
+    """
+    remaining = {}
+    for g in groups: remaining[g] = remaining.get(g, 0) + 1
+    pending = {}
+    for i, result in results:
+        g = groups[i]
+        pending.setdefault(g, []).append((i, result))
+        remaining[g] -= 1
+        if remaining[g] == 0:
+            yield g, sorted(pending.pop(g), key=lambda p: p[0])
@@ -0,0 +1,233 @@
+"""
+Treetop detection and crown segmentation on the canopy height model.
+
+A Python port of `detect_trees.R`, which runs lidR on band 461 (the CHM) of
+each tile:
+
+    smooth_chm      3x3 mean ignoring missing values, focal(..., mean(x, na.rm=T))
+    local_maxima    lmf(ws, hmin, shape='circular') on the smoothed CHM
+    grow_crowns     dalponte2016(chm, ttops, th_tree=hmin, th_seed, th_cr, max_cr)
+    crown_frames    rasterToPolygons(dissolve=TRUE) and the crown postprocessing
+
+Region growing advances all crown fronts one pixel ring per sweep, as in the
+original Dalponte formulation, instead of visiting pixels one at a time in
+raster order. A pixel claimed by several crowns in the same sweep goes to the
+first of them in raster order.
+"""
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from rasterio import features
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from src import instrument, masking, tiles
+
+# Band of the canopy height model in the hyperspectral tiles (1-based)
+CHM_BAND = 461
+
+# Parameters of detect_treetops.sh and detect_trees.R
+WINDOW_SIZE = 5
+HMIN = 10
+TH_SEED = 0.65
+TH_CR = 0.5
+MAX_CR = 5
+
+# Neighbours visited by the region growing: up, left, right, down
+NEIGHBOURS = np.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+
+
+def read_chm(tile_fn, band=CHM_BAND):
+    """
+    Read the CHM band of a tile, from the separate CHM file of a repacked
+    tile if there is one.
+
+    Return
+    ------
+    chm : A float64 array with missing values as nan
+    transform : The affine transform of the tile
+    """
+    source, band = tiles.band_source(tile_fn, band)
+    with tiles.TileReader(source, bands=[band]) as reader:
+        chm = reader.read_rows(0, reader.dataset.height)[0].astype(np.float64)
+        nodata, transform = reader.dataset.nodata, reader.dataset.transform
+    if nodata is not None: chm[chm == nodata] = np.nan
+    return chm, transform
+
+
+def smooth_chm(chm):
+    """
+    Mean of the 3x3 neighbourhood of each pixel ignoring missing values. The
+    edge pixels have no full neighbourhood and, like pixels without any valid
+    neighbour, are set to 0.
+    """
+    valid = ~np.isnan(chm)
+    kernel = np.ones((3, 3))
+    total = ndimage.correlate(np.where(valid, chm, 0), kernel, mode='constant')
+    count = ndimage.correlate(valid.astype(np.float64), kernel, mode='constant')
+    smoothed = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+    smoothed[[0, -1], :] = 0
+    smoothed[:, [0, -1]] = 0
+    return smoothed
+
+
+def circular_footprint(radius):
+    "Boolean disc of the pixels within `radius` pixels of the centre"
+    r = int(np.floor(radius))
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    return dx**2 + dy**2 <= radius**2
+
+
+def local_maxima(chm, ws=WINDOW_SIZE, hmin=HMIN, res=0.5):
+    """
+    Find the treetops as the highest pixels within a circular window.
+
+    Parameters
+    ----------
+    chm : The smoothed canopy height model
+    ws : Diameter of the window in map units
+    hmin : Minimum height of a treetop
+    res : The pixel size in map units
+
+    Return
+    ------
+    rows, cols : Pixel positions of the treetops in raster order. Of equally
+                 high maxima within the same window only the first is kept.
+    """
+    radius = ws / 2 / res
+    footprint = circular_footprint(radius)
+    highest = ndimage.maximum_filter(chm, footprint=footprint, mode='constant', cval=-np.inf)
+    rows, cols = np.nonzero((chm >= highest) & (chm >= hmin))
+    # Plateaus give several maxima of the same height
+    pairs = cKDTree(np.stack([rows, cols], axis=1)).query_pairs(radius, output_type='ndarray')
+    pairs = pairs[chm[rows[pairs[:,0]], cols[pairs[:,0]]] == chm[rows[pairs[:,1]], cols[pairs[:,1]]]]
+    keep = np.ones(len(rows), dtype=bool)
+    for i, j in pairs[np.lexsort((pairs[:,1], pairs[:,0]))]:
+        if keep[i]: keep[j] = False
+    return rows[keep], cols[keep]
+
+
+def grow_crowns(chm, seed_rows, seed_cols, th_tree=HMIN, th_seed=TH_SEED, th_cr=TH_CR, max_cr=MAX_CR):
+    """
+    Dalponte seeded region growing.
+
+    A pixel joins a neighbouring crown when it is higher than `th_tree`,
+    `th_seed` times the treetop height and `th_cr` times the mean height of
+    the crown, at most 5% higher than the treetop, and less than `max_cr`
+    pixels from the treetop along both axes.
+
+    Parameters
+    ----------
+    chm : The smoothed canopy height model
+    seed_rows, seed_cols : Pixel positions of the treetops
+
+    Return
+    ------
+    labels : An int32 raster with the tree id of each crown pixel, counting
+             from 1 in the order of the seeds, and 0 elsewhere
+    """
+    nrow, ncol = chm.shape
+    n = len(seed_rows)
+    labels = np.zeros(chm.shape, dtype=np.int32)
+    labels[seed_rows, seed_cols] = np.arange(1, n + 1)
+    seed_height = np.concatenate([[0], chm[seed_rows, seed_cols]])
+    seed_rows, seed_cols = np.concatenate([[0], seed_rows]), np.concatenate([[0], seed_cols])
+    height_sum, n_pixels = seed_height.copy(), np.ones(n + 1)
+
+    front = np.stack([seed_rows[1:], seed_cols[1:]], axis=1)
+    while len(front):
+        # Only pixels off the raster edge grow, in raster order
+        front = front[(front[:,0] > 0) & (front[:,0] < nrow - 1) & (front[:,1] > 0) & (front[:,1] < ncol - 1)]
+        front = front[np.lexsort((front[:,1], front[:,0]))]
+        ids = np.repeat(labels[front[:,0], front[:,1]], len(NEIGHBOURS))
+        cand = (front[:,None,:] + NEIGHBOURS[None]).reshape(-1, 2)
+        r, c = cand[:,0], cand[:,1]
+        h = chm[r, c]
+        mean_height = height_sum[ids] / n_pixels[ids]
+        ok = ((labels[r, c] == 0) & (h > th_tree) & (h > seed_height[ids] * th_seed)
+              & (h > mean_height * th_cr) & (h <= seed_height[ids] * 1.05)
+              & (np.abs(seed_rows[ids] - r) < max_cr) & (np.abs(seed_cols[ids] - c) < max_cr))
+        cand, ids = cand[ok], ids[ok]
+        # The first crown claiming a pixel gets it
+        _, first = np.unique(cand[:,0] * ncol + cand[:,1], return_index=True)
+        first = np.sort(first)
+        cand, ids = cand[first], ids[first]
+        labels[cand[:,0], cand[:,1]] = ids
+        height_sum += np.bincount(ids, weights=chm[cand[:,0], cand[:,1]], minlength=n + 1)
+        n_pixels += np.bincount(ids, minlength=n + 1)
+        front = cand
+    return labels
+
+
+@instrument.timed('segment')
+def segment_chm(chm, res, ws=WINDOW_SIZE, hmin=HMIN, th_seed=TH_SEED, th_cr=TH_CR, max_cr=MAX_CR):
+    """
+    Smooth the CHM, find the treetops and grow the crowns.
+
+    Return
+    ------
+    smoothed : The smoothed CHM
+    rows, cols : Pixel positions of the treetops, tree i+1 is at (rows[i], cols[i])
+    labels : The crown raster, see `grow_crowns`
+    """
+    smoothed = smooth_chm(chm)
+    rows, cols = local_maxima(smoothed, ws, hmin, res)
+    labels = grow_crowns(smoothed, rows, cols, hmin, th_seed, th_cr, max_cr)
+    return smoothed, rows, cols, labels
+
+
+@instrument.timed('vectorize')
+def crown_frames(smoothed, rows, cols, labels, transform, crs='EPSG:32635'):
+    """
+    Vectorize the segmentation into the treetop and crown tables written by
+    `detect_trees.R`.
+
+    Return
+    ------
+    ttops : A GeoDataFrame with treeID, Z and the treetop points
+    crowns : A GeoDataFrame with value, X, Y, Height_m, CA_m2 and the convex
+             hulls of the crowns shrunk by half a pixel, keeping crowns over 1 m2
+    """
+    xs, ys = masking.pixel_centres(transform, smoothed.shape[1], smoothed.shape[0])
+    ttops = gpd.GeoDataFrame({'treeID': np.arange(1, len(rows) + 1), 'Z': smoothed[rows, cols]},
+                             geometry=shapely.points(xs[cols], ys[rows]), crs=crs)
+
+    # Polygons of the connected parts of each crown, dissolved by tree id
+    parts = [(shapely.geometry.shape(geom), int(value))
+             for geom, value in features.shapes(labels, mask=labels > 0, connectivity=4, transform=transform)]
+    values = np.array([v for _, v in parts], dtype=np.int64)
+    ids, inverse = np.unique(values, return_inverse=True)
+    dissolved = np.empty(len(ids), dtype=object)
+    dissolved[inverse] = [g for g, _ in parts]
+    # Only crowns split into several parts need a union
+    for i in np.flatnonzero(np.bincount(inverse, minlength=len(ids)) > 1):
+        dissolved[i] = shapely.union_all([g for (g, _), j in zip(parts, inverse) if j == i])
+
+    # The centroid of the largest part, like sp::coordinates
+    largest = [max(shapely.get_parts(g), key=lambda p: p.area) for g in dissolved]
+    centroids = shapely.centroid(np.array(largest, dtype=object))
+    res = abs(transform.a)
+    hulls = shapely.convex_hull(shapely.buffer(dissolved, -res / 2, cap_style='square'))
+    crowns = gpd.GeoDataFrame({'value': ids,
+                               'X': np.round(shapely.get_x(centroids), 2),
+                               'Y': np.round(shapely.get_y(centroids), 2),
+                               'Height_m': np.round(ndimage.maximum(smoothed, labels, ids), 2),
+                               'CA_m2': np.round(shapely.area(hulls), 2)},
+                              geometry=hulls, crs=crs)
+    return ttops, crowns[crowns.CA_m2 > 1].reset_index(drop=True)
+
+
+def segment_tile(tile_fn, band=CHM_BAND, ws=WINDOW_SIZE, hmin=HMIN, th_seed=TH_SEED, th_cr=TH_CR, max_cr=MAX_CR):
+    """
+    Segment the trees of a tile.
+
+    Return
+    ------
+    ttops, crowns : The treetop and crown tables, see `crown_frames`
+    labels : The crown raster
+    transform : The affine transform of `labels`
+    """
+    chm, transform = read_chm(tile_fn, band)
+    smoothed, rows, cols, labels = segment_chm(chm, abs(transform.a), ws, hmin, th_seed, th_cr, max_cr)
+    ttops, crowns = crown_frames(smoothed, rows, cols, labels, transform)
+    return ttops, crowns, labels, transform
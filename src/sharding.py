@@ -0,0 +1,72 @@
+"""
+Splitting the tiles of a stage over several jobs, e.g. the tasks of a SLURM
+job array.
+
+Every shard computes the same assignment from the same list of tiles and
+their costs, usually the number of crowns, and keeps its own part. Tiles are
+assigned largest first to the shard with the least work so far, so the
+shards get about the same number of crowns instead of the same number of
+files. The shard and the number of shards default to the SLURM array
+variables of the job.
+"""
+
+import os
+import heapq
+import numpy as np
+import pyarrow.parquet as pq
+from src import geo_io
+
+
+def shard_args(shard=None, n_shards=None):
+    """
+    The shard of this job and the number of shards. Missing values are taken
+    from SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT, and without a job
+    array there is a single shard.
+    """
+    if shard is None and 'SLURM_ARRAY_TASK_ID' in os.environ:
+        shard = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    if n_shards is None and 'SLURM_ARRAY_TASK_COUNT' in os.environ:
+        n_shards = int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    shard, n_shards = shard or 0, n_shards or 1
+    if not 0 <= shard < n_shards: raise ValueError(f'Shard {shard} is not in [0, {n_shards})')
+    return shard, n_shards
+
+
+def assign(costs, n_shards):
+    """
+    Balance tasks over shards, largest first to the least loaded shard.
+
+    Ties are broken by the position of the task and the number of the shard,
+    so the assignment only depends on the costs and their order.
+
+    Return
+    ------
+    shards : The shard of each task
+    """
+    costs = np.asarray(costs)
+    shards = np.zeros(len(costs), dtype=np.int64)
+    loads = [(0, s) for s in range(n_shards)]
+    for i in np.argsort(-costs, kind='stable'):
+        load, s = heapq.heappop(loads)
+        shards[i] = s
+        heapq.heappush(loads, (load + costs[i], s))
+    return shards
+
+
+def select(tasks, costs, shard=None, n_shards=None):
+    """
+    The tasks of this shard and their costs, see `shard_args` and `assign`.
+    `tasks` must be listed in the same order by every shard.
+    """
+    shard, n_shards = shard_args(shard, n_shards)
+    if n_shards == 1: return list(tasks), list(costs)
+    mine = np.flatnonzero(assign(costs, n_shards) == shard)
+    print(f'Shard {shard + 1}/{n_shards}: {len(mine)} of {len(tasks)} tiles, '
+          f'{int(np.asarray(costs)[mine].sum())} of {int(np.sum(costs))} trees')
+    return [tasks[i] for i in mine], [costs[i] for i in mine]
+
+
+def count_rows(path):
+    "The number of trees in a vector file, from the metadata of a parquet file"
+    if geo_io.is_parquet(path): return pq.ParquetFile(path).metadata.num_rows
+    return len(geo_io.read_frame(path, columns=['geometry']))
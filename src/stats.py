@@ -0,0 +1,151 @@
+"""
+Grouped per-band statistics of crown pixels.
+
+All six feature families (mean, sd, min, max, skew, kurt) are derived from
+power sums accumulated for every (crown, band) pair in a single pass over the
+pixels of a tile, instead of running six separate NaN-aware reductions per crown.
+"""
+
+import re
+from collections import namedtuple
+import numpy as np
+from src import instrument
+
+# Feature families in the order they appear in the feature tables
+STATISTICS = ('mean', 'sd', 'min', 'max', 'skew', 'kurt')
+
+# Power sums are stored for values shifted by a per-(group, band) constant
+# `shift` to limit cancellation when deriving the central moments
+Moments = namedtuple('Moments', ['count', 'sum', 'sum2', 'sum3', 'sum4', 'min', 'max', 'shift'])
+
+
+def feature_names(n_bands=461, stats=STATISTICS, bands=None):
+    """
+    Column names of the feature tables, e.g. mean_band_1 ... kurt_band_461,
+    or of the given 1-based `bands` only
+    """
+    bands = range(1, n_bands + 1) if bands is None else bands
+    return [f'{stat}_band_{b}' for stat in stats for b in bands]
+
+
+def parse_feature_name(name):
+    "Split a feature name like mean_band_12 into ('mean', 12), or None for other columns"
+    match = re.fullmatch(r'([a-z]+)_band_(\d+)', str(name))
+    if match is None or match.group(1) not in STATISTICS: return None
+    return match.group(1), int(match.group(2))
+
+
+def feature_columns(columns):
+    "The feature columns among `columns`, in their original order"
+    return [c for c in columns if parse_feature_name(c) is not None]
+
+
+def _highest_power(stats):
+    "The highest power sum needed for the given statistics"
+    if 'kurt' in stats: return 4
+    if 'skew' in stats: return 3
+    if 'sd' in stats: return 2
+    return 1
+
+
+@instrument.timed('stats')
+def grouped_moments(values, labels, n_groups, dtype=np.float64, stats=STATISTICS):
+    """
+    Accumulate NaN-aware moments for every (group, band) pair.
+
+    Parameters
+    ----------
+    values : An array of shape (n_pixels, n_bands) containing the pixel values
+    labels : The group (crown) of each pixel, an integer in [0, n_groups)
+    n_groups : The number of groups
+    dtype : The accumulation dtype. float32 halves the memory traffic at the
+            cost of precision in the higher moments.
+    stats : The statistics that will be derived, used to skip unneeded sums
+
+    Return
+    ------
+    moments : A Moments tuple of arrays with shape (n_groups, n_bands).
+              Sums that are not needed for `stats` are None.
+    """
+    values = np.asarray(values)
+    labels = np.asarray(labels)
+    n_bands = values.shape[1]
+    if len(labels) > 1 and np.any(labels[1:] < labels[:-1]):
+        order = np.argsort(labels, kind='stable')
+        values, labels = values[order], labels[order]
+
+    offsets = np.searchsorted(labels, np.arange(n_groups + 1))
+    starts = offsets[:-1]
+    nonempty = offsets[1:] > starts
+    starts = starts[nonempty]
+    power = _highest_power(stats)
+
+    def reduce(ufunc, arr, fill):
+        out = np.full((n_groups, n_bands), fill, dtype=dtype)
+        if len(starts): out[nonempty] = ufunc.reduceat(arr, starts, axis=0)
+        return out
+
+    # Shift each group by the value of its first pixel, falling back to the
+    # band mean of all pixels where that value is missing
+    valid = ~np.isnan(values)
+    shift = np.zeros((n_groups, n_bands), dtype=dtype)
+    shift[nonempty] = values[starts]
+    missing = np.isnan(shift)
+    if missing.any():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fallback = np.nan_to_num(np.nanmean(values, axis=0)).astype(dtype)
+        shift = np.where(missing, fallback, shift)
+    sizes = np.diff(offsets)
+    d = np.where(valid, values.astype(dtype, copy=False) - np.repeat(shift, sizes, axis=0), 0)
+
+    count = reduce(np.add, valid.astype(dtype), 0)
+    sums = [reduce(np.add, d, 0)]
+    dk = d
+    for _ in range(2, power + 1):
+        dk = dk * d
+        sums.append(reduce(np.add, dk, 0))
+    sums += [None] * (4 - len(sums))
+
+    if 'min' in stats or 'max' in stats:
+        vmin = reduce(np.fmin, values.astype(dtype, copy=False), np.nan)
+        vmax = reduce(np.fmax, values.astype(dtype, copy=False), np.nan)
+    else:
+        vmin = vmax = None
+    return Moments(count, *sums, vmin, vmax, shift)
+
+
+@instrument.timed('stats')
+def crown_features(moments, stats=STATISTICS):
+    """
+    Derive the requested statistics from accumulated moments.
+
+    sd is the population standard deviation as in np.nanstd, and skew and
+    kurt follow the biased definitions of scipy.stats.skew and
+    scipy.stats.kurtosis (Fisher), including nan for constant data.
+
+    Return
+    ------
+    features : An array of shape (n_groups, len(stats)*n_bands), ordered as `feature_names`
+    """
+    n = moments.count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = moments.sum / n
+        mean = a + moments.shift
+        if moments.sum2 is not None:
+            m2 = np.maximum(moments.sum2 / n - a**2, 0)
+            zero = m2 <= (np.finfo(m2.dtype).eps * mean)**2
+        if moments.sum3 is not None:
+            m3 = moments.sum3 / n - 3*a*moments.sum2 / n + 2*a**3
+        if moments.sum4 is not None:
+            m4 = moments.sum4 / n - 4*a*moments.sum3 / n + 6*a**2*moments.sum2 / n - 3*a**4
+
+        derived = {}
+        for stat in stats:
+            if stat == 'mean': derived[stat] = mean
+            elif stat == 'sd': derived[stat] = np.sqrt(m2)
+            elif stat == 'min': derived[stat] = moments.min
+            elif stat == 'max': derived[stat] = moments.max
+            elif stat == 'skew': derived[stat] = np.where(zero, np.nan, m3 / m2**1.5)
+            elif stat == 'kurt': derived[stat] = np.where(zero, np.nan, m4 / m2**2) - 3
+            else: raise ValueError(f'Unknown statistic {stat}')
+    return np.hstack([derived[stat] for stat in stats])
@@ -0,0 +1,247 @@
+"""
+Windowed access to the hyperspectral tiles.
+
+Crowns are grouped by the internal block layout of the GeoTIFF and every
+block row is read exactly once through rasterio windows, so a worker only
+holds the rows needed by the crowns currently being processed instead of a
+whole 461-band tile.
+
+The tiles can be repacked once with `repack` into compressed GeoTIFFs of
+square blocks, so a crown window only touches the blocks around it instead of
+full-width strips. The CHM band is also copied to `chm/{tile}.tif` next to the
+repacked tiles, see `chm_path`. Both layouts are read through the same code.
+"""
+
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from src import instrument, masking
+
+# Default memory ceiling for the pixel rows held by one worker
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+# Layout of repacked tiles. Band interleaving keeps reading a subset of the
+# bands cheap, see benchmarks/bench_tiles.py for pixel interleaving.
+REPACK_BLOCK_SIZE = 256
+REPACK_COMPRESS = 'zstd'
+REPACK_INTERLEAVE = 'band'
+CHM_DIR = 'chm'
+
+# Tag of a CHM file naming the band of the tile it was copied from
+CHM_TAG = 'source_band'
+
+
+class TileReader:
+    """
+    Block-aligned reader for a single tile. Keeps count of the bytes read.
+
+    Use as a context manager:
+
+        with TileReader(tile_fn) as reader:
+            for idx, block, row_off in reader.batches(windows):
+                ...
+    """
+
+    def __init__(self, tile_fn, bands=None):
+        """
+        Parameters
+        ----------
+        tile_fn : Path to the tile
+        bands : 1-based indexes of the bands to read, all bands by default
+        """
+        self.tile_fn = tile_fn
+        self.dataset = rasterio.open(tile_fn)
+        self.bands = list(range(1, self.dataset.count + 1)) if bands is None else [int(b) for b in bands]
+        self.xs, self.ys = masking.pixel_centres(self.dataset.transform, self.dataset.width, self.dataset.height)
+        self.bytes_read = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, *args): self.close()
+
+    def close(self): self.dataset.close()
+
+    @property
+    def shape(self): return (len(self.bands), self.dataset.height, self.dataset.width)
+
+    @property
+    def block_height(self): return self.dataset.block_shapes[0][0]
+
+    def row_bytes(self):
+        "Bytes needed for one full-width row of the selected bands"
+        return self.dataset.width * len(self.bands) * np.dtype(self.dataset.dtypes[0]).itemsize
+
+    @instrument.timed('read')
+    def read_rows(self, start, stop):
+        "Read full-width rows [start, stop) of the selected bands"
+        data = self.dataset.read(self.bands, window=Window(0, start, self.dataset.width, stop - start))
+        self.bytes_read += data.nbytes
+        instrument.count(bytes_read=data.nbytes)
+        return data
+
+    @instrument.timed('read')
+    def read(self, window):
+        "Read a single (row_start, row_stop, col_start, col_stop) window of the selected bands"
+        r0, r1, c0, c1 = (int(v) for v in window)
+        data = self.dataset.read(self.bands, window=Window(c0, r0, c1 - c0, r1 - r0))
+        self.bytes_read += data.nbytes
+        instrument.count(bytes_read=data.nbytes)
+        return data
+
+    def batches(self, windows, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Group pixel windows by block rows and read every block row once.
+
+        The reader keeps a buffer of full-width rows and advances it in steps
+        aligned with the blocks of the file. Windows are emitted as soon as
+        all of their rows are in the buffer, and rows no longer needed by any
+        pending window are released.
+
+        Parameters
+        ----------
+        windows : An integer array of shape (n, 4) containing row_start,
+                  row_stop, col_start and col_stop of each window
+        max_bytes : The memory ceiling for the buffered rows. Windows taller
+                    than the ceiling still get all of their rows.
+
+        Yields
+        ------
+        idx : Positions of the windows in this batch
+        block : An array of shape (bands, rows, width) holding the buffered rows
+        row_off : The tile row of the first row in `block`
+        """
+        windows = np.asarray(windows).reshape(-1, 4)
+        height = self.dataset.height
+        bh = self.block_height
+
+        # Empty windows need no pixels
+        empty = (windows[:,1] <= windows[:,0]) | (windows[:,3] <= windows[:,2])
+        if empty.any():
+            yield np.flatnonzero(empty), np.empty((len(self.bands), 0, self.dataset.width), self.dataset.dtypes[0]), windows[empty,0].min()
+
+        pending = np.flatnonzero(~empty)
+        if len(pending) == 0: return
+        pending = pending[np.argsort(windows[pending,0], kind='stable')]
+
+        # Rows read per step, aligned with the block height of the file
+        tallest = int((windows[pending,1] - windows[pending,0]).max())
+        budget = max_bytes // self.row_bytes() - tallest
+        step = max(bh, budget // bh * bh)
+
+        buf_start = windows[pending[0],0] // bh * bh
+        buf_end = buf_start
+        block = np.empty((len(self.bands), 0, self.dataset.width), self.dataset.dtypes[0])
+        while len(pending):
+            # Skip the rows between the buffer and the next window
+            next_start = windows[pending,0].min() // bh * bh
+            if next_start >= buf_end:
+                buf_start = buf_end = next_start
+                block = block[:, :0]
+            stop = min(buf_end + step, height)
+            block = np.concatenate([block, self.read_rows(buf_end, stop)], axis=1)
+            buf_end = stop
+
+            ready = windows[pending,1] <= buf_end
+            if ready.any():
+                yield pending[ready], block, buf_start
+                pending = pending[~ready]
+                if len(pending) == 0: break
+
+                # Release the rows that no pending window needs
+                keep_from = windows[pending,0].min()
+                block = block[:, keep_from - buf_start:].copy()
+                buf_start = keep_from
+
+
+def crown_pixel_batches(reader, geometries, max_bytes=DEFAULT_MAX_BYTES, pixels=None):
+    """
+    Yield the pixels of the crowns in batches read through `reader`.
+
+    The crown pixels are found with `masking.crown_pixels`, unless they are
+    given as `pixels`, e.g. decoded from stored masks with `rle.decode`.
+
+    Yields
+    ------
+    idx : Positions of the crowns of this batch in `geometries`
+    values : An array of shape (n_pixels, n_bands) with the crown pixels
+    labels : The position of each pixel's crown within `idx`
+    """
+    geometries = np.asarray(geometries)
+    if pixels is None:
+        windows = masking.crown_windows(geometries, reader.xs, reader.ys)
+        labels, rows, cols = masking.crown_pixels(geometries, reader.xs, reader.ys, windows)
+    else:
+        labels, rows, cols = pixels
+        windows = masking.pixel_windows(labels, rows, cols, len(geometries))
+    offsets = masking.crown_offsets(labels, len(geometries))
+    for idx, block, row_off in reader.batches(windows, max_bytes):
+        with instrument.phase('mask'):
+            starts = offsets[idx]
+            sizes = offsets[idx + 1] - starts
+            sel = np.repeat(starts - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())
+            values = np.ascontiguousarray(block[:, rows[sel] - row_off, cols[sel]].T)
+        instrument.count(crowns=len(idx), pixels=len(values))
+        yield idx, values, np.repeat(np.arange(len(idx)), sizes)
+
+
+def chm_path(tile_fn):
+    "Path of the separate CHM file of a repacked tile, which may not exist"
+    tile_fn = Path(tile_fn)
+    return tile_fn.parent/CHM_DIR/tile_fn.name
+
+
+def band_source(tile_fn, band):
+    """
+    The file and band to read band `band` of a tile from: the separate CHM
+    file of a repacked tile if it holds that band, or else the tile itself
+    """
+    chm_fn = chm_path(tile_fn)
+    if chm_fn.exists():
+        with rasterio.open(chm_fn) as src:
+            if src.tags().get(CHM_TAG) == str(band): return chm_fn, 1
+    return tile_fn, band
+
+
+
+def _copy(src, dst_fn, bands, profile, tags=None):
+    "Copy `bands` of `src` to a new file one block row at a time, with their metadata"
+    with rasterio.open(dst_fn, 'w', **profile) as dst:
+        dst.update_tags(**src.tags(), **(tags or {}))
+        for i, b in enumerate(bands, 1):
+            if src.descriptions[b - 1]: dst.set_band_description(i, src.descriptions[b - 1])
+            dst.update_tags(i, **src.tags(b))
+        step = profile['blockysize']
+        for row in range(0, src.height, step):
+            window = Window(0, row, src.width, min(step, src.height - row))
+            with instrument.phase('read'):
+                data = src.read(bands, window=window)
+            instrument.count(bytes_read=data.nbytes)
+            with instrument.phase('write'):
+                dst.write(data, window=window)
+
+
+def repack(tile_fn, out_fn, chm_fn=None, chm_band=None, block_size=REPACK_BLOCK_SIZE, compress=REPACK_COMPRESS,
+           interleave=REPACK_INTERLEAVE):
+    """
+    Rewrite a tile as a tiled and compressed GeoTIFF with the same
+    georeferencing, bands and values.
+
+    Parameters
+    ----------
+    tile_fn : The source tile
+    out_fn : The repacked tile
+    chm_fn, chm_band : Also copy band `chm_band` (1-based) to a single band file `chm_fn`
+    block_size : Width and height of the blocks in pixels
+    compress : A GDAL compression, with the floating point predictor where it applies
+    interleave : 'band', or 'pixel' to keep all bands of a pixel together
+    """
+    with rasterio.open(tile_fn) as src:
+        profile = {k: v for k, v in src.profile.items() if k not in ('photometric', 'predictor')}
+        profile.update(driver='GTiff', tiled=True, blockxsize=block_size, blockysize=block_size,
+                       interleave=interleave, compress=compress, bigtiff='if_safer')
+        if compress.lower() in ('zstd', 'deflate', 'lzw'):
+            profile['predictor'] = 3 if np.dtype(src.dtypes[0]).kind == 'f' else 2
+        _copy(src, out_fn, list(range(1, src.count + 1)), profile)
+        if chm_fn is not None:
+            _copy(src, chm_fn, [chm_band], {**profile, 'count': 1}, {CHM_TAG: chm_band})
@@ -0,0 +1,301 @@
+"""
+A spatial index over the finished tree map for fast local queries.
+
+The index is built once from the outputs of map_species.py (or the merged
+tree map) and stored in a directory of flat arrays, which are memory-mapped
+when the index is opened, so opening is instant and the pages are shared by
+all readers:
+
+    meta.json       grid, species names, tiles and CRS
+    x.npy, y.npy    treetop coordinates, float64
+    species.npy     species code, uint8, into meta['species']
+    height.npy      Height_m, float64
+    area.npy        CA_m2, float64
+    tile.npy        tile code, int32, into meta['tiles']
+    tree_id.npy     the value (treeID) column, or the row within the file
+    source.npy      position of the crown in wkb.bin
+    cell_start.npy  first tree of each grid cell, plus the number of trees
+    wkb.bin         the crowns as WKB in the order they were read
+    wkb_offsets.npy start of each crown in wkb.bin, plus its size
+
+The trees are sorted by grid cell, cells numbered row by row, like a packed
+grid file. A bounding box covers a run of consecutive cells in each row of
+the grid, so a query reads one contiguous slice of the arrays per grid row
+and filters it exactly. Trees are located by their treetop.
+"""
+
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS
+from src import geo_io
+
+META_FILE = 'meta.json'
+
+# Side of the grid cells in metres
+CELL_SIZE = 100.0
+
+# Rows converted and written at a time when streaming results
+CHUNK_SIZE = 10_000
+
+ARRAYS = ['x', 'y', 'species', 'height', 'area', 'tile', 'tree_id', 'source', 'cell_start', 'wkb_offsets']
+
+
+def _read_chunks(path):
+    """
+    The trees of a file in chunks, with the geometry as WKB. GeoParquet is
+    read one batch at a time without parsing the geometries.
+
+    Return
+    ------
+    crs : The CRS of the file
+    chunks : An iterator over DataFrames
+    """
+    columns = ['ttop_x', 'ttop_y', 'species', 'Height_m', 'CA_m2']
+    if geo_io.is_parquet(path):
+        f = pq.ParquetFile(path)
+        geo = json.loads(f.schema_arrow.metadata[b'geo'])
+        crs = geo['columns'][geo['primary_column']].get('crs')
+        names = f.schema_arrow.names
+        read = columns + [c for c in ('value', 'tile_id') if c in names] + [geo['primary_column']]
+        chunks = (b.to_pandas().rename(columns={geo['primary_column']: 'geometry'})
+                  for b in f.iter_batches(batch_size=geo_io.ROW_GROUP_SIZE, columns=read))
+        return (CRS.from_json_dict(crs) if crs else None), chunks
+    frame = geo_io.read_frame(path)
+    keep = columns + [c for c in ('value', 'tile_id') if c in frame.columns]
+    chunk = pd.DataFrame(frame[keep])
+    chunk['geometry'] = frame.geometry.to_wkb().values
+    return frame.crs, iter([chunk])
+
+
+def build(paths, out_dir, cell_size=CELL_SIZE):
+    """
+    Build an index over the trees of the vector files `paths`, reading one
+    chunk of trees at a time. The index is written next to `out_dir` and
+    moved in place when complete.
+
+    Return
+    ------
+    n : The number of trees indexed
+    """
+    out_dir = Path(out_dir)
+    tmp = out_dir.with_name(f'{out_dir.name}.tmp')
+    if tmp.exists(): shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    parts = {k: [] for k in ('x', 'y', 'species', 'height', 'area', 'tile', 'tree_id', 'wkb_size')}
+    tiles, species_names, crs = {}, set(), None
+    with open(tmp/'wkb.bin', 'wb') as wkb:
+        for path in paths:
+            path = Path(path)
+            file_crs, chunks = _read_chunks(path)
+            crs = crs or file_crs
+            row = 0
+            for chunk in chunks:
+                tile_ids = chunk.tile_id.astype(str).values if 'tile_id' in chunk else np.full(len(chunk), path.stem)
+                parts['tile'].append(np.array([tiles.setdefault(t, len(tiles)) for t in tile_ids], dtype=np.int32))
+                parts['tree_id'].append(chunk.value.values.astype(np.int64) if 'value' in chunk
+                                        else np.arange(row, row + len(chunk)))
+                parts['x'].append(chunk.ttop_x.values.astype(np.float64))
+                parts['y'].append(chunk.ttop_y.values.astype(np.float64))
+                parts['species'].append(chunk.species.astype(str).values)
+                parts['height'].append(chunk.Height_m.values.astype(np.float64))
+                parts['area'].append(chunk.CA_m2.values.astype(np.float64))
+                parts['wkb_size'].append(np.fromiter(map(len, chunk.geometry.values), np.int64, len(chunk)))
+                wkb.write(b''.join(chunk.geometry.values))
+                species_names.update(parts['species'][-1])
+                row += len(chunk)
+
+    arrays = {k: np.concatenate(v) if v else np.zeros(0) for k, v in parts.items()}
+    species_names = sorted(species_names)
+    if len(species_names) > 255: raise ValueError(f'{len(species_names)} species do not fit in uint8 codes')
+    arrays['species'] = np.searchsorted(species_names, arrays['species']).astype(np.uint8)
+    arrays['wkb_offsets'] = np.concatenate([[0], np.cumsum(arrays.pop('wkb_size'))]).astype(np.int64)
+
+    n = len(arrays['x'])
+    x0 = np.floor(arrays['x'].min() / cell_size) * cell_size if n else 0.0
+    y0 = np.floor(arrays['y'].min() / cell_size) * cell_size if n else 0.0
+    cols = np.floor((arrays['x'] - x0) / cell_size).astype(np.int64)
+    rows = np.floor((arrays['y'] - y0) / cell_size).astype(np.int64)
+    shape = (int(rows.max()) + 1 if n else 0, int(cols.max()) + 1 if n else 0)
+    cell = rows * shape[1] + cols
+    order = np.argsort(cell, kind='stable')
+    for k in ('x', 'y', 'species', 'height', 'area', 'tile', 'tree_id'): arrays[k] = arrays[k][order]
+    arrays['source'] = order.astype(np.int64)
+    arrays['cell_start'] = np.searchsorted(cell[order], np.arange(shape[0] * shape[1] + 1)).astype(np.int64)
+
+    for k, v in arrays.items(): np.save(tmp/f'{k}.npy', v)
+    meta = {'n': n, 'cell_size': cell_size, 'origin': [x0, y0], 'shape': list(shape),
+            'species': species_names, 'tiles': list(tiles), 'crs': crs.to_json_dict() if crs else None,
+            'sources': [str(p) for p in paths]}
+    with open(tmp/META_FILE, 'w') as f: json.dump(meta, f, indent=1)
+    if out_dir.exists(): shutil.rmtree(out_dir)
+    os.replace(tmp, out_dir)
+    return n
+
+
+def _ranges(starts, ends):
+    "The concatenated ranges [starts[i], ends[i])"
+    n = ends - starts
+    return np.repeat(starts - np.cumsum(n) + n, n) + np.arange(n.sum())
+
+
+class TreeIndex:
+    "Queries over a tree map index written by `build`"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/META_FILE) as f:
+            self.meta = json.load(f)
+        for k in ARRAYS: setattr(self, k, np.load(self.path/f'{k}.npy', mmap_mode='r'))
+        self.blob = np.memmap(self.path/'wkb.bin', dtype=np.uint8, mode='r') if self.wkb_offsets[-1] else b''
+        self.species_names = self.meta['species']
+        self.tile_ids = np.array(self.meta['tiles'], dtype=object)
+        self.crs = CRS.from_json_dict(self.meta['crs']) if self.meta['crs'] else None
+        self.cell_size = self.meta['cell_size']
+        self.x0, self.y0 = self.meta['origin']
+        self.n_rows, self.n_cols = self.meta['shape']
+
+    def __len__(self): return self.meta['n']
+
+    def species_codes(self, species):
+        "The codes of a list of species names, unknown names raise a KeyError"
+        unknown = [s for s in species if s not in self.species_names]
+        if unknown: raise KeyError(f'Unknown species {unknown}, expected some of {self.species_names}')
+        return np.array([self.species_names.index(s) for s in species], dtype=np.uint8)
+
+    def in_bbox(self, bbox):
+        "The trees with the treetop in the closed box (xmin, ymin, xmax, ymax), in index order"
+        xmin, ymin, xmax, ymax = bbox
+        c0 = max(int(np.floor((xmin - self.x0) / self.cell_size)), 0)
+        c1 = min(int(np.floor((xmax - self.x0) / self.cell_size)), self.n_cols - 1)
+        r0 = max(int(np.floor((ymin - self.y0) / self.cell_size)), 0)
+        r1 = min(int(np.floor((ymax - self.y0) / self.cell_size)), self.n_rows - 1)
+        if c0 > c1 or r0 > r1: return np.zeros(0, dtype=np.int64)
+        first = np.arange(r0, r1 + 1) * self.n_cols
+        idx = _ranges(self.cell_start[first + c0], self.cell_start[first + c1 + 1])
+        x, y = self.x[idx], self.y[idx]
+        return idx[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+    def query(self, bbox=None, center=None, radius=None, polygon=None, species=None,
+              min_height=None, max_height=None, limit=None):
+        """
+        Select trees by location and attributes. The location filters are
+        combined, without any the whole map is selected.
+
+        Parameters
+        ----------
+        bbox : (xmin, ymin, xmax, ymax) containing the treetops
+        center, radius : (x, y) and the distance of the treetops from it
+        polygon : A shapely polygon containing the treetops, e.g. a stand
+        species : A list of species names
+        min_height, max_height : Bounds of Height_m
+        limit : The maximum number of trees returned
+
+        Return
+        ------
+        idx : The positions of the trees in the index
+        """
+        boxes = []
+        if bbox is not None: boxes.append(tuple(bbox))
+        if center is not None:
+            if radius is None: raise ValueError('A radius is needed with the center')
+            boxes.append((center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius))
+        if polygon is not None: boxes.append(tuple(shapely.bounds(polygon)))
+        if boxes:
+            box = np.array(boxes)
+            idx = self.in_bbox((*box[:, :2].max(axis=0), *box[:, 2:].min(axis=0)))
+        else:
+            idx = np.arange(len(self), dtype=np.int64)
+
+        keep = np.ones(len(idx), dtype=bool)
+        if center is not None:
+            keep &= (self.x[idx] - center[0])**2 + (self.y[idx] - center[1])**2 <= radius**2
+        if polygon is not None:
+            keep &= shapely.contains_xy(polygon, self.x[idx], self.y[idx])
+        if species is not None: keep &= np.isin(self.species[idx], self.species_codes(species))
+        if min_height is not None: keep &= self.height[idx] >= min_height
+        if max_height is not None: keep &= self.height[idx] <= max_height
+        idx = idx[keep]
+        return idx if limit is None else idx[:limit]
+
+    def counts(self, idx, cell_size=CELL_SIZE):
+        """
+        The number of trees of each species per square cell of `cell_size`
+        metres, cells aligned to multiples of `cell_size`. 100 m gives the
+        counts per hectare.
+
+        Return
+        ------
+        counts : A DataFrame with the corner x, y of each cell with trees, the
+                 total and a column per species
+        """
+        col = np.floor(self.x[idx] / cell_size).astype(np.int64)
+        row = np.floor(self.y[idx] / cell_size).astype(np.int64)
+        n_species = len(self.species_names)
+        if len(idx) == 0: return pd.DataFrame(columns=['x', 'y', 'total'] + self.species_names)
+        # Count over the cells of the bounding box of the trees, then keep the occupied cells
+        col0, row0 = col.min(), row.min()
+        n_cols, n_rows = col.max() - col0 + 1, row.max() - row0 + 1
+        cell = (row - row0) * n_cols + (col - col0)
+        table = np.bincount(cell * n_species + self.species[idx],
+                            minlength=n_rows * n_cols * n_species).reshape(-1, n_species)
+        occupied = np.flatnonzero(table.any(axis=1))
+        counts = pd.DataFrame(table[occupied], columns=self.species_names)
+        counts.insert(0, 'total', counts.sum(axis=1))
+        counts.insert(0, 'y', (occupied // n_cols + row0) * cell_size)
+        counts.insert(0, 'x', (occupied % n_cols + col0) * cell_size)
+        return counts
+
+    def columns(self, idx):
+        "The attributes of the trees as a DataFrame"
+        return pd.DataFrame({'tile_id': self.tile_ids[self.tile[idx]], 'tree_id': self.tree_id[idx],
+                             'ttop_x': self.x[idx], 'ttop_y': self.y[idx],
+                             'species': np.array(self.species_names, dtype=object)[self.species[idx]],
+                             'Height_m': self.height[idx], 'CA_m2': self.area[idx]})
+
+    def wkb(self, idx):
+        "The crowns of the trees as WKB"
+        source = self.source[idx]
+        starts, ends = self.wkb_offsets[source], self.wkb_offsets[source + 1]
+        return np.array([bytes(self.blob[s:e]) for s, e in zip(starts, ends)], dtype=object)
+
+    def frame(self, idx):
+        "The trees as a GeoDataFrame"
+        return gpd.GeoDataFrame(self.columns(idx), geometry=shapely.from_wkb(self.wkb(idx)), crs=self.crs)
+
+    def write_parquet(self, idx, f, chunk_size=CHUNK_SIZE):
+        "Stream the trees to a GeoParquet file or file-like object, a row group per chunk"
+        geo = json.dumps(geo_io.geo_metadata('geometry', self.crs)).encode()
+        writer = None
+        for start in range(0, max(len(idx), 1), chunk_size):
+            chunk = idx[start:start + chunk_size]
+            table = pa.Table.from_pandas(self.columns(chunk), preserve_index=False)
+            table = table.append_column('geometry', pa.array(self.wkb(chunk), pa.binary()))
+            table = table.replace_schema_metadata({**table.schema.metadata, b'geo': geo})
+            if writer is None: writer = pq.ParquetWriter(f, table.schema)
+            writer.write_table(table)
+        writer.close()
+
+    def write_ndjson(self, idx, f, chunk_size=CHUNK_SIZE):
+        "Stream the trees to a binary file-like object as GeoJSON features, one per line"
+        for start in range(0, len(idx), chunk_size):
+            chunk = idx[start:start + chunk_size]
+            geometries = shapely.to_geojson(shapely.from_wkb(self.wkb(chunk)))
+            properties = self.columns(chunk)
+            # Missing heights and areas become null, NaN is not valid JSON
+            for c in properties.select_dtypes('float').columns:
+                values = properties[c].to_numpy()
+                finite = np.isfinite(values)
+                if not finite.all(): properties[c] = pd.Series(np.where(finite, values, None), properties.index, dtype=object)
+            records = properties.to_dict('records')
+            lines = [f'{{"type": "Feature", "properties": {json.dumps(r, allow_nan=False)}, "geometry": {g}}}\n'
+                     for r, g in zip(records, geometries)]
+            f.write(''.join(lines).encode())
@@ -8,6 +8,7 @@ from math import modf
 import matplotlib.pyplot as plt
 from shapely.geometry import Point, Polygon
 import geopandas as gpd
+from src import proximity
 
 def check_distance(row, df_measured, radius):
     """
@@ -100,37 +101,31 @@ def filter_too_close(df, radius):
     Filter trees that are too close to each other
     If label is same, drop one of them
     If label is different, drop both
+
+    NOTE: Returns a new frame, see proximity.filter_too_close
     """
-    for row in df.itertuples():
-        if row.Index not in df.index:
-            continue
-        close = df[np.sqrt((df.x - row.x)**2 + (df.y - row.y)**2) < radius]
-        close = close.iloc[1:]
-        for tree in close.itertuples():
-            if row.species == tree.species:
-                # Same species, drop later
-                df.drop(tree.Index, inplace=True)
-            else:
-                # Different species, drop both
-                # Crashes for some reason, fix?
-                df.drop([tree.Index, row.Index], inplace=True)
-                #df.drop(row.Index, inplace=True)
-                break
-    return df
+    return proximity.filter_too_close(df, radius)
 
 def snv(vals):
     """
-    Perform SNV transformation to input tile
-    NOTE: Remove all interpolated bands before computing
+    Perform SNV transformation to input tile, bands first
+    NOTE: Remove all interpolated bands before computing, or use
+    normalization.Normalization, which also leaves out the bands
+
+    Returns a new float32 array, see normalization.normalize
     """
-    vals = (vals - vals.mean(axis=0))/(vals.std(axis=0))
-    return vals
+    # Imported here so the small helpers of utils do not pull in rasterio
+    from src import normalization
+    return normalization.normalize(vals, 'snv', axis=0)
 
 
 def scale_pixels(vals):
     """Scale each pixel with respect to the sum of all bands, 
     as in Dalponte et al 2016
-    NOTE: Remove all interpolated bands before computing this
+    NOTE: Remove all interpolated bands before computing this, or use
+    normalization.Normalization, which also leaves out the bands
+
+    Returns a new float32 array, the input is left unchanged
     """
-    vals /= vals.sum(axis=0)
-    return vals
\ No newline at end of file
+    from src import normalization
+    return normalization.normalize(vals, 'sum', axis=0)
\ No newline at end of file
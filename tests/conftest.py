@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The tests import the shared modules as `from src import ...`, like the scripts
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,61 @@
+"""
+Duplicate groups chaining across tile boundaries, and the reruns of the
+dedup stage when a tile of such a group changes.
+"""
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from src import dedup, geo_io, manifest
+from dedup_trees import dedup_trees
+
+CRS = 'EPSG:32635'
+
+
+def write_tile(path, xmin, xmax):
+    "A tile holding a single crown, a 2 m high box with the treetop in its centre"
+    crown = shapely.box(xmin, 0.0, xmax, 2.0)
+    trees = gpd.GeoDataFrame({'ttop_x': [(xmin + xmax) / 2], 'ttop_y': [1.0], 'CA_m2': [crown.area]},
+                             geometry=[crown], crs=CRS)
+    geo_io.write_frame(trees, path)
+
+
+def chain(tmp_path):
+    """
+    Three tiles whose crowns form one group of duplicates, A overlapping B
+    and B overlapping C, while the treetops of A and C are too far apart to
+    be candidates
+    """
+    tree_dir = tmp_path/'trees'
+    tree_dir.mkdir()
+    for name, x in zip('ABC', (0.0, 0.6, 1.2)):
+        write_tile(tree_dir/f'{name}.parquet', x, x + 4.0)
+    return tree_dir
+
+
+def test_group_tiles():
+    # Crowns 0-1 of tile 0 and 2 are duplicates, and 1-3-4 of tiles 0, 1 and 3
+    group = np.array([0, 1, 0, 1, 1, 2])
+    tile = np.array([0, 0, 2, 1, 3, 3])
+    related = dedup.group_tiles(group, tile, 4)
+    assert [r.tolist() for r in related] == [[1, 2, 3], [0, 3], [0], [0, 1]]
+
+
+def test_chained_group(tmp_path):
+    tree_dir = chain(tmp_path)
+    keys = dedup.cell_keys(np.array([2.0, 2.6, 3.2]), np.ones(3), dedup.GRID_SIZE)
+    i, j = dedup.candidate_pairs(keys, 1)
+    assert sorted(zip(i.tolist(), j.tolist())) == [(0, 1), (1, 2)]
+
+    out_dir = tmp_path/'out'
+    dedup_trees(tree_dir, out_dir, num_workers=1)
+    # Equal areas, the crown of the tile sorted first is kept
+    assert [len(geo_io.read_frame(out_dir/f'{t}.parquet')) for t in 'ABC'] == [1, 0, 0]
+    record = manifest.Manifest(out_dir, 'dedup', {}).load('A')
+    assert set(record['inputs']) == {'trees', 'neighbour_B', 'neighbour_C'}
+
+    # A larger crown in C takes over the whole group, and A is redone although
+    # it has no candidate pair with C
+    write_tile(tree_dir/'C.parquet', 1.2, 5.4)
+    dedup_trees(tree_dir, out_dir, num_workers=1)
+    assert [len(geo_io.read_frame(out_dir/f'{t}.parquet')) for t in 'ABC'] == [0, 0, 1]
@@ -0,0 +1,88 @@
+"""
+Parity of the rasterized crown masks with the former per-pixel
+``Point.within`` loop of the feature extraction.
+"""
+
+from itertools import product
+import numpy as np
+import pytest
+import rioxarray as rxr
+import shapely
+from shapely.geometry import Point, box, Polygon
+from benchmarks import synthetic
+from src import masking, stats
+
+BOUNDS = synthetic.tile_bounds(0, 0, size=20.0)
+
+
+def edge_crowns():
+    "Crowns with edges exactly through pixel centres, and overlapping crowns"
+    xmin, _, _, ymax = BOUNDS
+    x, y = xmin + 0.25, ymax - 0.25
+    return [box(x + 1.0, y - 3.0, x + 3.0, y - 1.0),
+            # Overlaps the first box on a band of pixel centres
+            box(x + 2.0, y - 4.0, x + 4.0, y - 2.0),
+            Polygon([(x + 6, y - 6), (x + 9, y - 6), (x + 6, y - 9)]),
+            # Contains the triangle above
+            Polygon([(x + 5.5, y - 5.5), (x + 10, y - 5.5), (x + 5.5, y - 10)]),
+            # Smaller than a pixel, no centre inside
+            box(x + 12.1, y - 12.4, x + 12.4, y - 12.1),
+            # Only touches pixel centres with its corners and edges
+            box(x, y - 0.5, x + 0.5, y)]
+
+
+@pytest.fixture(scope='module')
+def tile(tmp_path_factory):
+    path = tmp_path_factory.mktemp('tile')/'R0C0.tif'
+    synthetic.write_tile(path, BOUNDS, n_bands=4)
+    _, crowns = synthetic.make_crowns(40, BOUNDS, 'R0C0')
+    geometries = np.concatenate([crowns.geometry.values, np.array(edge_crowns(), dtype=object)])
+    return rxr.open_rasterio(path), geometries
+
+
+def old_masked_windows(tile, geometries):
+    "The crown windows of the former loop, with the pixels outside the crown set to nan"
+    windows = []
+    for geometry in geometries:
+        xmin, ymin, xmax, ymax = geometry.bounds
+        cropped = tile.sel(y=slice(ymax, ymin), x=slice(xmin, xmax)).copy()
+        for x, y in product(range(cropped.shape[2]), range(cropped.shape[1])):
+            if not Point(cropped[:, y, x].x.values, cropped[:, y, x].y.values).within(geometry):
+                cropped[:, y, x] = np.nan
+        windows.append(cropped.values)
+    return windows
+
+
+def test_pixel_centres(tile):
+    tile, _ = tile
+    xs, ys = masking.pixel_centres(tile.rio.transform(), tile.rio.width, tile.rio.height)
+    assert np.array_equal(xs, tile.x.values)
+    assert np.array_equal(ys, tile.y.values)
+
+
+def test_crown_masks(tile):
+    tile, geometries = tile
+    # Overlapping crowns are part of the parity check
+    assert shapely.intersects(geometries[-6], geometries[-5])
+    old = old_masked_windows(tile, geometries)
+    new = list(masking.crown_masks(geometries, tile.x.values, tile.y.values))
+    assert len(old) == len(new)
+    for cropped, ((r0, r1, c0, c1), mask) in zip(old, new):
+        assert np.array_equal(~np.isnan(cropped[0]), mask)
+        assert np.array_equal(cropped, masking.mask_outside(tile.values[:, r0:r1, c0:c1], mask), equal_nan=True)
+
+
+def test_crown_features(tile):
+    tile, geometries = tile
+    values = tile.values
+
+    # The pixels of the former loop, row by row within each crown window
+    old = old_masked_windows(tile, geometries)
+    old_pixels = [cropped[:, ~np.isnan(cropped[0])].T for cropped in old]
+    old_labels = np.repeat(np.arange(len(geometries)), [len(p) for p in old_pixels])
+    old_moments = stats.grouped_moments(np.concatenate(old_pixels), old_labels, len(geometries))
+
+    labels, rows, cols = masking.crown_pixels(geometries, tile.x.values, tile.y.values)
+    assert np.array_equal(labels, old_labels)
+    new_moments = stats.grouped_moments(values[:, rows, cols].T, labels, len(geometries))
+    assert np.array_equal(stats.crown_features(new_moments), stats.crown_features(old_moments), equal_nan=True)
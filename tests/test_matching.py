@@ -0,0 +1,79 @@
+"""
+Parity of the STRtree crown matching with the former per-crown
+``utils.label_contours`` apply of match_field_data.py.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from benchmarks import synthetic
+from src import matching, utils
+
+BOUNDS = synthetic.tile_bounds(0, 0, size=60.0)
+
+
+def tied_trees(crowns, n=12):
+    """
+    Field trees at equal distances from the treetops of the first `n` crowns:
+    pairs of non-GPS trees, pairs of GPS trees, and a close non-GPS tree with
+    a GPS tree further away
+    """
+    rows = []
+    for k, crown in enumerate(crowns.head(n).itertuples()):
+        x, y, d = crown.ttop_x, crown.ttop_y, 0.25
+        gps = [(0, 0), (1, 1), (0, 1)][k % 3]
+        far = 2 * d if gps == (0, 1) else d
+        for (dx, dy), is_gps in zip([(-d, 0), (far, 0)], gps):
+            rows.append({'species': f'tie{k}', 'tree_X': x + dx, 'tree_Y': y + dy, 'DBH': 20.0,
+                         'nov_2019': 0, 'sum_2019': 1, 'is_gps': is_gps})
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope='module')
+def tile():
+    ttops, crowns = synthetic.make_crowns(200, BOUNDS, 'R0C0', seed=1)
+    crowns['ttop_x'] = shapely.get_x(ttops.geometry.values)
+    crowns['ttop_y'] = shapely.get_y(ttops.geometry.values)
+    field = synthetic.make_field_plots(ttops, n_plots=6, radius=9.0, seed=1)
+    field = pd.concat([pd.DataFrame(field.drop(columns='geometry')), tied_trees(crowns)], ignore_index=True)
+    field = field[['species', 'tree_X', 'tree_Y', 'DBH', 'nov_2019', 'sum_2019', 'is_gps']]
+    return crowns, field.drop_duplicates(['tree_X', 'tree_Y'])
+
+
+def old_match(crowns, field):
+    "The matching loop of the original match_field_data.py"
+    xdims = crowns.ttop_x.min(), crowns.ttop_x.max()
+    ydims = crowns.ttop_y.min(), crowns.ttop_y.max()
+    plot = field[field['tree_Y'].between(ydims[0], ydims[1]) & field['tree_X'].between(xdims[0], xdims[1])].copy()
+    crowns = crowns.copy()
+    crowns[matching.MATCH_COLUMNS] = crowns.apply(lambda row: utils.label_contours(row, plot), axis=1,
+                                                  result_type='expand')
+    return crowns.dropna()
+
+
+def new_match(crowns, field):
+    "The matching of match_field_data.py"
+    xdims = crowns.ttop_x.min(), crowns.ttop_x.max()
+    ydims = crowns.ttop_y.min(), crowns.ttop_y.max()
+    plot = matching.trees_in_bbox(field, xdims, ydims, matching.field_index(field))
+    crowns = crowns.copy()
+    matched = matching.match_crowns(crowns, plot)
+    for col in matching.MATCH_COLUMNS: crowns[col] = matched[col]
+    return crowns.dropna()
+
+
+def test_trees_in_bbox(tile):
+    crowns, field = tile
+    xdims, ydims = (BOUNDS[0] + 10, BOUNDS[0] + 30), (BOUNDS[1] + 5, BOUNDS[1] + 40)
+    expected = field[field.tree_Y.between(*ydims) & field.tree_X.between(*xdims)]
+    pd.testing.assert_frame_equal(matching.trees_in_bbox(field, xdims, ydims), expected, check_exact=True)
+
+
+def test_matched_trees(tile):
+    crowns, field = tile
+    old, new = old_match(crowns, field), new_match(crowns, field)
+    # Crowns with several candidates and ties in the distance are part of the check
+    assert (old.species.str.startswith('tie')).sum() >= 10
+    assert len(old) > 20
+    pd.testing.assert_frame_equal(new, old, check_dtype=False, check_exact=True)
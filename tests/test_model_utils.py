@@ -0,0 +1,48 @@
+"""
+The hyperparameter search of train_classifier keeps the column names of a
+DataFrame, so the searched candidates see the same input as the returned model.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import StandardScaler
+from model_utils import train_classifier
+
+PARAMS = {"n_estimators": [5, 10], "max_depth": [2, 4, None]}
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(120, 6)), columns=[f"mean_band_{b}" for b in range(1, 7)])
+    y = np.where(X.mean_band_2 + X.mean_band_5 > 0, "pine", "spruce")
+    return X, y
+
+
+def _by_name():
+    return [("select", ColumnTransformer([("scale", StandardScaler(), ["mean_band_2", "mean_band_5"])]))]
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+@pytest.mark.parametrize("search", ["random", "halving"])
+def test_columns_by_name(data, memmap, search):
+    X, y = data
+    clf = train_classifier(RandomForestClassifier(random_state=0), PARAMS, X, y, search=search,
+                           preprocessing=_by_name(), memmap=memmap, n_iter=4, cv=3, random_state=0,
+                           error_score="raise")
+    assert list(clf.feature_names_in_) == list(X.columns)
+    assert (clf.predict(X) == y).mean() > 0.9
+
+
+def test_multimetric_refit(data):
+    X, y = data
+    clf = train_classifier(RandomForestClassifier(random_state=0), PARAMS, X, y,
+                           scoring={"f1": "f1_macro", "acc": "accuracy"}, refit="f1", n_iter=3, cv=3, random_state=0)
+    assert clf.predict(X).shape == y.shape
+    with pytest.raises(ValueError):
+        train_classifier(RandomForestClassifier(), PARAMS, X, y, scoring={"f1": "f1_macro", "acc": "accuracy"}, n_iter=2)
+    with pytest.raises(ValueError):
+        train_classifier(RandomForestClassifier(), PARAMS, X, y, refit=False, n_iter=2)
@@ -0,0 +1,61 @@
+"""
+The grouped moment kernel against the NumPy and SciPy statistics of the
+former per-crown feature extraction.
+"""
+
+import warnings
+import numpy as np
+import pytest
+from scipy.stats import skew, kurtosis
+from src import stats
+
+
+def reference_features(values, labels, n_groups):
+    "The statistics of each group as np.nanmean, np.nanstd, ..., scipy skew and kurtosis compute them"
+    rows = []
+    with warnings.catch_warnings():
+        # All-NaN bands and constant data warn in NumPy and SciPy
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for g in range(n_groups):
+            v = values[labels == g]
+            rows.append(np.hstack([np.nanmean(v, axis=0), np.nanstd(v, axis=0), np.nanmin(v, axis=0),
+                                   np.nanmax(v, axis=0), skew(v, axis=0, nan_policy='omit'),
+                                   kurtosis(v, axis=0, nan_policy='omit')]))
+    return np.array(rows, dtype=np.float64)
+
+
+@pytest.fixture
+def pixels():
+    rng = np.random.default_rng(0)
+    sizes = np.array([1, 1, 2, 3, 17, 40, 5, 1, 120, 9])
+    labels = np.repeat(np.arange(len(sizes)), sizes)
+    values = rng.normal(0.2, 0.05, (len(labels), 6)).astype(np.float32)
+    # Missing pixels, a band missing from a whole crown and a constant band
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[labels == 5, 2] = np.nan
+    values[labels == 4, 3] = 0.25
+    # Crowns in shuffled pixel order
+    order = rng.permutation(len(labels))
+    return values[order], labels[order], len(sizes)
+
+
+def test_crown_features_match_reference(pixels):
+    values, labels, n_groups = pixels
+    expected = reference_features(values.astype(np.float64), labels, n_groups)
+    computed = stats.crown_features(stats.grouped_moments(values, labels, n_groups))
+    assert np.array_equal(np.isnan(computed), np.isnan(expected))
+    np.testing.assert_allclose(computed, expected, rtol=1e-9, atol=1e-12, equal_nan=True)
+
+
+def test_one_pixel_crowns(pixels):
+    values, labels, n_groups = pixels
+    computed = stats.crown_features(stats.grouped_moments(values, labels, n_groups)).reshape(n_groups, 6, -1)
+    single = [g for g in range(n_groups) if (labels == g).sum() == 1]
+    for g in single:
+        v = values[labels == g][0]
+        mean, sd, vmin, vmax, sk, ku = computed[g]
+        np.testing.assert_array_equal(mean, v)
+        np.testing.assert_array_equal(vmin, v)
+        np.testing.assert_array_equal(vmax, v)
+        assert np.all(sd[~np.isnan(v)] == 0)
+        assert np.all(np.isnan(sk)) and np.all(np.isnan(ku))